@@ -7,7 +7,7 @@ v. 1.0 (7/20/2015) script does edge removal, star-diffraction spikes through run
 has to be done separately.
 
 v. 2.0 (8/4/2015) changed to object-oriented design. Manual masking, in-image overlap are included. A clean catalog is generated every time
-a GalaxyCatalog instance is initiated. (No statistics)
+a GalaxyCatalog instance is initiated.
 
 v. 2.1 (8/5/2015) helper functions moved to cleanutils.py and are imported.
 
@@ -29,7 +29,8 @@ The automatic star diffraction masking has been tested on AEGIS f606w and f814w
 that the size of each diffraction spike scales with flux. These parameters can also be adjusted, but the 
 automatic parameters are included. 
 
-Finally, statistics of how many objects are extracted and cleaned at each step are output into a text file.
+Finally, statistics of how many objects are extracted and cleaned at each step, with the time and memory each
+step takes, are written as JSON lines by instrument.py (set CG_INSTRUMENT_LOG to turn them on).
 
 ########## Input ##########
 
@@ -83,8 +84,14 @@ import pyfits
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+import os
 from cleanutils import *
 from focus_positions import *
+import instrument
+from selection import apply_selection
+from background import prepare_sextractor_images, bad_rms
+from subtiles import run_sextractor_split
+from compressed_fits import image_hdu, read_header, write_image
 
 '''
 Steps:
@@ -103,6 +110,10 @@ Steps:
 13) Manual cleanup
 '''
 
+#(BACK_SIZE, BACK_FILTERSIZE) of a SExtractor configuration
+def background_setting(config_dict):
+    return (config_dict['BACK_SIZE'], config_dict['BACK_FILTERSIZE'])
+
 ### Class definition ###
 class GalaxyCatalog:
     
@@ -152,7 +163,17 @@ class GalaxyCatalog:
     f606w_spike_params = (0.0350087,64.0863,40.0,2.614)
     f814w_spike_params = (0.0367020,77.7674,40.0,2.180)
     
-    def __init__(self, file, weight_file, filter, out_name, manual_mask_file=None, catalog=None):  
+    #selection (a selection.Selection, e.g. selection.assoc_selection) drops the objects that cannot pass it as
+    #soon as its columns exist, keeping its context objects (the stars)
+    #detection, a (detection image, detection weight) pair from dual_image.make_detection_image, runs SExtractor
+    #in dual-image mode: objects are found on the detection image and measured on file. The NUMBER given after
+    #the merge of the two passes is kept through cleaning, and is the same object in every filter
+    #background_cache, a directory, has the background and RMS maps of both SExtractor passes measured once per
+    #tile and cached there (see background.py) instead of by SExtractor in each pass (single-image mode only)
+    #subtiles, (n_x, n_y), runs SExtractor on n_x x n_y overlapping sub-tiles in parallel, with subtile_margin
+    #pixels of overlap (more than the biggest object), and stitches them (see subtiles.py)
+    #compression sets the tile compression of the segmentation map (the "segmentation" kind of compressed_fits.py)
+    def __init__(self, file, weight_file, filter, out_name, manual_mask_file=None, catalog=None, selection=None, detection=None, background_cache=None, subtiles=None, subtile_margin=500, compression=None):  
         #Initial setup of attributes
         self.file = file
         self.weight_file = weight_file
@@ -166,58 +187,99 @@ class GalaxyCatalog:
         if catalog is not None:
             self.catalog = catalog
         self.catalog_vertex_file = manual_mask_file
+        self.selection = selection
+        self.detection = detection
+        self.background_cache = background_cache
+        self.background_images = {}
+        self.subtiles = subtiles
+        self.subtile_margin = subtile_margin
+        self.compression = compression
         
     def generate_catalog(self):
+        with instrument.Stage("generate_catalog", tile=self.file) as total:
+            self.__generate_catalog()
+            total.rows_out = self.catalog
+
+    def __generate_catalog(self):
+        #Background-subtracted images and RMS maps for both passes, from the cache or one read of the tile
+        if self.background_cache is not None and self.detection is None:
+            settings = [background_setting(self.bright_config_dict), background_setting(self.faint_config_dict)]
+            self.background_images = prepare_sextractor_images(self.file, self.weight_file, settings, self.background_cache)
+        
         #Runs sextractor for the bright catalog
-        self.__run_sextractor(self.bright_config_dict, self.out_name + "_bright", self.output_params)
-        self.bright_catalog = self.out_name + "_bright.cat"
+        with instrument.Stage("sextractor_bright") as s:
+            self.__run_sextractor(self.bright_config_dict, self.out_name + "_bright", self.output_params)
+            self.bright_catalog = self.out_name + "_bright.cat"
+            s.rows_out = self.bright_catalog
         #Stores "bright.cat" as the bright catalog
         
         #Makes the segmentation map
-        print self.file
-        self.__make_segmentation_map(self.out_name)
-        self.seg_map = self.out_name + "_seg_map.fits"
+        with instrument.Stage("segmentation_map", rows_in=self.bright_catalog):
+            self.__make_segmentation_map(self.out_name)
+            self.seg_map = self.out_name + "_seg_map.fits"
         
-        #Runs sextractor for the faint catalog
-        self.__run_sextractor(self.faint_config_dict, self.out_name + "_faint", self.output_params)
-        self.faint_catalog = self.out_name + "_faint.cat"
+        #Runs sextractor for the faint catalog. Its segmentation map is kept so that postage_stamps can
+        #cut the stamp masks from it instead of re-running sextractor on every stamp.
+        with instrument.Stage("sextractor_faint") as s:
+            self.__run_sextractor(self.faint_config_dict, self.out_name + "_faint", self.output_params, check_images={"SEGMENTATION" : self.out_name + ".seg.fits"})
+            self.faint_catalog = self.out_name + "_faint.cat"
+            self.segmentation = self.out_name + ".seg.fits"
+            s.rows_out = self.faint_catalog
+        #The background images stay in the cache for the next run on this tile
+        self.background_images = {}
         
         #Filters the faint catalog
-        self.__filter_cat_with_segmentation_map(self.out_name + "_filteredfaint.cat")
-        self.filtered_faint_catalog = self.out_name + "_filteredfaint.cat"
+        with instrument.Stage("filter_faint", rows_in=self.faint_catalog) as s:
+            self.__filter_cat_with_segmentation_map(self.out_name + "_filteredfaint.cat")
+            self.filtered_faint_catalog = self.out_name + "_filteredfaint.cat"
+            s.rows_out = self.filtered_faint_catalog
         
         #Merges the faint and bright catalogs
-        self.__merge(self.out_name + "_merge.cat")
-        self.merged_catalog = self.out_name + "_merge.cat"
-        renumber(self.merged_catalog)
+        with instrument.Stage("merge") as s:
+            self.__merge(self.out_name + "_merge.cat")
+            self.merged_catalog = self.out_name + "_merge.cat"
+            renumber(self.merged_catalog)
+            s.rows_out = self.merged_catalog
         
         #Add is_star
-        self.__alter_catalog_for_classification(self.out_name + "_class.cat", self.star_galaxy_weights[0], self.star_galaxy_weights[1], self.star_galaxy_weights[2], self.star_galaxy_weights[3])
-        self.class_catalog = self.out_name + "_class.cat"
+        with instrument.Stage("classification", rows_in=self.merged_catalog) as s:
+            self.__alter_catalog_for_classification(self.out_name + "_class.cat", self.star_galaxy_weights[0], self.star_galaxy_weights[1], self.star_galaxy_weights[2], self.star_galaxy_weights[3])
+            self.class_catalog = self.out_name + "_class.cat"
+            s.rows_out = self.class_catalog
         
-        #Add S/N ratio
-        self.__make_SNR(self.out_name + "_snr.cat")
-        self.snr_catalog = self.out_name + "_snr.cat"   
+        #Selection cuts on the columns that exist now (MAG_AUTO, FLUX_RADIUS, IS_STAR)
+        if self.selection is not None:
+            apply_selection(self.class_catalog, self.selection)
         
-        #Clean out edge objects
-        self.__edge_overlap_clean(self.out_name + "_edge.cat")
-        self.edge_catalog = self.out_name + "_edge.cat"
+        #Add S/N ratio
+        with instrument.Stage("snr", rows_in=self.class_catalog) as s:
+            self.__make_SNR(self.out_name + "_snr.cat")
+            self.snr_catalog = self.out_name + "_snr.cat"   
+            s.rows_out = self.snr_catalog
         
-        #Clean star diffraction spikes/clean for overlap
-        self.diffraction_mask_cleanup(self.out_name + ".cat", self.spike_params)
-        delete_overlap(self.out_name + ".cat")
-        delete_null(self.out_name + ".cat")
-        renumber(self.out_name + ".cat")
+        #Cleaning: edge removal, star diffraction spikes, in-image overlap and the manual masks of this catalog.
+        #Each step is a keep-mask over the S/N catalog; the survivors are renumbered and written once, and the
+        #rejected objects go to _rejected.cat with the step that removed them. The edge footprint follows the
+        #size of the tile.
+        header = read_header(self.file)
+        corners = tile_edge_corners((int(header['NAXIS2']), int(header['NAXIS1'])))
+        steps = [("edge_clean", lambda cat, keep: edge_keep(cat, keep, corners)),
+                 ("diffraction_mask", lambda cat, keep: diffraction_keep(cat, keep, self.spike_params)),
+                 ("delete_overlap", overlap_keep)]
+        if self.selection is not None:
+            steps.insert(0, ("selection", lambda cat, keep: self.selection.keep(cat, cat.names)))
+        masks = self.manual_masks()
+        if len(masks) > 0:
+            steps.append(("manual_mask", lambda cat, keep: manual_keep(cat, keep, masks)))
+        self.rejected_catalog = self.out_name + "_rejected.cat"
+        self.keep, self.rejected = clean_catalog(self.snr_catalog, self.out_name + ".cat", steps, renumber_rows=self.detection is None, rejected_name=self.rejected_catalog)
         self.diff_catalog = self.out_name + ".cat"
         self.catalog = self.diff_catalog
         
-        #Manual mask
-        if self.catalog_vertex_file != None:
-            self.manual_mask_catalogs()
-        
         subprocess.call(["rm", "-rf", self.out_name + "_*"])
                 
-    def run_sextractor(self, use_dict, out_name, output_params, clean=True):
+    #check_images is an optional dictionary of CHECKIMAGE_TYPE : CHECKIMAGE_NAME
+    def run_sextractor(self, use_dict, out_name, output_params, clean=True, check_images=None):
         param_ascii = asciidata.create(1,len(output_params))
         row_counter = 0
         for param in output_params:
@@ -226,17 +288,40 @@ class GalaxyCatalog:
         param_fname = self.out_name + ".param"
         param_ascii.writeto(param_fname)
         #Create config newfiles[i] and write out to a file
-        config_ascii = asciidata.create(2,4+len(use_dict))
+        if check_images is None:
+            check_images = {}
+        images = self.file
+        weight_type = 'MAP_WEIGHT'
+        weight_image = self.weight_file
+        precomputed = self.background_images.get(background_setting(use_dict))
+        if precomputed is not None:
+            #Background already subtracted and the noise given per pixel (background.py)
+            images, weight_image = precomputed
+            weight_type = 'MAP_RMS'
+            use_dict = dict(use_dict)
+            use_dict.update({'BACK_TYPE' : 'MANUAL', 'BACK_VALUE' : 0.0, 'WEIGHT_THRESH' : bad_rms/10})
+        config_ascii = asciidata.create(2,4+len(use_dict)+2*(len(check_images) > 0))
         #File-Specific Configurations
         config_ascii[0][0] = 'CATALOG_NAME'
         config_ascii[1][0] = out_name + ".cat"
         config_ascii[0][1] = 'PARAMETERS_NAME'
         config_ascii[1][1] = self.out_name + ".param"
         config_ascii[0][2] = 'WEIGHT_TYPE'
-        config_ascii[1][2] = 'MAP_WEIGHT'
+        config_ascii[1][2] = weight_type
         config_ascii[0][3] = 'WEIGHT_IMAGE'
-        config_ascii[1][3] = self.weight_file
+        config_ascii[1][3] = weight_image
+        if self.detection is not None:
+            #Dual-image mode: detection image first, measurement image second, and a weight map for each
+            config_ascii[1][2] = 'MAP_WEIGHT,MAP_WEIGHT'
+            config_ascii[1][3] = self.detection[1] + "," + self.weight_file
+            images = self.detection[0] + "," + self.file
         row_counter = 4
+        if len(check_images) > 0:
+            config_ascii[0][row_counter] = 'CHECKIMAGE_TYPE'
+            config_ascii[1][row_counter] = ",".join(check_images.keys())
+            config_ascii[0][row_counter+1] = 'CHECKIMAGE_NAME'
+            config_ascii[1][row_counter+1] = ",".join(check_images.values())
+            row_counter += 2
         for key, value in use_dict.iteritems():
             config_ascii[0][row_counter] = key
             config_ascii[1][row_counter] = value
@@ -245,7 +330,10 @@ class GalaxyCatalog:
         config_ascii.writeto(config_fname)
                 
         #Run sextractor and get the catalog
-        subprocess.call(["sex", self.file , "-c", config_fname])
+        if self.subtiles is None:
+            instrument.call(["sex", images, "-c", config_fname])
+        else:
+            run_sextractor_split(images, config_fname, self.subtiles, self.subtile_margin)
     
         #Optional Clean
         subprocess.call(["rm", config_fname])
@@ -255,8 +343,8 @@ class GalaxyCatalog:
     
     def make_segmentation_map(self, out_name, enlarge=20):
         hdulist = pyfits.open(self.file)
-        x_dim = int(hdulist[0].header['NAXIS1'])
-        y_dim = int(hdulist[0].header['NAXIS2'])
+        x_dim = int(image_hdu(hdulist).header['NAXIS1'])
+        y_dim = int(image_hdu(hdulist).header['NAXIS2'])
         hdulist.close()
         positions = []
         catalog = asciidata.open(self.bright_catalog)
@@ -268,7 +356,7 @@ class GalaxyCatalog:
             pos_tuple = (x_min, x_max, y_min, y_max)
             positions.append(pos_tuple)
         #Make an empty numpy array of zeros in those dimensions
-        segmentation_map_array = np.zeros((x_dim, y_dim))
+        segmentation_map_array = np.zeros((x_dim, y_dim), dtype=np.uint8)
         #Iterate through position tuples and switch flagged areas to 1's in the array
         for j in range(len(positions)):
             x_min = (positions[j])[0]
@@ -282,8 +370,7 @@ class GalaxyCatalog:
                     except:
                         continue
         #Write out to a fits file
-	    hdu_out = pyfits.PrimaryHDU(segmentation_map_array)
-        hdu_out.writeto(out_name + "_seg_map.fits",clobber=True)
+        write_image(segmentation_map_array, out_name + "_seg_map.fits", kind="segmentation", compression=self.compression)
         
     __make_segmentation_map = make_segmentation_map
     
@@ -291,7 +378,7 @@ class GalaxyCatalog:
         catalog = asciidata.open(self.faint_catalog)
         new_table = asciidata.create(catalog.ncols,catalog.nrows) 
         segmentation_file = pyfits.open(self.seg_map)
-        data = segmentation_file[0].data   
+        data = image_hdu(segmentation_file).data   
         for j in range(0,catalog.nrows):
             x_center = catalog['X_IMAGE'][j]
             y_center = catalog['Y_IMAGE'][j]
@@ -326,6 +413,7 @@ class GalaxyCatalog:
                 f.write(line)          
         faint_cat.close()
         bright_cat.close()
+        f.close()
         
     __merge = merge
     
@@ -350,172 +438,31 @@ class GalaxyCatalog:
         
     __make_SNR = make_SNR
     
-    def edge_overlap_clean(self, out_name):
-        A = (390.,321.)
-        B = (498.,6725.)
-        C = (6898.,7287.)
-        D = (7002.,806.)
-        (left_m, left_b) = points_to_line(A,B)
-        (top_m, top_b) = points_to_line(B,C)
-        (right_m, right_b) = points_to_line(C,D)
-        (bottom_m, bottom_b) = points_to_line(D,A)
-        #Open the original catalog
-        table_catalog = asciidata.open(self.snr_catalog)
-        #Make a new ascii table (the new catalog)
-        new_table = asciidata.create(table_catalog.ncols,table_catalog.nrows)
-        for i in range(table_catalog.nrows):
-            x_min = table_catalog['XMIN_IMAGE'][i]
-            x_max = table_catalog['XMAX_IMAGE'][i]
-            y_min = table_catalog['YMIN_IMAGE'][i]
-            y_max = table_catalog['YMAX_IMAGE'][i]
-            if (x_min < left_m*x_min+left_b and x_max < right_m*x_max+right_b and \
-            y_min > bottom_m*y_min+bottom_b and y_max < top_m*y_max+top_b):
-                 for k in range(table_catalog.ncols):
-                     new_table[k][i] = table_catalog[k][i]
-        #Get rid of empty rows
-        row_number = 0
-        while True:
-            try:
-                if new_table[0][row_number] is None:
-                    new_table.delete(row_number)
-                else:
-                    row_number += 1
-            except:
-                break
-        #Write out to another catalog
-        new_table.writeto("table_edge_clean.cat")
-        new_catalog = open("table_edge_clean.cat")
-        old_catalog = open(self.snr_catalog)
-        final_catalog = open(out_name, "w")
-        for line in old_catalog.readlines():
-            if line[0] == "#":
-                final_catalog.write(line)
-            else:
-                break
-        for line in new_catalog:
-            final_catalog.write(line)
-    
-    __edge_overlap_clean = edge_overlap_clean
+    #Manual mask polygons of this catalog in the manual masking file, which names catalogs either by out_name
+    #(e.g. 606_17.cat) or by image file (e.g. EGS_10134_17_acs_wfc_f606w_30mas_unrot_drz.fits.cat)
+    def manual_masks(self):
+        if self.catalog_vertex_file is None:
+            return []
+        masks = read_manual_masks(self.catalog_vertex_file)
+        return masks.get(self.out_name + ".cat", []) + masks.get(os.path.basename(self.file) + ".cat", [])
     
-	#Clean the merged catalog
-    def diffraction_mask_cleanup(self, out_name, diff_spike_params, mag_cutoff = 19.0):
-        #Get all stars for which we are masking
-        #the length of the spike is given by l = m*Flux+b
-        #the width of the spike is given by w
-        m = diff_spike_params[0] 
-        b = diff_spike_params[1]
-        w = diff_spike_params[2]*0.5
-        theta = diff_spike_params[3]
-        star_numbers = []
-        star_centroids = []
-        star_radii = []
-        star_spike_lengths = []
-        orig_name = self.edge_catalog
-        catalog = asciidata.open(self.edge_catalog)
-        for i in range(catalog.nrows):
-           if catalog['MAG_AUTO'][i] + 25 < mag_cutoff and catalog['IS_STAR'][i] == 1:
-              star_numbers.append(catalog['NUMBER'][i])
-              star_centroids.append((catalog['X_IMAGE'][i],catalog['Y_IMAGE'][i]))
-              radius = np.mean([catalog['A_IMAGE'][i],catalog['B_IMAGE'][i]])
-              star_radii.append(radius)
-              flux = catalog['FLUX_AUTO'][i]
-              length = m*flux+b
-              star_spike_lengths.append(length)
-        #Get the vertices of each star's diffraction mask
-        x_vertex_sets = []
-        y_vertex_sets = []
-        for i in range(len(star_numbers)):
-            centroid = (star_centroids[i])
-            x0 = centroid[0]
-            y0 = centroid[1]
-            r = star_radii[i]
-            l = star_spike_lengths[i]
-            x_vertices = [x0-w,x0-w,x0+w,x0+w,x0+r,x0+l,x0+l,x0+r,x0+w,x0+w,x0-w,x0-w,x0-r,x0-l,x0-l,x0-r]
-            y_vertices = [y0+r,y0+l,y0+l,y0+r,y0+w,y0+w,y0-w,y0-w,y0-r,y0-l,y0-l,y0-r,y0-w,y0-w,y0+w,y0+w]
-            rotated = rotate(x_vertices,y_vertices,x0,y0,theta)
-            x_rotated = rotated[0]
-            y_rotated = rotated[1]
-            x_vertex_sets.append(x_rotated)
-            y_vertex_sets.append(y_rotated)
-        delete_numbers = []
-        print "Applying masks for", len(x_vertex_sets), "stars."
-        for i in range(catalog.nrows):
-            if (i+1) % 1000 == 0:
-                print "Working on object", i+1, "out of", catalog.nrows
-            number = catalog['NUMBER'][i]
-            is_star = catalog['IS_STAR'][i]
-            if is_star == 1:
-                continue
-            x_min,y_min = int(catalog['XMIN_IMAGE'][i]), int(catalog['YMIN_IMAGE'][i])
-            x_max,y_max = int(catalog['XMAX_IMAGE'][i]), int(catalog['YMAX_IMAGE'][i])
-            bottom_pixels = [(x,y_min) for x in range(x_min,x_max)]
-            left_pixels = [(x_min,y) for y in range(y_min,y_max)]
-            top_pixels = [(x, y_max) for x in range(x_min,x_max)]
-            right_pixels = [(x_max,y) for y in range(y_min,y_max)]
-            pixels = bottom_pixels + left_pixels + top_pixels + right_pixels
-            bools = [inpoly(pixel[0],pixel[1],x_vertex_sets[j],y_vertex_sets[j]) for pixel in pixels for j in range(len(x_vertex_sets))]
-            if max(bools) == 1:
-                delete_numbers.append(number)
-        print "Delete numbers", delete_numbers
-        #Delete entries for which any pixel is within the mask
-        #Make a new ascii table (the new catalog)
-        new_table = asciidata.create(catalog.ncols,catalog.nrows)
-        for i in range(catalog.nrows):
-            if catalog['NUMBER'][i] not in delete_numbers:
-                for k in range(catalog.ncols):
-                    new_table[k][i] = catalog[k][i]
-        #Get rid of empty rows
-        row_number = 0
-        while True:
-            try:
-                if new_table[0][row_number] is None:
-                     new_table.delete(row_number)
-                else:
-                     row_number += 1
-            except:
-                break
-        #Write out to another catalog
-        new_table.writeto("diffraction_filter.cat")
-        new_catalog = open("diffraction_filter.cat")
-        old_catalog = open(orig_name)
-        final_catalog = open(out_name, "w")
-        for line in old_catalog.readlines():
-            if line[0] == "#":
-                final_catalog.write(line)
-            else:
-                break
-        for line in new_catalog:
-            final_catalog.write(line) 
-    
-	# Runs manual mask on a file where lines are:
-	# # 'filename' (must be preceded by # and a space)
-	# list of x-vertices for mask 1
-	# list of y-vertices for mask 1
-	# list of x-vertices for mask 2, etc...
-	def manual_mask_catalogs(self, catalog_vertex_file=self.catalog_vertex_file):
-		f = open(catalog_vertex_file)
-		current_catalog = ""
-		x_vertices = []
-		y_vertices = []
-		for line in f.readlines():
-			split = line.split()
-			if split[0] == '#':
-				current_catalog = split[1]
-				x_vertices = []
-				y_vertices = []
-			else:
-				if len(x_vertices) == 0:
-					for word in split:
-						x_vertices.append(np.float32(word))
-				else:
-					for word in split:
-						y_vertices.append(np.float32(word))
-					print "Masking vertices on", current_catalog, "with vertices:"
-					print x_vertices
-					print y_vertices
-					manual_mask(current_catalog, x_vertices, y_vertices)
-					x_vertices = []
-					y_vertices = []
+    # Runs manual mask on the catalogs named in a file where lines are:
+    # # 'filename' (must be preceded by # and a space)
+    # list of x-vertices for mask 1
+    # list of y-vertices for mask 1
+    # list of x-vertices for mask 2, etc...
+    def manual_mask_catalogs(self, catalog_vertex_file=None):
+        if catalog_vertex_file is None:
+            catalog_vertex_file = self.catalog_vertex_file
+        masks = read_manual_masks(catalog_vertex_file)
+        for current_catalog in sorted(masks.keys()):
+            print "Masking", len(masks[current_catalog]), "polygons on", current_catalog
+            clean_catalog(current_catalog, current_catalog, [("manual_mask", lambda cat, keep: manual_keep(cat, keep, masks[current_catalog]))], renumber_rows=False)
+
+#GalaxyCatalog.generate_catalog as a top-level function (for scheduler.Scheduler); returns the catalog
+def generate_catalog(catalog):
+    catalog.generate_catalog()
+    return catalog
 
 class GalaxyCatalogList:
     def __init__(self, catalog_list, filter):
@@ -530,10 +477,12 @@ class GalaxyCatalogList:
     def add(self, catalog):
         self.catalogs.append(catalog)
         
-    def add_focus(self, out_name, root):
-        tt_galsim_images = get_tt_files(self.filter, root)
+    #store (an image_store.ImageStore) shares the TT fields and tiles between processes; processes measures that
+    #many tiles at once (non-interactive only, see focus_positions.focus)
+    def add_focus(self, out_name, root, interactive=True, histogram=True, store=None, processes=None):
+        tt_galsim_images = get_tt_files(self.filter, root, store)
         tt_star_file = get_star_file(self.filter, root)
-        focus(self.catalogs, self.images, tt_galsim_images, tt_star_file, out_name)
+        focus(self.catalogs, self.images, tt_galsim_images, tt_star_file, out_name, histogram=histogram, interactive=interactive, store=store, processes=processes)
         label_catalogs(out_name, self.catalogs)
              					 
 
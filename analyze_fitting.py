@@ -1,124 +1,263 @@
+import matplotlib
+matplotlib.use("Agg")
 import pyfits
-import asciidata
 import numpy as np
 import matplotlib.pyplot as plt
+import glob
+import os
+import sys
 
-hdulist = pyfits.open("/Users/bemi/JPL/assoc_606_01/output/RAWFIT00000.00471.fits")
-hdulist2 = pyfits.open("/Users/bemi/JPL/assoc_814_01/output/RAWFIT00000.00471.fits")
-stats = open("filter_statistics.txt")
-data1 = hdulist[1].data
-cols1 = hdulist[1].columns
-data2 = hdulist2[1].data
-cols2 = hdulist2[1].columns
-#cols.info()
-
-#Magnitudes and half-light-radii
-
-m1 = []
-m2 = []
-r1 = []
-r2 = []
-for line in stats.readlines():
-    s = line.split()
-    m1.append(float(s[0]))
-    m2.append(float(s[1]))
-    r1.append(float(s[2]))
-    r2.append(float(s[3]))
-
-m1 = np.asarray(m1)
-m2 = np.asarray(m2)
-r1 = np.asarray(r1)*0.03
-r2 = np.asarray(r2)*0.03
-mresid = m1-m2
-rresid = r1-r2
-print np.mean(rresid)
-
-plt.hist([m1,m2],label=["f606w","f814w"], bins=30)
-plt.title("Magnitudes of galaxies in final sample")
-plt.xlabel("Magnitude")
-plt.ylabel("Frequency")
-plt.legend()
-plt.show()
-
-plt.hist(mresid, bins=30)
-plt.title("Difference in magnitude for individual galaxies across f606w and f814w filters")
-plt.xlabel("Residuals, f606w magnitude - f814w magnitude")
-plt.ylabel("Frequency")
-plt.show()
-
-plt.hist([r1,r2],label=["f606w","f814w"], bins=30)
-plt.title("Half-light radius of galaxies in final sample")
-plt.xlabel("Half-light radius, arcseconds")
-plt.ylabel("Frequency")
-plt.legend()
-plt.show()
-
-plt.hist(rresid, bins=30, range=(-0.3,0.3))
-plt.title("Difference in half light radius for individual galaxies across f606w and f814w filters")
-plt.xlabel("Residuals, f606w radius - f814w radius, arcseconds")
-plt.ylabel("Frequency")
-plt.show()
-
-
-#Fits and chi-square
-fit_dvc = (data1.field('FIT_DVC'), data2.field('FIT_DVC'))
-chisq_dvc = (data1.field('CHISQ_DVC'), data2.field('CHISQ_DVC'))
-
-fit_ser = (data1.field('FIT_SER'), data2.field('FIT_SER'))
-chisq_ser = (data1.field('CHISQ_SER'), data2.field('CHISQ_SER'))
-
-fit_expdvc = (data1.field('FIT_EXPDVC'), data2.field('FIT_EXPDVC'))
-chisq_expdvc = (data1.field('CHISQ_EXPDVC'), data2.field('CHISQ_EXPDVC'))
-
-plt.hist([chisq_dvc[0], chisq_ser[0], chisq_expdvc[0]], bins=10, range=(0.0,3.0), label=["De Vacoleurs", "Sersic", "Bulge-disk"])
-plt.xlabel("Chi-square value")
-plt.ylabel("Frequency")
-plt.legend()
-plt.title("Goodness of fit for galaxy profiles in f606w filter")
-plt.show()
-plt.hist([chisq_dvc[1], chisq_ser[1], chisq_expdvc[1]], bins=10, range=(0.0,3.0), label=["De Vacoleurs", "Sersic", "Bulge-disk"])
-plt.xlabel("Chi-square value")
-plt.ylabel("Frequency")
-plt.legend()
-plt.title("Goodness of fit for galaxy profiles in f814w filter")
-plt.show() 
-
-#Flux ratio for b/d
-
-fluxratio_expdvc = (data1.field('FLUXRATIO_EXPDVC'), data2.field('FLUXRATIO_EXPDVC'))
-plt.hist(fluxratio_expdvc, bins=20, range=(0.0,1.0), label=("f606w", "f814w"))
-plt.title("Bulge-to-disk ratios from best bulge-disk fit")
-plt.xlabel("Bulge-to-disk ratio")
-plt.ylabel("Frequency")
-plt.legend()
-plt.show()
-
-
-#Sersic index
-
-fit_ser606 = fit_ser[0]
-fit_ser814 = fit_ser[1]
-ser_index606 = [(fit_ser606[i])[2] for i in range(len(fit_ser606))]
-ser_index814 = [(fit_ser814[i])[2] for i in range(len(fit_ser814))]
-plt.hist([ser_index606, ser_index814], bins=20, range=(0.0, 10.0), label=["f606w", "f814w"])
-plt.title("Best-fit Sersic index for fitting galaxy profiles")
-plt.xlabel("Sersic index")
-plt.ylabel("Frequency")
-plt.legend()
-plt.show()
-
-
-#Fitting status check
-
-name = (data1.field('NAME'), data2.field('NAME'))
-stat_dvc = (data1.field('STAT_DVC'), data2.field('STAT_DVC'))
-stat_ser = (data1.field('STAT_SER'), data2.field('STAT_SER'))
-stat_expdvc = (data1.field('STAT_EXPDVC'), data2.field('STAT_EXPDVC'))
-for i in range(np.size(name[0])):
-  for j in range(2):
-    if (stat_dvc[j])[i] == 0 or (stat_dvc[j])[i] == 5:
-        print j, (name[j])[i], "dvc"
-    if (stat_ser[j])[i] == 0 or (stat_ser[j])[i] == 5:
-        print j, (name[j])[i], "ser"
-    if (stat_expdvc[j])[i] == 0 or (stat_expdvc[j])[i] == 5:
-        print j, (name[j])[i], "expdvc"
+#Summaries of the RAWFIT tables written by the fitter (see fit_galaxies), streamed file by file and chunk by chunk
+#so memory does not grow with the number of galaxies. Histograms use fixed bins decided up front, so the counts
+#from every chunk can simply be added together.
+
+models = ["DVC", "SER", "EXPDVC"]
+model_labels = {"DVC": "De Vacoleurs", "SER": "Sersic", "EXPDVC": "Bulge-disk"}
+failed_stats = (0, 5)
+chunk_rows = 100000
+
+chisq_bins = (30, (0.0, 3.0))
+ser_index_bins = (20, (0.0, 10.0))
+fluxratio_bins = (20, (0.0, 1.0))
+mag_bins = (48, (16.0, 28.0))
+radius_bins = (30, (0.0, 1.5))
+mresid_bins = (40, (-1.0, 1.0))
+rresid_bins = (30, (-0.3, 0.3))
+pixel_scale = 0.03
+
+#Fixed-bin histogram. Values outside the range go to the underflow/overflow counts; NaNs are counted separately.
+class Histogram:
+    def __init__(self, nbins, range):
+        self.edges = np.linspace(range[0], range[1], nbins+1)
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.under = 0
+        self.over = 0
+        self.nan = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        self.nan += len(values) - np.count_nonzero(finite)
+        values = values[finite]
+        self.under += np.count_nonzero(values < self.edges[0])
+        self.over += np.count_nonzero(values > self.edges[-1])
+        self.counts += np.histogram(values, bins=self.edges)[0]
+
+#Count, mean, variance, min and max of a stream of values. Chunks are merged with the pairwise update of
+#Chan et al., which stays accurate when the running count gets large.
+class RunningStats:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean()
+        m2 = ((values - mean)**2).sum()
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta*n/total
+        self.m2 += m2 + delta**2*self.n*n/total
+        self.n = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def std(self):
+        if self.n < 2:
+            return np.nan
+        return np.sqrt(self.m2/(self.n-1))
+
+#Everything accumulated for one band
+class BandSummary:
+    def __init__(self, band):
+        self.band = band
+        self.nfiles = 0
+        self.ngal = 0
+        self.nfailed = dict((m, 0) for m in models)
+        self.chisq_hist = dict((m, Histogram(*chisq_bins)) for m in models)
+        self.chisq_stats = dict((m, RunningStats()) for m in models)
+        self.ser_index_hist = Histogram(*ser_index_bins)
+        self.ser_index_stats = RunningStats()
+        self.fluxratio_hist = Histogram(*fluxratio_bins)
+        self.fluxratio_stats = RunningStats()
+
+    #Adds one chunk of rows of a RAWFIT table. Failed fits are written to failed_file and left out of the
+    #distributions of that model.
+    def add(self, data, start, end, failed_file):
+        names = data.field('NAME')[start:end]
+        self.ngal += len(names)
+        for m in models:
+            stat = data.field('STAT_' + m)[start:end]
+            failed = np.in1d(stat, failed_stats)
+            nfailed = np.count_nonzero(failed)
+            self.nfailed[m] += nfailed
+            for name in names[failed]:
+                failed_file.write(self.band + " " + str(name) + " " + m.lower() + "\n")
+            ok = ~failed
+            chisq = data.field('CHISQ_' + m)[start:end][ok]
+            self.chisq_hist[m].add(chisq)
+            self.chisq_stats[m].add(chisq)
+            if m == "SER":
+                index = data.field('FIT_SER')[start:end][ok,2]
+                self.ser_index_hist.add(index)
+                self.ser_index_stats.add(index)
+            if m == "EXPDVC":
+                ratio = data.field('FLUXRATIO_EXPDVC')[start:end][ok]
+                self.fluxratio_hist.add(ratio)
+                self.fluxratio_stats.add(ratio)
+
+    def add_file(self, rawfit, failed_file):
+        hdulist = pyfits.open(rawfit, memmap=True)
+        data = hdulist[1].data
+        n = 0 if data is None else len(data)
+        for start in range(0, n, chunk_rows):
+            self.add(data, start, min(start + chunk_rows, n), failed_file)
+        del data
+        hdulist.close()
+        self.nfiles += 1
+
+#Magnitudes and half-light radii of the final sample in both filters, from a filter_statistics file with one
+#galaxy per line: m606 m814 r606 r814, radii in pixels.
+class FilterStatistics:
+    def __init__(self):
+        self.ngal = 0
+        self.mag_hist = (Histogram(*mag_bins), Histogram(*mag_bins))
+        self.radius_hist = (Histogram(*radius_bins), Histogram(*radius_bins))
+        self.mresid_hist = Histogram(*mresid_bins)
+        self.rresid_hist = Histogram(*rresid_bins)
+        self.mresid_stats = RunningStats()
+        self.rresid_stats = RunningStats()
+
+    def add(self, values):
+        if len(values) == 0:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        m1, m2 = values[:,0], values[:,1]
+        r1, r2 = values[:,2]*pixel_scale, values[:,3]*pixel_scale
+        self.ngal += len(values)
+        self.mag_hist[0].add(m1)
+        self.mag_hist[1].add(m2)
+        self.radius_hist[0].add(r1)
+        self.radius_hist[1].add(r2)
+        self.mresid_hist.add(m1-m2)
+        self.rresid_hist.add(r1-r2)
+        self.mresid_stats.add(m1-m2)
+        self.rresid_stats.add(r1-r2)
+
+    def add_file(self, stats_file):
+        f = open(stats_file)
+        values = []
+        for line in f:
+            s = line.split()
+            if len(s) < 4 or s[0].startswith("#"):
+                continue
+            values.append([float(v) for v in s[:4]])
+            if len(values) == chunk_rows:
+                self.add(values)
+                values = []
+        self.add(values)
+        f.close()
+
+#Draws already-binned histograms the way plt.hist would have drawn the raw values
+def plot_hists(hists, labels, title, xlabel, out_file):
+    edges = hists[0].edges
+    centers = 0.5*(edges[1:] + edges[:-1])
+    fig = plt.figure()
+    plt.hist([centers]*len(hists), bins=edges, weights=[h.counts for h in hists], label=labels)
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel("Frequency")
+    if labels is not None:
+        plt.legend()
+    fig.savefig(out_file)
+    plt.close(fig)
+
+def stats_line(name, stats):
+    return "%-24s %10d %10.4f %10.4f %10.4f %10.4f\n" % (name, stats.n, stats.mean, stats.std(), stats.min, stats.max)
+
+def write_report(summaries, filter_stats, out_file):
+    f = open(out_file, "w")
+    f.write("#Fit statistics exclude fits with STAT in " + str(failed_stats) + "\n")
+    for s in summaries:
+        f.write("\n" + s.band + ": " + str(s.ngal) + " galaxies in " + str(s.nfiles) + " files\n")
+        for m in models:
+            f.write("%-24s %10d failed\n" % (m, s.nfailed[m]))
+        f.write("%-24s %10s %10s %10s %10s %10s\n" % ("#quantity", "n", "mean", "std", "min", "max"))
+        for m in models:
+            f.write(stats_line("CHISQ_" + m, s.chisq_stats[m]))
+        f.write(stats_line("SERSIC_INDEX", s.ser_index_stats))
+        f.write(stats_line("FLUXRATIO_EXPDVC", s.fluxratio_stats))
+    if filter_stats is not None:
+        f.write("\nfilter statistics: " + str(filter_stats.ngal) + " galaxies\n")
+        f.write(stats_line("MAG_606-814", filter_stats.mresid_stats))
+        f.write(stats_line("RADIUS_606-814", filter_stats.rresid_stats))
+    f.close()
+
+def make_figures(summaries, filter_stats, out_dir):
+    bands = [s.band for s in summaries]
+    for s in summaries:
+        plot_hists([s.chisq_hist[m] for m in models], [model_labels[m] for m in models],
+                   "Goodness of fit for galaxy profiles in " + s.band + " filter", "Chi-square value",
+                   os.path.join(out_dir, "chisq_" + s.band + ".png"))
+    if len(summaries) > 0:
+        plot_hists([s.fluxratio_hist for s in summaries], bands, "Bulge-to-disk ratios from best bulge-disk fit",
+                   "Bulge-to-disk ratio", os.path.join(out_dir, "fluxratio_expdvc.png"))
+        plot_hists([s.ser_index_hist for s in summaries], bands, "Best-fit Sersic index for fitting galaxy profiles",
+                   "Sersic index", os.path.join(out_dir, "sersic_index.png"))
+    if filter_stats is not None:
+        plot_hists(filter_stats.mag_hist, ["f606w", "f814w"], "Magnitudes of galaxies in final sample",
+                   "Magnitude", os.path.join(out_dir, "magnitudes.png"))
+        plot_hists([filter_stats.mresid_hist], None,
+                   "Difference in magnitude for individual galaxies across f606w and f814w filters",
+                   "Residuals, f606w magnitude - f814w magnitude", os.path.join(out_dir, "magnitude_residuals.png"))
+        plot_hists(filter_stats.radius_hist, ["f606w", "f814w"], "Half-light radius of galaxies in final sample",
+                   "Half-light radius, arcseconds", os.path.join(out_dir, "radii.png"))
+        plot_hists([filter_stats.rresid_hist], None,
+                   "Difference in half light radius for individual galaxies across f606w and f814w filters",
+                   "Residuals, f606w radius - f814w radius, arcseconds", os.path.join(out_dir, "radius_residuals.png"))
+
+#rawfit_globs maps a band name to a glob pattern (or list of patterns) of RAWFIT files, e.g.
+#{"f606w": "/data/assoc_606_*/output/RAWFIT*.fits"}. Writes fit_report.txt, failed_fits.txt and the figures
+#to out_dir and returns the band summaries.
+def analyze(rawfit_globs, out_dir, stats_file=None):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    failed_file = open(os.path.join(out_dir, "failed_fits.txt"), "w")
+    summaries = []
+    for band in sorted(rawfit_globs):
+        patterns = rawfit_globs[band]
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        files = sorted(set(sum([glob.glob(p) for p in patterns], [])))
+        print "Reading", len(files), "RAWFIT files for", band
+        summary = BandSummary(band)
+        for rawfit in files:
+            summary.add_file(rawfit, failed_file)
+        summaries.append(summary)
+    failed_file.close()
+    filter_stats = None
+    if stats_file is not None:
+        filter_stats = FilterStatistics()
+        filter_stats.add_file(stats_file)
+    write_report(summaries, filter_stats, os.path.join(out_dir, "fit_report.txt"))
+    make_figures(summaries, filter_stats, out_dir)
+    return summaries
+
+#python analyze_fitting.py out_dir f606w=<RAWFIT glob> f814w=<RAWFIT glob> [stats=filter_statistics.txt]
+if __name__ == "__main__":
+    rawfit_globs = {}
+    stats_file = None
+    for arg in sys.argv[2:]:
+        key, value = arg.split("=", 1)
+        if key == "stats":
+            stats_file = value
+        else:
+            rawfit_globs.setdefault(key, []).append(value)
+    analyze(rawfit_globs, sys.argv[1], stats_file=stats_file)
@@ -2,41 +2,181 @@ import asciidata
 import time
 import numpy as np
 import matplotlib.pyplot as plt
+from cleanutils import box_pairs
+import instrument
+from selection import assoc_selection
+from sextractor_io import read_catalog, write_catalog
+
+#Index of the first (lowest index) object in catalog 2 within tolerance of each object in catalog 1, or -1
+def first_matches(alpha1, delta1, alpha2, delta2, tolerance = 1/18000.):
+    i, j = box_pairs(alpha1, delta1, alpha2, delta2, tolerance)
+    match = -np.ones(len(alpha1), dtype=np.int64)
+    #Pairs are sorted by i then j, so the first pair of each i holds its lowest j
+    first = np.ones(len(i), dtype=bool)
+    first[1:] = i[1:] != i[:-1]
+    match[i[first]] = j[first]
+    return match
+
+#Bright, resolved, non-star objects that are allowed into the association (selection.assoc_selection)
+def assoc_cuts(snr, mag, radius, is_star):
+    return assoc_selection.passes({"SNR" : snr, "MAG_AUTO" : mag, "FLUX_RADIUS" : radius, "IS_STAR" : is_star})
+
+def good_for_assoc(cat):
+    snr = np.array([cat['SNR'][i] for i in range(cat.nrows)], dtype=np.float64)
+    mag = np.array([cat['MAG_AUTO'][i] for i in range(cat.nrows)], dtype=np.float64)
+    radius = np.array([cat['FLUX_RADIUS'][i] for i in range(cat.nrows)], dtype=np.float64)
+    is_star = np.array([cat['IS_STAR'][i] for i in range(cat.nrows)])
+    return assoc_cuts(snr, mag, radius, is_star)
+
+#Rows of catalog 1 that get associated with their first match. Each object in catalog 1 takes its first
+#match in catalog 2 if both pass good_for_assoc, unless an earlier object in catalog 1 already took it.
+def assign_assoc(match, good1, good2):
+    candidates = np.where(match != -1)[0]
+    candidates = candidates[good1[candidates] & good2[match[candidates]]]
+    taken, first = np.unique(match[candidates], return_index=True)
+    return np.sort(candidates[first])
 
 def assoc_catalogs_opt(c1, c2, tolerance = 1/18000.):
-    mag_tuples = []
-    flux_tuples = []
-    cat1 = asciidata.open(c1)
-    cat2 = asciidata.open(c2)
-    for i in range(cat2.nrows):
-        cat2['ASSOC'][i] = -1
-    for i in range(cat1.nrows):
-        cat1['ASSOC'][i] = -1
-    alpha1 = [cat1['ALPHA_SKY'][i] for i in range(cat1.nrows)]
-    alpha2 = [cat2['ALPHA_SKY'][i] for i in range(cat2.nrows)]
-    delta1 =   [cat1['DELTA_SKY'][i] for i in range(cat1.nrows)]
-    delta2 =   [cat2['DELTA_SKY'][i] for i in range(cat2.nrows)]
-    for i in range(cat1.nrows):
-        match = [abs(alpha1[i]-alpha2[j]) < tolerance and abs(delta1[i]-delta2[j]) < tolerance for j in range(cat2.nrows)]
-        try:
-           idx = match.index(True)
-           if cat2['ASSOC'][idx] == -1 \
-           and cat1['SNR'][i] > 20 \
-           and cat2['SNR'][idx] > 20 \
-           and cat1['MAG_AUTO'][i] + 21.1 < 22.5 \
-           and cat2['MAG_AUTO'][idx] + 21.1 < 22.5 \
-           and cat1['FLUX_RADIUS'][i] > 0 \
-           and cat2['FLUX_RADIUS'][idx] > 0 \
-           and cat1['IS_STAR'][i] == 0 \
-           and cat2['IS_STAR'][idx] == 0 \
-           and cat1['FLUX_RADIUS'][i] < 500 \
-           and cat2['FLUX_RADIUS'][idx] < 500:
-               cat1['ASSOC'][i] = i
-               cat2['ASSOC'][idx] = i
-               mag_tuples.append((cat1['MAG_AUTO'][i], cat2['MAG_AUTO'][idx]))
-               flux_tuples.append((cat1['FLUX_RADIUS'][i],cat2['FLUX_RADIUS'][idx]))               
-        except ValueError:
-           continue
-    #cat1.writeto(c1)
-    #cat2.writeto(c2)
+    with instrument.Stage("assoc", tile=c1) as s:
+        mag_tuples = []
+        flux_tuples = []
+        cat1 = asciidata.open(c1)
+        cat2 = asciidata.open(c2)
+        s.rows_in = [cat1.nrows, cat2.nrows]
+        if cat1.nrows > 0:
+            #Log under the image name like the other stages (label_catalogs stores it in FILENAME)
+            s.fields["tile"] = cat1['FILENAME'][0]
+        for i in range(cat2.nrows):
+            cat2['ASSOC'][i] = -1
+        for i in range(cat1.nrows):
+            cat1['ASSOC'][i] = -1
+        alpha1 = [cat1['ALPHA_SKY'][i] for i in range(cat1.nrows)]
+        alpha2 = [cat2['ALPHA_SKY'][i] for i in range(cat2.nrows)]
+        delta1 =   [cat1['DELTA_SKY'][i] for i in range(cat1.nrows)]
+        delta2 =   [cat2['DELTA_SKY'][i] for i in range(cat2.nrows)]
+        match = first_matches(alpha1, delta1, alpha2, delta2, tolerance)
+        good1 = good_for_assoc(cat1)
+        good2 = good_for_assoc(cat2)
+        for i in assign_assoc(match, good1, good2):
+            i, idx = int(i), int(match[i])
+            cat1['ASSOC'][i] = i
+            cat2['ASSOC'][idx] = i
+            mag_tuples.append((cat1['MAG_AUTO'][i], cat2['MAG_AUTO'][idx]))
+            flux_tuples.append((cat1['FLUX_RADIUS'][i],cat2['FLUX_RADIUS'][idx]))
+        #cat1.writeto(c1)
+        #cat2.writeto(c2)
+        #Superseded by assoc_catalogs_multi, which handles any number of bands and writes ASSOC
+        s.rows_out = len(mag_tuples)
+
+#The matching of assoc_catalogs_multi on arrays: alphas, deltas and goods (the assoc cuts, None to keep every
+#object) hold one array per band. Returns the ASSOC ids of each band (-1 for objects not associated) and the
+#number of ids given.
+def group_assoc(alphas, deltas, goods, first_id=0, tolerance = 1/18000., min_bands=None):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    n_bands = len(alphas)
+    if min_bands is None:
+        min_bands = n_bands
+    rows = []
+    bands = []
+    for b in range(n_bands):
+        good = np.arange(len(alphas[b])) if goods[b] is None else np.where(goods[b])[0]
+        rows.append(good)
+        bands.append(np.repeat(b, len(good)))
+    row = np.concatenate(rows)
+    band = np.concatenate(bands)
+    alpha = np.concatenate([np.asarray(alphas[b])[rows[b]] for b in range(n_bands)]).astype(np.float64)
+    delta = np.concatenate([np.asarray(deltas[b])[rows[b]] for b in range(n_bands)]).astype(np.float64)
+    n = len(row)
+    i, j = box_pairs(alpha, delta, alpha, delta, tolerance)
+    link = (i < j) & (band[i] != band[j])
+    graph = coo_matrix((np.ones(np.count_nonzero(link)), (i[link], j[link])), shape=(n, n))
+    n_groups, group = connected_components(graph, directed=False)
+    #Nearest object to the group centre in each band
+    size = np.bincount(group, minlength=n_groups).astype(np.float64)
+    centre_alpha = np.bincount(group, alpha, n_groups)/np.maximum(size, 1)
+    centre_delta = np.bincount(group, delta, n_groups)/np.maximum(size, 1)
+    distance = np.hypot(alpha - centre_alpha[group], delta - centre_delta[group])
+    order = np.lexsort((np.arange(n), distance, band, group))
+    key = group[order]*n_bands + band[order]
+    first = np.ones(n, dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+    chosen = order[first]
+    n_bands_found = np.bincount(group[chosen], minlength=n_groups)
+    associated = np.where(n_bands_found >= min_bands)[0]
+    ids = -np.ones(n_groups, dtype=np.int64)
+    ids[associated] = first_id + np.arange(len(associated))
+    assocs = []
+    for b in range(n_bands):
+        assoc = -np.ones(len(alphas[b]), dtype=np.int64)
+        in_band = chosen[band[chosen] == b]
+        assoc[row[in_band]] = ids[group[in_band]]
+        assocs.append(assoc)
+    return assocs, len(associated)
+
+#Multi-way association of the catalogs of one tile in any number of bands. The objects that pass the assoc cuts
+#in every band go into one sky grid (box_pairs), every pair closer than tolerance in different bands links two
+#objects, and the groups are the connected components of those links. In each group the object of each band
+#nearest to the group centre is associated; groups with objects in at least min_bands bands (all of them by
+#default) get an ASSOC id, first_id, first_id+1, ... in the order of their first object. The ASSOC column is
+#written to every catalog (-1 for objects not associated). Returns the next free id, so consecutive tiles get
+#survey-unique ids.
+def assoc_catalogs_multi(catalogs, first_id=0, tolerance = 1/18000., min_bands=None):
+    n_bands = len(catalogs)
+    with instrument.Stage("assoc", tile=catalogs[0]) as s:
+        cats = [read_catalog(catalog) for catalog in catalogs]
+        s.rows_in = [cat.nrows for cat in cats]
+        if cats[0].nrows > 0 and "FILENAME" in cats[0]:
+            #Log under the image name like the other stages
+            s.fields["tile"] = cats[0]['FILENAME'][0]
+        goods = [assoc_selection.passes(cat, cat.names) if cat.nrows > 0 else None for cat in cats]
+        assocs, n_associated = group_assoc([cat['ALPHA_SKY'] if cat.nrows > 0 else np.zeros(0) for cat in cats],
+                                           [cat['DELTA_SKY'] if cat.nrows > 0 else np.zeros(0) for cat in cats],
+                                           goods, first_id, tolerance, min_bands)
+        for b in range(n_bands):
+            cats[b]['ASSOC'] = assocs[b]
+            write_catalog(cats[b], catalogs[b])
+        s.rows_out = n_associated
+    print n_associated, "objects associated in", n_bands, "bands."
+    return first_id + n_associated
+
+#assoc_catalogs_multi on every tile. catalog_lists holds one list of catalogs per band, in the same tile order.
+#With by_number (catalogs made in dual-image mode) the tiles are associated by NUMBER instead (assoc_by_number).
+def assoc_all(catalog_lists, tolerance = 1/18000., min_bands=None, by_number=False):
+    next_id = 0
+    for i in range(len(catalog_lists[0])):
+        catalogs = [catalog_list[i] for catalog_list in catalog_lists]
+        if by_number:
+            next_id = assoc_by_number(catalogs, next_id)
+        else:
+            next_id = assoc_catalogs_multi(catalogs, next_id, tolerance, min_bands)
+    return next_id
 
+#Association of catalogs made in dual-image mode (dual_image.py), where the same NUMBER is the same object in
+#every band: the objects whose NUMBER survived the cleaning of every band and pass the assoc cuts
+#(selection.assoc_selection) in every band get the ASSOC id first_id + their rank, the rest -1. Returns the
+#next free id, as assoc_catalogs_multi.
+def assoc_by_number(catalogs, first_id=0):
+    with instrument.Stage("assoc", tile=catalogs[0]) as s:
+        cats = [read_catalog(catalog) for catalog in catalogs]
+        s.rows_in = [cat.nrows for cat in cats]
+        if cats[0].nrows > 0 and "FILENAME" in cats[0]:
+            s.fields["tile"] = cats[0]['FILENAME'][0]
+        numbers = [cat['NUMBER'] if cat.nrows > 0 else np.zeros(0, dtype=np.int64) for cat in cats]
+        good = []
+        for b in range(len(cats)):
+            passes = assoc_selection.passes(cats[b], cats[b].names) if cats[b].nrows > 0 else None
+            good.append(numbers[b] if passes is None else numbers[b][passes])
+        common = good[0]
+        for number in good[1:]:
+            common = np.intersect1d(common, number)
+        common = np.unique(common)
+        for b in range(len(cats)):
+            assoc = -np.ones(cats[b].nrows, dtype=np.int64)
+            found = np.in1d(numbers[b], common)
+            assoc[found] = first_id + np.searchsorted(common, numbers[b][found])
+            cats[b]['ASSOC'] = assoc
+            write_catalog(cats[b], catalogs[b])
+        s.rows_out = len(common)
+    print len(common), "objects associated by NUMBER in", len(catalogs), "bands."
+    return first_id + len(common)
@@ -0,0 +1,118 @@
+'''
+Script Name: async_writer.py
+
+########### Description ##########
+
+Output files written by a pool of threads while the caller goes on computing, in place of writing every stamp
+synchronously between two objects.
+
+writer = AsyncWriter(n_threads=4, maxsize=64, index_name="stamps/index.txt")
+writer.write_fits(hdulist, "stamps/images/12_150.1_2.2.processed.fits", index_line="12 150.1 2.2")
+...
+writer.close()
+
+write_fits (and submit, for any function that writes a file) puts the job on a queue of at most maxsize jobs and
+returns; when the queue is full it blocks until a writer thread takes a job, so a slow disk slows the producer down
+instead of filling the memory with pending stamps.
+
+Every file is written under a temporary name in the same directory and renamed when it is complete, so a crash
+leaves complete files or no file at all (and at most stray .tmp files), never a truncated one.
+
+Jobs can carry a line for the index file. Lines are appended in the order the jobs were submitted, each only
+after its file (and every file submitted before it) is complete, so the index is always an ordered prefix of
+what was asked for and only lists files that exist.
+
+flush() waits for every job submitted so far (the writer stays open); close() waits for every job and stops the
+threads. Both raise the first error a writer met. An error also stops submit from accepting
+more jobs.
+'''
+
+import os
+import sys
+import threading
+import Queue
+
+_stop = object()
+
+class AsyncWriter:
+    def __init__(self, n_threads=4, maxsize=64, index_name=None):
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.next_index = 0
+        self.finished = {}
+        self.failure = None
+        self.index = None
+        if index_name is not None:
+            self.index = open(index_name, "a")
+        self.threads = []
+        for k in range(n_threads):
+            thread = threading.Thread(target=self.work, name="writer%d" % k)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    #Queues write(temporary_name, *args), then the rename of temporary_name to name and the index line
+    def submit(self, name, write, args=(), index_line=None):
+        if self.failure is not None:
+            self.raise_failure()
+        with self.lock:
+            sequence = self.submitted
+            self.submitted += 1
+        self.queue.put((sequence, name, write, args, index_line))
+
+    def write_fits(self, hdulist, name, index_line=None):
+        self.submit(name, write_hdulist, (hdulist,), index_line)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is _stop:
+                self.queue.task_done()
+                return
+            sequence, name, write, args, index_line = job
+            try:
+                if self.failure is None:
+                    temporary = os.path.join(os.path.dirname(name), "." + os.path.basename(name) + ".tmp")
+                    write(temporary, *args)
+                    os.rename(temporary, name)
+            except Exception:
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = sys.exc_info()
+                index_line = None
+            self.finish(sequence, index_line)
+            self.queue.task_done()
+
+    #Appends the index lines of every job finished in submission order up to now
+    def finish(self, sequence, index_line):
+        with self.lock:
+            self.finished[sequence] = index_line
+            while self.next_index in self.finished:
+                line = self.finished.pop(self.next_index)
+                if line is not None and self.index is not None and self.failure is None:
+                    self.index.write(line.rstrip("\n") + "\n")
+                    self.index.flush()
+                self.next_index += 1
+
+    def raise_failure(self):
+        raise self.failure[0], self.failure[1], self.failure[2]
+
+    #Waits until every job submitted so far is written and in the index
+    def flush(self):
+        self.queue.join()
+        if self.failure is not None:
+            self.raise_failure()
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(_stop)
+        for thread in self.threads:
+            thread.join()
+        if self.index is not None:
+            self.index.close()
+        if self.failure is not None:
+            self.raise_failure()
+
+def write_hdulist(name, hdulist):
+    hdulist.writeto(name, clobber=True)
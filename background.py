@@ -0,0 +1,216 @@
+'''
+Script Name: background.py
+
+########### Description ##########
+
+Sky background and background RMS of a tile, computed once and cached, in place of SExtractor estimating them
+from scratch in the bright and again in the faint pass of GalaxyCatalog.generate_catalog.
+
+The maps are kept as meshes (one value per BACK_SIZE x BACK_SIZE box, sigma-clipped and median filtered over
+BACK_FILTERSIZE boxes as SExtractor does, see detection.background_mesh), together with the mean weight of each
+mesh. A mesh is a few kB, so one .npz per tile and setting is cached in cache_dir, named after the SHA-1 of the
+image and weight file contents and the settings: a tile that was already done, or the same tile under another
+name, is not measured again. Digests are remembered per file (size and modification time) in
+cache_dir/digests.json so the files are only hashed once; the file is replaced by a rename, so workers sharing
+the cache never read it half written.
+
+prepare_sextractor_images gives, for each setting the tile needs (the bright and the faint pass), the
+background-subtracted image and the per-pixel RMS map,
+
+rms = mesh rms * sqrt(mesh mean weight/weight)
+
+(the scaling SExtractor applies to a MAP_WEIGHT), so SExtractor runs with BACK_TYPE MANUAL, BACK_VALUE 0 and
+WEIGHT_TYPE MAP_RMS and measures no background itself. Pixels with zero weight get an RMS of 1e30. The two
+images are cached in cache_dir under the same content key as the meshes, so a tile that is done again (another
+run, or the other pass) reads nothing and writes nothing here; settings that are missing are made from one read
+of the image and weight map.
+
+This mode trades I/O for one shared background estimate: the first time a tile is seen it is hashed (both files
+read once), read once more, and two full-size float32 images per setting are written, which SExtractor then reads
+in place of the tile and weight map; the cache holds those images (4 per tile with the default settings) until
+cache_dir is deleted. Later runs on the same tile only stat the files.
+
+stamp_rms gives the background RMS over any stamp from the cached meshes, without reading the tile.
+
+########## Usage ##########
+
+python background.py image.fits weight.fits [back_size=100] [filter_size=3] [cache_dir=background_cache]
+'''
+
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import pyfits
+import instrument
+from compressed_fits import image_hdu, read_image, read_header
+from detection import background_mesh, expand_mesh
+
+bad_rms = 1e30
+
+#SHA-1 of a file's contents, remembered by path, size and modification time in cache_dir/digests.json
+def file_digest(name, cache_dir):
+    index_name = os.path.join(cache_dir, "digests.json")
+    path = os.path.abspath(name)
+    stat = os.stat(name)
+    stamp = [stat.st_size, stat.st_mtime]
+    index = read_digests(index_name)
+    if path in index and index[path][0] == stamp:
+        return index[path][1]
+    digest = hashlib.sha1()
+    f = open(name, "rb")
+    while True:
+        block = f.read(1 << 24)
+        if not block:
+            break
+        digest.update(block)
+    f.close()
+    #Read again so the digests other workers added meanwhile are kept, and written under a temporary name and
+    #renamed so a reader never sees a partial file
+    index = read_digests(index_name)
+    index[path] = [stamp, digest.hexdigest()]
+    temporary = index_name + "." + str(os.getpid()) + ".tmp"
+    f = open(temporary, "w")
+    json.dump(index, f)
+    f.close()
+    os.rename(temporary, index_name)
+    return index[path][1]
+
+def read_digests(index_name):
+    if not os.path.exists(index_name):
+        return {}
+    f = open(index_name)
+    index = json.load(f)
+    f.close()
+    return index
+
+def cache_name(file, weight_file, back_size, filter_size, nsigma, cache_dir):
+    key = hashlib.sha1(file_digest(file, cache_dir) + file_digest(weight_file, cache_dir) + repr((back_size, filter_size, nsigma))).hexdigest()
+    return os.path.join(cache_dir, key + ".npz")
+
+#Mean of the positive weights of each back_size x back_size mesh (the mean of the whole map where a mesh has none)
+def weight_mesh(weight, back_size):
+    (ny, nx) = weight.shape
+    nmy = int(np.ceil(float(ny)/back_size))
+    nmx = int(np.ceil(float(nx)/back_size))
+    padded = np.zeros((nmy*back_size, nmx*back_size), dtype=np.float64)
+    padded[:ny,:nx] = np.maximum(weight, 0)
+    blocks = padded.reshape(nmy, back_size, nmx, back_size)
+    sums = blocks.sum(axis=(1,3))
+    counts = (blocks > 0).sum(axis=(1,3))
+    del padded, blocks
+    mean = np.zeros((nmy, nmx))
+    mean[counts > 0] = sums[counts > 0]/counts[counts > 0]
+    if (counts > 0).any():
+        mean[counts == 0] = sums.sum()/counts.sum()
+    return mean
+
+#{(back_size, filter_size) : (background mesh, rms mesh, weight mesh)} for the settings, from the cache or measured
+#and cached. The image and weight are only read if some setting is not cached, and then once for all of them;
+#images = (data, weight) passes arrays the caller has read already.
+def load_meshes(file, weight_file, settings, cache_dir="background_cache", nsigma=3.0, images=None):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    meshes = {}
+    missing = []
+    for (back_size, filter_size) in settings:
+        name = cache_name(file, weight_file, back_size, filter_size, nsigma, cache_dir)
+        if os.path.exists(name):
+            cached = np.load(name)
+            meshes[(back_size, filter_size)] = (cached['background'], cached['rms'], cached['weight'])
+        else:
+            missing.append((back_size, filter_size))
+    if len(missing) > 0:
+        if images is None:
+            data, header, weight = read_tile(file, weight_file)
+        else:
+            (data, weight) = images
+        for (back_size, filter_size) in missing:
+            background, rms = background_mesh(data, weight, back_size, filter_size, nsigma)
+            mean_weight = weight_mesh(weight, int(min(back_size, data.shape[0], data.shape[1])))
+            name = cache_name(file, weight_file, back_size, filter_size, nsigma, cache_dir)
+            temporary = open(name + "." + str(os.getpid()) + ".tmp", "wb")
+            np.savez(temporary, background=background, rms=rms, weight=mean_weight)
+            temporary.close()
+            os.rename(temporary.name, name)
+            meshes[(back_size, filter_size)] = (background, rms, mean_weight)
+    return meshes
+
+#float32 image, its header and the float32 weight map of a tile
+def read_tile(file, weight_file):
+    f = pyfits.open(file)
+    hdu = image_hdu(f)
+    data = hdu.data.astype(np.float32)
+    header = hdu.header.copy()
+    f.close()
+    weight = read_image(weight_file).astype(np.float32)
+    return data, header, weight
+
+#The background-subtracted image and RMS map SExtractor reads for one setting, cached next to its meshes
+def image_names(file, weight_file, back_size, filter_size, nsigma, cache_dir):
+    root = os.path.splitext(cache_name(file, weight_file, back_size, filter_size, nsigma, cache_dir))[0]
+    return root + "_back.fits", root + "_rms.fits"
+
+#Writes hdu to name through a temporary file and a rename, so a worker sharing the cache never reads it half written
+def write_cached(hdu, name):
+    temporary = name + "." + str(os.getpid()) + ".tmp"
+    hdu.writeto(temporary, clobber=True)
+    os.rename(temporary, name)
+
+#The background-subtracted image and the RMS map for each (back_size, filter_size) in settings, in cache_dir under
+#the content key of the tile and setting. Settings already cached are used as they are; the others are made from
+#one read of the tile. Returns {(back_size, filter_size) : (subtracted image, rms map)}.
+def prepare_sextractor_images(file, weight_file, settings, cache_dir="background_cache", nsigma=3.0):
+    with instrument.Stage("background", tile=file):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        names = {}
+        missing = []
+        for (back_size, filter_size) in settings:
+            names[(back_size, filter_size)] = image_names(file, weight_file, back_size, filter_size, nsigma, cache_dir)
+            if not all(os.path.exists(name) for name in names[(back_size, filter_size)]):
+                missing.append((back_size, filter_size))
+        if len(missing) == 0:
+            return names
+        data, header, weight = read_tile(file, weight_file)
+        meshes = load_meshes(file, weight_file, missing, cache_dir, nsigma, images=(data, weight))
+        good = weight > 0
+        for (back_size, filter_size) in missing:
+            background, rms, mean_weight = meshes[(back_size, filter_size)]
+            size = int(min(back_size, data.shape[0], data.shape[1]))
+            sub_name, rms_name = names[(back_size, filter_size)]
+            write_cached(pyfits.PrimaryHDU(data - expand_mesh(background, data.shape, size), header=header), sub_name)
+            rms_map = expand_mesh(rms, data.shape, size)
+            rms_map[good] *= np.sqrt(expand_mesh(mean_weight, data.shape, size)[good]/weight[good])
+            rms_map[~good] = bad_rms
+            write_cached(pyfits.PrimaryHDU(rms_map, header=header), rms_name)
+    return names
+
+#Bilinear interpolation of a mesh at 0-indexed pixel coordinates xs, ys (1d), as expand_mesh does over a whole image
+def expand_region(mesh, back_size, xs, ys):
+    (nmy, nmx) = mesh.shape
+    yy = np.clip((np.asarray(ys) + 0.5)/back_size - 0.5, 0, nmy-1)
+    xx = (np.asarray(xs) + 0.5)/back_size - 0.5
+    rows = np.array([np.interp(xx, np.arange(nmx), mesh[j]) for j in range(nmy)])
+    y0 = np.minimum(np.floor(yy).astype(int), max(nmy-2, 0))
+    y1 = np.minimum(y0 + 1, nmy-1)
+    fy = (yy - y0)[:,None]
+    return (1 - fy)*rows[y0] + fy*rows[y1]
+
+#Background RMS over a stamp, bounds = (xmin, xmax, ymin, ymax) inclusive and 1-indexed (as postage_stamps.stamp_bounds)
+def stamp_rms(file, weight_file, bounds, back_size=100, filter_size=3, cache_dir="background_cache"):
+    background, rms, mean_weight = load_meshes(file, weight_file, [(back_size, filter_size)], cache_dir)[(back_size, filter_size)]
+    left, right, bottom, top = bounds
+    shape = read_header(file)
+    size = int(min(back_size, shape['NAXIS1'], shape['NAXIS2']))
+    return expand_region(rms, size, np.arange(left - 1, right), np.arange(bottom - 1, top))
+
+if __name__ == "__main__":
+    options = {"back_size" : "100", "filter_size" : "3", "cache_dir" : "background_cache"}
+    for arg in sys.argv[3:]:
+        key, value = arg.split("=", 1)
+        options[key] = value
+    setting = (int(options["back_size"]), int(options["filter_size"]))
+    background, rms, mean_weight = load_meshes(sys.argv[1], sys.argv[2], [setting], options["cache_dir"])[setting]
+    print "background", np.median(background), "rms", np.median(rms), "in", background.shape[1], "x", background.shape[0], "meshes"
@@ -0,0 +1,287 @@
+'''
+Script Name: benchmark.py
+
+########### Description ##########
+
+End-to-end benchmark of the pipeline on a synthetic survey from synthetic_data.py. The stages are the ones
+run.py goes through:
+
+generate -- make the synthetic tiles, TT fields and star lists
+catalog  -- HST_Sextractor_new.GalaxyCatalog.generate_catalog on every tile in both filters
+focus    -- GalaxyCatalogList.add_focus (non-interactive: every selected star is accepted)
+assoc    -- assoc_catalogs.assoc_all on the f606w and f814w tiles
+stamps   -- postage_stamps.get_postage_stamps_all in both filters
+
+Each stage runs in a forked child process, so its peak resident memory (including SExtractor and any other
+subprocesses it waits for), its CPU time and its block I/O come straight from os.wait4. A stage whose predecessor failed is
+recorded as skipped. The stage output goes to <work_dir>/<stage>.log.
+
+########## Output ##########
+
+One JSON object per stage is appended to the results file, with the git commit (and whether the tree was dirty),
+the host, the synthetic data parameters, and wall_s, user_s, sys_s, maxrss_mb and status for the stage,
+read_mb and write_mb (bytes the stage's Python process read and wrote, from /proc/self/io where it exists),
+block_read_mb and block_write_mb (what reached the disk, SExtractor included, from os.wait4),
+plus stage-specific counts (objects in the catalogs, stamps written, error of the recovered focus).
+All the stages of one invocation share a run_id.
+
+########## Usage ##########
+
+python benchmark.py run work_dir [results=benchmark_results.jsonl] [size=2048] [tiles=2x1] [seed=0] [stages=generate,catalog,focus,assoc,stamps] [background_cache=dir]
+
+background_cache runs the catalog stage with background.py (GalaxyCatalog(..., background_cache=dir)).
+python benchmark.py compare benchmark_results.jsonl [run_id_a run_id_b]
+
+compare prints the per-stage wall time and peak memory of two runs (by default the last two) and their ratios.
+'''
+
+import os
+import sys
+import time
+import json
+import glob
+import resource
+import socket
+import platform
+import subprocess
+import traceback
+import numpy as np
+
+stages = ["generate", "catalog", "focus", "assoc", "stamps"]
+bands = (606, 814)
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir).strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def read_list(name):
+    f = open(name)
+    lines = [line.strip() for line in f.readlines() if line.strip() != ""]
+    f.close()
+    return lines
+
+#Same catalog names as run.py
+def catalog_name(filter, file):
+    return str(filter) + "_" + file[10:12]
+
+#(rchar, wchar) of this process from /proc/self/io, None where the kernel has no I/O accounting
+def process_io():
+    try:
+        f = open("/proc/self/io")
+        counters = dict(line.split(":") for line in f.read().strip().split("\n"))
+        f.close()
+    except (IOError, ValueError):
+        return None
+    return int(counters["rchar"]), int(counters["wchar"])
+
+def count_rows(catalogs):
+    n = 0
+    for catalog in catalogs:
+        if not os.path.exists(catalog):
+            continue
+        f = open(catalog)
+        for line in f:
+            if line[0] != "#" and line.strip() != "":
+                n += 1
+        f.close()
+    return n
+
+def run_generate(work_dir, options):
+    import synthetic_data
+    synthetic_data.make_survey(work_dir, size=options["size"], n_tiles=options["tiles"], seed=options["seed"])
+    return {"tiles" : len(read_list("f606w_filenames.txt"))}
+
+def run_catalog(work_dir, options):
+    import HST_Sextractor_new
+    catalogs = []
+    for filter in bands:
+        files = read_list("f" + str(filter) + "w_filenames.txt")
+        weights = read_list("f" + str(filter) + "w_backgrounds.txt")
+        out = open("f" + str(filter) + "w_catalogs.txt", "w")
+        for i in range(len(files)):
+            name = catalog_name(filter, files[i])
+            out.write(name + ".focus.cat\n")
+            cat = HST_Sextractor_new.GalaxyCatalog(files[i], weights[i], filter, name, background_cache=options["background_cache"])
+            cat.generate_catalog()
+            catalogs.append(name + ".cat")
+        out.close()
+    return {"objects" : count_rows(catalogs)}
+
+def run_focus(work_dir, options):
+    import HST_Sextractor_new
+    truth = {}
+    for line in read_list("truth_focus.txt"):
+        truth[line.split()[0]] = float(line.split()[1])
+    errors = []
+    for filter in bands:
+        files = read_list("f" + str(filter) + "w_filenames.txt")
+        weights = read_list("f" + str(filter) + "w_backgrounds.txt")
+        catalogs = []
+        for i in range(len(files)):
+            name = catalog_name(filter, files[i])
+            catalogs.append(HST_Sextractor_new.GalaxyCatalog(files[i], weights[i], filter, name, catalog=name + ".cat"))
+        cat_list = HST_Sextractor_new.GalaxyCatalogList(catalogs, filter)
+        focus_file = "f" + str(filter) + "w_focus.txt"
+        cat_list.add_focus(focus_file, work_dir + "/", interactive=False, histogram=False)
+        for line in read_list(focus_file):
+            split = line.split()
+            errors.append(float(split[1]) - truth[split[0]])
+    return {"focus_rms_error" : float(np.sqrt(np.mean(np.square(errors))))}
+
+def run_assoc(work_dir, options):
+    import assoc_catalogs
+    catalog_lists = [read_list("f" + str(filter) + "w_catalogs.txt") for filter in bands]
+    associated = assoc_catalogs.assoc_all(catalog_lists)
+    return {"objects" : count_rows(sum(catalog_lists, [])), "associated" : associated}
+
+def run_stamps(work_dir, options):
+    import postage_stamps
+    for filter in bands:
+        postage_stamps.get_postage_stamps_all("f" + str(filter) + "w_catalogs.txt", "f" + str(filter) + "w_filenames.txt", filter, work_dir + "/", tt_root=work_dir + "/")
+    return {"stamps" : len(glob.glob(os.path.join(work_dir, "stamps_*", "images", "*.fits")))}
+
+stage_functions = {"generate" : run_generate,
+                   "catalog" : run_catalog,
+                   "focus" : run_focus,
+                   "assoc" : run_assoc,
+                   "stamps" : run_stamps}
+
+#Runs one stage in a forked child inside work_dir and returns its record. The child reports its stage-specific
+#counts (or the traceback) through a small JSON file.
+def measure(stage, work_dir, options):
+    result_name = os.path.join(work_dir, "." + stage + ".result")
+    log = open(os.path.join(work_dir, stage + ".log"), "w")
+    sys.stdout.flush()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            os.chdir(work_dir)
+            io_start = process_io()
+            result = {"counts" : stage_functions[stage](work_dir, options)}
+            io_end = process_io()
+            if io_start is not None and io_end is not None:
+                result["io"] = {"read_mb" : round((io_end[0] - io_start[0])/2.**20, 1),
+                                "write_mb" : round((io_end[1] - io_start[1])/2.**20, 1)}
+        except BaseException:
+            result = {"error" : traceback.format_exc()}
+            status = 1
+        f = open(result_name, "w")
+        json.dump(result, f)
+        f.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+    pid, status, usage = os.wait4(pid, 0)
+    wall = time.time() - start
+    log.close()
+    record = {"stage" : stage,
+              "wall_s" : round(wall, 3),
+              "user_s" : round(usage.ru_utime, 3),
+              "sys_s" : round(usage.ru_stime, 3),
+              "maxrss_mb" : round(usage.ru_maxrss/1024., 1),
+              "block_read_mb" : round(usage.ru_inblock*512./2.**20, 1),
+              "block_write_mb" : round(usage.ru_oublock*512./2.**20, 1)}
+    try:
+        f = open(result_name)
+        result = json.load(f)
+        f.close()
+        os.remove(result_name)
+    except (IOError, ValueError):
+        result = {"error" : "stage exited with status " + str(status) + " without a result"}
+    if "error" in result:
+        record["status"] = "failed"
+        record["error"] = result["error"].strip().split("\n")[-1]
+    else:
+        record["status"] = "ok"
+        record.update(result["counts"])
+        record.update(result.get("io", {}))
+    return record
+
+def run(work_dir, results="benchmark_results.jsonl", size=2048, tiles=(2,1), seed=0, stages=stages, background_cache=None):
+    work_dir = os.path.abspath(work_dir)
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    sys.path.insert(0, repo_dir)
+    options = {"size" : size, "tiles" : tiles, "seed" : seed, "background_cache" : background_cache}
+    commit, dirty = git_commit()
+    common = {"run_id" : time.strftime("%Y%m%dT%H%M%S"),
+              "commit" : commit,
+              "dirty" : dirty,
+              "host" : socket.gethostname(),
+              "python" : platform.python_version(),
+              "parent_rss_mb" : round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024., 1)}
+    records = []
+    failed = False
+    for stage in stages:
+        if failed:
+            record = {"stage" : stage, "status" : "skipped"}
+        else:
+            print "Running", stage
+            record = measure(stage, work_dir, options)
+            failed = record["status"] != "ok"
+        if os.path.exists(os.path.join(work_dir, "synthetic.json")):
+            f = open(os.path.join(work_dir, "synthetic.json"))
+            record["dataset"] = json.load(f)
+            f.close()
+        record.update(common)
+        print json.dumps(record, sort_keys=True)
+        records.append(record)
+    out = open(results, "a")
+    for record in records:
+        out.write(json.dumps(record, sort_keys=True) + "\n")
+    out.close()
+    return records
+
+def compare(results, run_a=None, run_b=None):
+    f = open(results)
+    records = [json.loads(line) for line in f if line.strip() != ""]
+    f.close()
+    run_ids = []
+    for record in records:
+        if record["run_id"] not in run_ids:
+            run_ids.append(record["run_id"])
+    if run_a is None:
+        run_a, run_b = run_ids[-2], run_ids[-1]
+    by_stage = ({}, {})
+    for record in records:
+        for k, run_id in enumerate((run_a, run_b)):
+            if record["run_id"] == run_id:
+                by_stage[k][record["stage"]] = record
+    print "%-10s %12s %12s %8s %12s %12s %8s" % ("#stage", "wall_a", "wall_b", "ratio", "rss_a", "rss_b", "ratio")
+    for stage in stages:
+        if stage not in by_stage[0] or stage not in by_stage[1]:
+            continue
+        a, b = by_stage[0][stage], by_stage[1][stage]
+        if a["status"] != "ok" or b["status"] != "ok":
+            print "%-10s %12s %12s" % (stage, a["status"], b["status"])
+            continue
+        print "%-10s %12.3f %12.3f %8.3f %12.1f %12.1f %8.3f" % (stage, a["wall_s"], b["wall_s"], b["wall_s"]/max(a["wall_s"], 1e-9),
+                                                                 a["maxrss_mb"], b["maxrss_mb"], b["maxrss_mb"]/max(a["maxrss_mb"], 1e-9))
+
+if __name__ == "__main__":
+    if sys.argv[1] == "compare":
+        if len(sys.argv) > 4:
+            compare(sys.argv[2], sys.argv[3], sys.argv[4])
+        else:
+            compare(sys.argv[2])
+    else:
+        kwargs = {}
+        for arg in sys.argv[3:]:
+            key, value = arg.split("=", 1)
+            if key == "tiles":
+                value = tuple(int(v) for v in value.split("x"))
+            elif key == "stages":
+                value = value.split(",")
+            elif key not in ("results", "background_cache"):
+                value = int(value)
+            kwargs[key] = value
+        run(sys.argv[2], **kwargs)
@@ -0,0 +1,294 @@
+'''
+Script Name: benchmark_kernels.py
+
+########### Description ##########
+
+Scaling micro-benchmarks for the catalog kernels that used to be quadratic loops:
+
+overlap     -- objects to delete for in-image overlap (cleanutils.delete_overlap)
+adjacent    -- objects of a neighbouring tile matching the base tile (overlap.check_adjacent)
+assoc       -- first-match f606w/f814w association (assoc_catalogs.assoc_catalogs_opt)
+diffraction -- galaxies touching a star diffraction-spike mask (cleanutils.diffraction_keep)
+manual      -- galaxies touching a manual mask polygon (cleanutils.manual_mask)
+
+Each kernel runs on synthetic catalogs from 10^3 to 10^6 rows. The current implementation is timed at every
+size, and the legacy loop (kept below as a reference copy of the original code, working on arrays instead of
+asciidata tables) at the sizes where it finishes in reasonable time. For the kernels that give one answer per
+row independently, the legacy loop runs on as many leading rows as fit in the time budget and its full time is
+extrapolated (marked * in the table). Where both run, their results must be identical. The polygon kernels
+are also run at several bright-star densities. Larger sizes are skipped once the current implementation
+takes more than new_seconds at one size.
+
+For each kernel the empirical scaling exponent is the slope of log(time) against log(rows), fit over the sizes
+that take more than a few milliseconds (or the three largest sizes, if fewer are that slow). A kernel whose exponent goes over max_exponent (1.3 by default, i.e.
+clearly worse than n log n), or whose results differ from the legacy loop, makes the script exit with status 1,
+so it can be run after every change.
+
+########## Usage ##########
+
+python benchmark_kernels.py [results=kernel_results.jsonl] [max_rows=1000000] [legacy_seconds=20] [new_seconds=30] [max_exponent=1.3]
+'''
+
+import os
+import sys
+import time
+import json
+import numpy as np
+from cleanutils import inpoly, rotate, overlapping, boxes_in_polygons
+from overlap import match_any
+from assoc_catalogs import first_matches, assign_assoc
+from benchmark import git_commit
+
+tolerance = 1./18000
+#Objects per square degree: about 10^4 detections on a 225" AEGIS tile
+object_density = 7e5
+duplicate_fraction = 0.02
+tile_size = 7500
+sizes = [1000, 3000, 10000, 30000, 100000, 300000, 1000000]
+star_densities = [10, 100, 1000]
+spike_params = (0.0350087,64.0863,40.0,2.614)
+
+########## Legacy loops, as in the original code ##########
+
+def legacy_overlap(ra, dec, tolerance):
+    n = len(ra)
+    delete_numbers = []
+    for i in range(n-1):
+        for j in range(i+1, n):
+            if abs(ra[j]-ra[i]) < tolerance and abs(dec[j]-dec[i]) < tolerance:
+                delete_numbers.append(j)
+                delete_numbers.append(i)
+    close = np.zeros(n, dtype=bool)
+    close[delete_numbers] = True
+    return close
+
+def legacy_match_any(check_alpha, check_delta, base_alpha, base_delta, tolerance):
+    matched = np.zeros(len(check_alpha), dtype=bool)
+    for j in range(len(check_alpha)):
+        item_bools = [(abs(check_alpha[j] - base_alpha[k]) < tolerance and abs(check_delta[j] - base_delta[k]) < tolerance) for k in range(len(base_alpha))]
+        if True in item_bools:
+            matched[j] = True
+    return matched
+
+def legacy_assoc(alpha1, delta1, alpha2, delta2, good1, good2, tolerance):
+    assoc1 = -np.ones(len(alpha1), dtype=np.int64)
+    assoc2 = -np.ones(len(alpha2), dtype=np.int64)
+    for i in range(len(alpha1)):
+        match = [abs(alpha1[i]-alpha2[j]) < tolerance and abs(delta1[i]-delta2[j]) < tolerance for j in range(len(alpha2))]
+        try:
+            idx = match.index(True)
+            if assoc2[idx] == -1 and good1[i] and good2[idx]:
+                assoc1[i] = i
+                assoc2[idx] = i
+        except ValueError:
+            continue
+    return assoc1, assoc2
+
+def legacy_boxes_in_polygons(x_min, x_max, y_min, y_max, x_vertex_sets, y_vertex_sets):
+    hit = np.zeros(len(x_min), dtype=bool)
+    for i in range(len(x_min)):
+        bottom_pixels = [(x,y_min[i]) for x in range(x_min[i],x_max[i])]
+        left_pixels = [(x_min[i],y) for y in range(y_min[i],y_max[i])]
+        top_pixels = [(x, y_max[i]) for x in range(x_min[i],x_max[i])]
+        right_pixels = [(x_max[i],y) for y in range(y_min[i],y_max[i])]
+        pixels = bottom_pixels + left_pixels + top_pixels + right_pixels
+        bools = [inpoly(pixel[0],pixel[1],x_vertex_sets[j],y_vertex_sets[j]) for pixel in pixels for j in range(len(x_vertex_sets))]
+        #The original max(bools) fails for an empty list; such objects are never masked
+        if len(bools) > 0 and max(bools) == 1:
+            hit[i] = True
+    return hit
+
+########## Synthetic catalogs ##########
+
+#n positions at constant density, with a few near-duplicates (as from overlapping detections)
+def sky_positions(rng, n):
+    side = np.sqrt(n/object_density)
+    ra = 214.8 + rng.uniform(0, side, n)
+    dec = 52.8 + rng.uniform(0, side, n)
+    ndup = int(duplicate_fraction*n)
+    src = rng.randint(0, n, ndup)
+    dst = rng.randint(0, n, ndup)
+    ra[dst] = ra[src] + rng.uniform(-0.5, 0.5, ndup)*tolerance
+    dec[dst] = dec[src] + rng.uniform(-0.5, 0.5, ndup)*tolerance
+    return ra, dec
+
+def boxes(rng, n):
+    x = rng.uniform(1, tile_size, n)
+    y = rng.uniform(1, tile_size, n)
+    w = np.clip(rng.lognormal(np.log(15.), 0.6, n), 2, 200)
+    h = np.clip(w*rng.uniform(0.4, 1., n), 2, 200)
+    return (x - w/2).astype(np.int64), (x + w/2).astype(np.int64), (y - h/2).astype(np.int64), (y + h/2).astype(np.int64)
+
+#Spike masks built exactly as cleanutils.diffraction_keep builds them, for n_stars bright stars
+def spike_masks(rng, n_stars):
+    m, b, w, theta = spike_params[0], spike_params[1], spike_params[2]*0.5, spike_params[3]
+    x_vertex_sets = []
+    y_vertex_sets = []
+    for k in range(n_stars):
+        x0, y0 = rng.uniform(1, tile_size, 2)
+        r = rng.uniform(3, 15)
+        l = m*10**rng.uniform(2.4, 4.5)+b
+        x_vertices = [x0-w,x0-w,x0+w,x0+w,x0+r,x0+l,x0+l,x0+r,x0+w,x0+w,x0-w,x0-w,x0-r,x0-l,x0-l,x0-r]
+        y_vertices = [y0+r,y0+l,y0+l,y0+r,y0+w,y0+w,y0-w,y0-w,y0-r,y0-l,y0-l,y0-r,y0-w,y0-w,y0+w,y0+w]
+        rotated = rotate(x_vertices,y_vertices,x0,y0,theta)
+        x_vertex_sets.append(rotated[0])
+        y_vertex_sets.append(rotated[1])
+    return x_vertex_sets, y_vertex_sets
+
+def manual_polygon(rng):
+    x0, y0 = rng.uniform(1000, tile_size-1000, 2)
+    return [[x0, x0+50, x0+700, x0+650]], [[y0, y0+600, y0+620, y0-20]]
+
+########## Kernels ##########
+
+#Each kernel makes its inputs and returns the new implementation, the legacy one and whether the result is
+#row-separable. For separable kernels (one answer per row that does not depend on the other rows of the same
+#catalog) the legacy loop can be run on the first rows only, and its time for all rows extrapolated.
+
+def kernel_overlap(rng, n, density):
+    ra, dec = sky_positions(rng, n)
+    return (lambda: overlapping(ra, dec, tolerance)), (lambda m: legacy_overlap(ra, dec, tolerance)), False
+
+def kernel_adjacent(rng, n, density):
+    ra, dec = sky_positions(rng, 2*n)
+    #Two overlapping tiles: every other object goes in the base catalog
+    base_ra, base_dec, check_ra, check_dec = ra[::2], dec[::2], ra[1::2], dec[1::2]
+    return (lambda: match_any(check_ra, check_dec, base_ra, base_dec, tolerance)), \
+           (lambda m: legacy_match_any(check_ra[:m], check_dec[:m], base_ra, base_dec, tolerance)), True
+
+def kernel_assoc(rng, n, density):
+    ra1, dec1 = sky_positions(rng, n)
+    jitter = 0.2*tolerance
+    ra2 = ra1 + rng.normal(0, jitter, n)
+    dec2 = dec1 + rng.normal(0, jitter, n)
+    order = rng.permutation(n)
+    ra2, dec2 = ra2[order], dec2[order]
+    good1 = rng.uniform(size=n) < 0.3
+    good2 = rng.uniform(size=n) < 0.3
+    def new():
+        match = first_matches(ra1, dec1, ra2, dec2, tolerance)
+        assoc1 = -np.ones(n, dtype=np.int64)
+        assoc2 = -np.ones(n, dtype=np.int64)
+        rows = assign_assoc(match, good1, good2)
+        assoc1[rows] = rows
+        assoc2[match[rows]] = rows
+        return assoc1, assoc2
+    return new, (lambda m: legacy_assoc(ra1, dec1, ra2, dec2, good1, good2, tolerance)), False
+
+def kernel_diffraction(rng, n, density):
+    x_min, x_max, y_min, y_max = boxes(rng, n)
+    #The same masks at every size, so only the number of rows changes
+    x_sets, y_sets = spike_masks(np.random.RandomState(density), density)
+    return (lambda: boxes_in_polygons(x_min, x_max, y_min, y_max, x_sets, y_sets)), \
+           (lambda m: legacy_boxes_in_polygons(x_min[:m], x_max[:m], y_min[:m], y_max[:m], x_sets, y_sets)), True
+
+def kernel_manual(rng, n, density):
+    x_min, x_max, y_min, y_max = boxes(rng, n)
+    x_sets, y_sets = manual_polygon(np.random.RandomState(1))
+    return (lambda: boxes_in_polygons(x_min, x_max, y_min, y_max, x_sets, y_sets)), \
+           (lambda m: legacy_boxes_in_polygons(x_min[:m], x_max[:m], y_min[:m], y_max[:m], x_sets, y_sets)), True
+
+#name : (kernel, densities)
+kernels = [("overlap", kernel_overlap, [None]),
+           ("adjacent", kernel_adjacent, [None]),
+           ("assoc", kernel_assoc, [None]),
+           ("diffraction", kernel_diffraction, star_densities),
+           ("manual", kernel_manual, [None])]
+
+def same_result(a, b, m=None):
+    if isinstance(a, tuple):
+        return all(same_result(x, y, m) for (x, y) in zip(a, b))
+    if m is not None:
+        a = a[:m]
+    return np.array_equal(a, b)
+
+#Best of repeats for quick runs, a single run for slow ones
+def timed(func, min_time=0.2, max_repeats=5):
+    best = None
+    total = 0.
+    repeats = 0
+    while repeats < max_repeats and (repeats == 0 or total < min_time):
+        s = time.time()
+        result = func()
+        t = time.time() - s
+        best = t if best is None else min(best, t)
+        total += t
+        repeats += 1
+    return best, result
+
+#Slope of log(time) vs log(rows) over the timings above min_time seconds, or over the three largest sizes if
+#fewer than three are that slow (very short timings are mostly call overhead and noise)
+def scaling_exponent(rows, times, min_time=5e-3):
+    rows = np.asarray(rows, dtype=np.float64)
+    times = np.asarray(times, dtype=np.float64)
+    if len(rows) < 2:
+        return np.nan
+    use = times > min_time
+    if np.count_nonzero(use) < 3:
+        use = np.arange(len(rows)) >= len(rows) - 3
+    return np.polyfit(np.log(rows[use]), np.log(times[use]), 1)[0]
+
+def run(results="kernel_results.jsonl", max_rows=1000000, legacy_seconds=20., new_seconds=30., max_exponent=1.3, seed=0):
+    commit, dirty = git_commit()
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    records = []
+    failed = False
+    print "%-12s %8s %9s %12s %12s %10s" % ("#kernel", "density", "rows", "new_s", "legacy_s", "agree")
+    for name, kernel, densities in kernels:
+        for density in densities:
+            rows, new_times, legacy_rows, legacy_times = [], [], [], []
+            run_legacy = True
+            for n in sizes:
+                if n > max_rows or (len(new_times) > 0 and new_times[-1] > new_seconds):
+                    continue
+                rng = np.random.RandomState(seed)
+                new, legacy, separable = kernel(rng, n, density)
+                new_time, new_result = timed(new)
+                rows.append(n)
+                new_times.append(new_time)
+                legacy_time = None
+                agree = None
+                m = n
+                if separable:
+                    #Time a few rows first and only run as many as fit in the budget
+                    t = timed(lambda: legacy(10), max_repeats=1)[0]
+                    m = min(n, max(10, int(10*legacy_seconds/3/max(t, 1e-6))))
+                if run_legacy or separable:
+                    legacy_time, legacy_result = timed(lambda: legacy(m), max_repeats=1)
+                    legacy_time *= float(n)/m
+                    agree = same_result(new_result, legacy_result, m if separable else None)
+                    legacy_rows.append(n)
+                    legacy_times.append(legacy_time)
+                    #The legacy loops are quadratic: stop before the next size takes far too long
+                    if legacy_time*(3.3**2) > legacy_seconds:
+                        run_legacy = False
+                    if not agree:
+                        failed = True
+                print "%-12s %8s %9d %12.5f %12s %10s" % (name, density, n, new_time, "-" if legacy_time is None else ("%.5f" % legacy_time) + ("" if m == n else "*"), "-" if agree is None else agree)
+                records.append({"kernel" : name, "density" : density, "rows" : n, "new_s" : new_time,
+                                "legacy_s" : legacy_time, "legacy_rows_run" : m if legacy_time is not None else None, "agree" : agree})
+            exponent = scaling_exponent(rows, new_times)
+            legacy_exponent = scaling_exponent(legacy_rows, legacy_times)
+            if exponent > max_exponent:
+                failed = True
+            print "%-12s %8s scaling exponent %.2f (legacy %.2f)" % (name, density, exponent, legacy_exponent)
+            records.append({"kernel" : name, "density" : density, "exponent" : exponent, "legacy_exponent" : legacy_exponent,
+                            "max_exponent" : max_exponent, "ok" : bool(exponent <= max_exponent)})
+    out = open(results, "a")
+    for record in records:
+        record.update({"run_id" : run_id, "commit" : commit, "dirty" : dirty})
+        out.write(json.dumps(record, sort_keys=True) + "\n")
+    out.close()
+    return not failed
+
+if __name__ == "__main__":
+    kwargs = {}
+    for arg in sys.argv[1:]:
+        key, value = arg.split("=", 1)
+        if key in ("max_rows", "seed"):
+            value = int(value)
+        elif key != "results":
+            value = float(value)
+        kwargs[key] = value
+    if not run(**kwargs):
+        sys.exit(1)
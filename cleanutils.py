@@ -8,15 +8,16 @@ import pyfits
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+import instrument
+from sextractor_io import read_catalog, write_catalog
 
 ### Helper functions for HST_Sextractor.py ###
 
 #Renumbers the objects in a catalog
 def renumber(catalog):
-    cat = asciidata.open(catalog)
-    for i in range(cat.nrows):
-        cat['NUMBER'][i] = i
-    cat.writeto(catalog)
+    cat = read_catalog(catalog)
+    cat['NUMBER'] = np.arange(cat.nrows)
+    write_catalog(cat, catalog)
     
 #Takes two x-y pairs (tuples) and returns as a tuple the slope and intercept of the line connecting them
 def points_to_line(point1, point2):
@@ -71,137 +72,248 @@ def inpoly(px,py,x,y):
                 if c > 0:
                     crossings += 1
     return crossings % 2
-    
+
+#inpoly for an array of points at once, with the same crossing rules (points level with every vertex or
+#entirely above/below the polygon are outside). Returns an int array of 0/1.
+def inpoly_points(px,py,x,y):
+    px = np.asarray(px, dtype=np.float64)[:,np.newaxis]
+    py = np.asarray(py, dtype=np.float64)[:,np.newaxis]
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    Ay = y[np.newaxis,:] - py
+    outside = np.all(Ay >= 0, axis=1) | np.all(Ay <= 0, axis=1)
+    Ax = x[np.newaxis,:] - px
+    Bx = np.roll(x, -1)[np.newaxis,:] - px
+    By = np.roll(y, -1)[np.newaxis,:] - py
+    straddle = Ay*By < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = Ax-(Ay*(Bx-Ax))/(By-Ay)
+    crossing = straddle & (((Ax > 0) & (Bx > 0)) | (c > 0))
+    crossings = np.count_nonzero(crossing, axis=1)
+    return np.where(outside, 0, crossings % 2)
+
+#Pixels on the boundary of each box, in the order the cleaning functions used to build them: the bottom and
+#top rows exclude x_max, the left and right columns exclude y_max. Returns the pixel coordinates and the
+#index of the box each pixel belongs to.
+def box_perimeters(x_min, x_max, y_min, y_max):
+    x_min, x_max = np.asarray(x_min, dtype=np.int64), np.asarray(x_max, dtype=np.int64)
+    y_min, y_max = np.asarray(y_min, dtype=np.int64), np.asarray(y_max, dtype=np.int64)
+    w = np.maximum(x_max - x_min, 0)
+    h = np.maximum(y_max - y_min, 0)
+    owner_w = np.repeat(np.arange(len(w)), w)
+    owner_h = np.repeat(np.arange(len(h)), h)
+    along_w = np.arange(len(owner_w)) - np.repeat(np.cumsum(w) - w, w)
+    along_h = np.arange(len(owner_h)) - np.repeat(np.cumsum(h) - h, h)
+    px = np.concatenate([x_min[owner_w] + along_w, x_min[owner_h], x_min[owner_w] + along_w, x_max[owner_h]])
+    py = np.concatenate([y_min[owner_w], y_min[owner_h] + along_h, y_max[owner_w], y_min[owner_h] + along_h])
+    owner = np.concatenate([owner_w, owner_h, owner_w, owner_h])
+    return px, py, owner
+
+#True for each box with a boundary pixel inside any of the polygons (lists of vertex lists). Only the boxes
+#whose bounding box overlaps a polygon's bounding box are tested against it; those are found from the boxes
+#sorted by x_min, so each polygon only looks at a narrow slice of the catalog.
+def boxes_in_polygons(x_min, x_max, y_min, y_max, x_vertex_sets, y_vertex_sets):
+    x_min, x_max = np.asarray(x_min), np.asarray(x_max)
+    y_min, y_max = np.asarray(y_min), np.asarray(y_max)
+    hit = np.zeros(len(x_min), dtype=bool)
+    if len(x_min) == 0:
+        return hit
+    order = np.argsort(x_min, kind='mergesort')
+    sorted_x_min = x_min[order]
+    max_width = (x_max - x_min).max()
+    for k in range(len(x_vertex_sets)):
+        x, y = np.asarray(x_vertex_sets[k]), np.asarray(y_vertex_sets[k])
+        lo = np.searchsorted(sorted_x_min, x.min() - max_width, side='left')
+        hi = np.searchsorted(sorted_x_min, x.max(), side='right')
+        near = order[lo:hi]
+        near = near[~hit[near] & (x_max[near] >= x.min()) & (y_max[near] >= y.min()) & (y_min[near] <= y.max())]
+        #In chunks, so the (pixels x edges) arrays of inpoly_points stay small
+        for start in range(0, len(near), 256):
+            chunk = near[start:start+256]
+            px, py, owner = box_perimeters(x_min[chunk], x_max[chunk], y_min[chunk], y_max[chunk])
+            inside = inpoly_points(px, py, x, y) == 1
+            hit[chunk[np.unique(owner[inside])]] = True
+    return hit
+
+#All pairs (i,j) with |x1[i]-x2[j]| < tolerance and |y1[i]-y2[j]| < tolerance. Both sets are binned on a grid
+#of tolerance-sized cells, so only the 3x3 block of cells around each point is searched instead of every row.
+#Pairs come back sorted by i, then j.
+def box_pairs(x1, y1, x2, y2, tolerance):
+    x1, y1 = np.asarray(x1, dtype=np.float64), np.asarray(y1, dtype=np.float64)
+    x2, y2 = np.asarray(x2, dtype=np.float64), np.asarray(y2, dtype=np.float64)
+    if len(x1) == 0 or len(x2) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    x0, y0 = min(x1.min(), x2.min()), min(y1.min(), y2.min())
+    cx1 = np.floor((x1 - x0)/tolerance).astype(np.int64)
+    cy1 = np.floor((y1 - y0)/tolerance).astype(np.int64)
+    cx2 = np.floor((x2 - x0)/tolerance).astype(np.int64)
+    cy2 = np.floor((y2 - y0)/tolerance).astype(np.int64)
+    ny = max(cy1.max(), cy2.max()) + 3
+    key2 = cx2*ny + cy2
+    order2 = np.argsort(key2)
+    sorted_key2 = key2[order2]
+    #The lookups go in cell order too; searchsorted on sorted keys stays in cache
+    key1 = cx1*ny + cy1
+    order1 = np.argsort(key1)
+    sorted_key1 = key1[order1]
+    i_out = []
+    j_out = []
+    for dx in (-1, 0, 1):
+        #The cells (cx+dx, cy-1..cy+1) are consecutive keys, so one range covers all three
+        lookup = sorted_key1 + dx*ny
+        lo = np.searchsorted(sorted_key2, lookup - 1, side='left')
+        hi = np.searchsorted(sorted_key2, lookup + 1, side='right')
+        counts = hi - lo
+        i = np.repeat(order1, counts)
+        j = order2[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        close = (np.abs(x1[i] - x2[j]) < tolerance) & (np.abs(y1[i] - y2[j]) < tolerance)
+        i_out.append(i[close])
+        j_out.append(j[close])
+    i = np.concatenate(i_out)
+    j = np.concatenate(j_out)
+    pair_key = np.sort(i*len(x2) + j)
+    return pair_key // len(x2), pair_key % len(x2)
+
+#True for every object within tolerance (in both coordinates) of another object in the same catalog
+def overlapping(x, y, tolerance):
+    i, j = box_pairs(x, y, x, y, tolerance)
+    pair = i < j
+    close = np.zeros(len(x), dtype=bool)
+    close[i[pair]] = True
+    close[j[pair]] = True
+    return close
+
+#Drops the rows asciidata left as "Null"
 def delete_null(catalog):
-    f = open(catalog)
-    lines = f.readlines()
+    with instrument.Stage("delete_null", rows_in=catalog) as s:
+        write_catalog(read_catalog(catalog, skip_null=True), catalog)
+        s.rows_out = catalog
+
+### Cleaning as a chain of keep-masks ###
+#Each cleaning step is a function step(cat, keep) of a sextractor_io catalog and the rows kept by the steps
+#before it, returning a boolean array that is False for the rows the step rejects. clean_catalog evaluates the
+#steps in order, ANDs their masks and writes the surviving rows once.
+
+#Corners of the AEGIS tile footprint (bottom-left, top-left, top-right, bottom-right) in pixels
+edge_corners = ((390.,321.), (498.,6725.), (6898.,7287.), (7002.,806.))
+
+#edge_corners scaled to a tile of shape (NAXIS2, NAXIS1); unchanged on the 7500 x 7500 AEGIS tiles, and the
+#footprint synthetic_data.py draws on a smaller tile
+def tile_edge_corners(shape, corners=edge_corners):
+    return tuple((x*shape[1]/7500., y*shape[0]/7500.) for (x, y) in corners)
+
+#Objects whose bounding box lies inside the tile footprint
+def edge_keep(cat, keep, corners=edge_corners):
+    (A, B, C, D) = corners
+    (left_m, left_b) = points_to_line(A,B)
+    (top_m, top_b) = points_to_line(B,C)
+    (right_m, right_b) = points_to_line(C,D)
+    (bottom_m, bottom_b) = points_to_line(D,A)
+    x_min, x_max = cat['XMIN_IMAGE'], cat['XMAX_IMAGE']
+    y_min, y_max = cat['YMIN_IMAGE'], cat['YMAX_IMAGE']
+    return (x_min < left_m*x_min+left_b) & (x_max < right_m*x_max+right_b) & \
+           (y_min > bottom_m*y_min+bottom_b) & (y_max < top_m*y_max+top_b)
+
+#Diffraction-spike mask polygons of the kept stars brighter than mag_cutoff. The length of the spike is
+#l = m*Flux+b and its width w (spike_params = (m, b, w, theta)).
+def spike_masks(cat, keep, spike_params, mag_cutoff=19.0):
+    (m, b, w, theta) = spike_params
+    w = w*0.5
+    stars = np.where(keep & (cat['MAG_AUTO'] + 25 < mag_cutoff) & (cat['IS_STAR'] == 1))[0]
+    x_vertex_sets = []
+    y_vertex_sets = []
+    for i in stars:
+        x0 = cat['X_IMAGE'][i]
+        y0 = cat['Y_IMAGE'][i]
+        r = np.mean([cat['A_IMAGE'][i], cat['B_IMAGE'][i]])
+        l = m*cat['FLUX_AUTO'][i]+b
+        x_vertices = [x0-w,x0-w,x0+w,x0+w,x0+r,x0+l,x0+l,x0+r,x0+w,x0+w,x0-w,x0-w,x0-r,x0-l,x0-l,x0-r]
+        y_vertices = [y0+r,y0+l,y0+l,y0+r,y0+w,y0+w,y0-w,y0-w,y0-r,y0-l,y0-l,y0-r,y0-w,y0-w,y0+w,y0+w]
+        (x_rotated, y_rotated) = rotate(x_vertices,y_vertices,x0,y0,theta)
+        x_vertex_sets.append(x_rotated)
+        y_vertex_sets.append(y_rotated)
+    return x_vertex_sets, y_vertex_sets
+
+#Kept non-star objects whose bounding box outline touches any of the polygons
+def polygon_hit(cat, keep, x_vertex_sets, y_vertex_sets):
+    hit = np.zeros(cat.nrows, dtype=bool)
+    galaxies = np.where(keep & (cat['IS_STAR'] != 1))[0]
+    x_min, x_max = cat['XMIN_IMAGE'].astype(np.int64), cat['XMAX_IMAGE'].astype(np.int64)
+    y_min, y_max = cat['YMIN_IMAGE'].astype(np.int64), cat['YMAX_IMAGE'].astype(np.int64)
+    hit[galaxies] = boxes_in_polygons(x_min[galaxies], x_max[galaxies], y_min[galaxies], y_max[galaxies], x_vertex_sets, y_vertex_sets)
+    return hit
+
+def diffraction_keep(cat, keep, spike_params, mag_cutoff=19.0):
+    x_vertex_sets, y_vertex_sets = spike_masks(cat, keep, spike_params, mag_cutoff)
+    print "Applying masks for", len(x_vertex_sets), "stars."
+    return ~polygon_hit(cat, keep, x_vertex_sets, y_vertex_sets)
+
+#masks is a list of (x_vertices, y_vertices)
+def manual_keep(cat, keep, masks):
+    return ~polygon_hit(cat, keep, [mask[0] for mask in masks], [mask[1] for mask in masks])
+
+#Both objects of every kept pair closer than tolerance (degrees) in ALPHA_SKY and DELTA_SKY are rejected
+def overlap_keep(cat, keep, tolerance = 1./18000):
+    step_keep = np.ones(cat.nrows, dtype=bool)
+    kept = np.where(keep)[0]
+    step_keep[kept] = ~overlapping(cat['ALPHA_SKY'][kept], cat['DELTA_SKY'][kept], tolerance)
+    return step_keep
+
+#Runs the cleaning steps (a list of (reason, step)) on in_name and writes the surviving rows to out_name,
+#renumbered from 0 if renumber_rows. Each step runs as an instrument stage named after its reason. The rejected
+#rows can be written to rejected_name, with their original NUMBER and the reason in an added REJECTED_BY column.
+#Returns the keep-mask and the number of rows each reason rejected.
+def clean_catalog(in_name, out_name, steps, renumber_rows=True, rejected_name=None):
+    cat = read_catalog(in_name)
+    keep = np.ones(cat.nrows, dtype=bool)
+    reasons = np.zeros(cat.nrows, dtype="S32")
+    rejected = []
+    for (reason, step) in steps:
+        with instrument.Stage(reason, rows_in=int(np.count_nonzero(keep))) as s:
+            rejects = keep & ~step(cat, keep)
+            keep &= ~rejects
+            reasons[rejects] = reason
+            s.rows_out = int(np.count_nonzero(keep))
+        rejected.append((reason, int(np.count_nonzero(rejects))))
+        print rejected[-1][1], "objects rejected by", reason
+    if renumber_rows:
+        #Only the survivors are renumbered; the rejected rows keep the NUMBER they had
+        number = np.array(cat['NUMBER'])
+        number[keep] = np.arange(np.count_nonzero(keep))
+        cat['NUMBER'] = number
+    write_catalog(cat, out_name, rows=keep)
+    if rejected_name is not None:
+        cat.add_column("REJECTED_BY", reasons, "Cleaning step that removed the object")
+        write_catalog(cat, rejected_name, rows=~keep)
+    return keep, rejected
+
+#Manual mask polygons from a file in the format described in HST_Sextractor_new.py:
+#{catalog name : [(x_vertices, y_vertices), ...]}
+def read_manual_masks(catalog_vertex_file):
+    masks = {}
+    current_catalog = ""
+    x_vertices = None
+    f = open(catalog_vertex_file)
+    for line in f.readlines():
+        split = line.split()
+        if len(split) == 0:
+            continue
+        if split[0] == '#':
+            current_catalog = split[1]
+            x_vertices = None
+        elif x_vertices is None:
+            x_vertices = [np.float32(word) for word in split]
+        else:
+            y_vertices = [np.float32(word) for word in split]
+            masks.setdefault(current_catalog, []).append((x_vertices, y_vertices))
+            x_vertices = None
     f.close()
-    g = open(catalog, "w")
-    for line in lines:
-        if (line.split())[0] != "Null":
-            g.write(line)        
+    return masks
 
 #tolerance in degrees
 def delete_overlap(catalog, tolerance = 1./18000, clean=True):
-    s = time.time()
-    orig_name = catalog
-    print "Deleting overlaps on file: ", orig_name
-    catalog = asciidata.open(catalog)
-    new_table = asciidata.create(catalog.ncols,catalog.nrows)
-    delete_numbers = []
-    for i in range(catalog.nrows-1):
-        if (i+1) % 10 == 0:
-            print "Working on object", i+1, "out of", catalog.nrows
-        number = catalog['NUMBER'][i]
-        ra, dec = catalog['ALPHA_SKY'][i], catalog['DELTA_SKY'][i]
-        for j in range(i+1, catalog.nrows):
-            number0 = catalog['NUMBER'][j]
-            ra0, dec0 = catalog['ALPHA_SKY'][j], catalog['DELTA_SKY'][j]
-            if abs(ra0-ra) < tolerance and abs(dec0-dec) < tolerance:
-                delete_numbers.append(number0)
-                delete_numbers.append(number)
-    print "Delete numbers", delete_numbers
-    new_table = asciidata.create(catalog.ncols,catalog.nrows)
-    for i in range(catalog.nrows):
-        if catalog['NUMBER'][i] not in delete_numbers:
-             for k in range(catalog.ncols):
-                 new_table[k][i] = catalog[k][i]
-    #Get rid of empty rows
-    row_number = 0
-    while True:
-        try:
-            if new_table[0][row_number] is None:
-                new_table.delete(row_number)
-                if "606" in orig_name:
-                    n_overlap606 += 1
-                if "814" in orig_name:
-                    n_overlap814 += 1
-            else:
-                row_number += 1
-        except:
-            break
-    #Write out to another catalog
-    new_table.writeto("overlap.cat")
-    new_catalog = open("overlap.cat")
-    old_catalog = open(orig_name)
-    final_catalog = open("final_overlap.cat", "w")
-    for line in old_catalog.readlines():
-        if line[0] == "#":
-            final_catalog.write(line)
-        else:
-            break
-    for line in new_catalog:
-        final_catalog.write(line)
-    old_catalog.close()
-    final_catalog.close()
-    final = open("final_overlap.cat", "r")
-    rewrite = open(orig_name, "w")
-    for line in final.readlines():
-        rewrite.write(line)
-    #Optional clean
-    if clean:
-        subprocess.call(["rm", "overlap.cat"])
-        subprocess.call(["rm", "final_overlap.cat"])
-    e = time.time()
-    print "Time:", e-s
+    print "Deleting overlaps on file: ", catalog
+    clean_catalog(catalog, catalog, [("delete_overlap", lambda cat, keep: overlap_keep(cat, keep, tolerance))], renumber_rows=False)
 
 def manual_mask(catalog, x_vertices, y_vertices, clean=True):
-    orig_name = catalog
-    catalog = asciidata.open(catalog)
-    new_table = asciidata.create(catalog.ncols,catalog.nrows)
-    delete_numbers = []
-    for i in range(catalog.nrows):
-        if (i+1) % 1000 == 0:
-            print "Working on object", i+1, "out of", catalog.nrows
-        number = catalog['NUMBER'][i]
-        is_star = catalog['IS_STAR'][i]
-        if is_star == 1:
-            continue
-        x_min,y_min = catalog['XMIN_IMAGE'][i], catalog['YMIN_IMAGE'][i]
-        x_max,y_max = catalog['XMAX_IMAGE'][i], catalog['YMAX_IMAGE'][i]
-        bottom_pixels = [(x,y_min) for x in range(x_min,x_max)]
-        left_pixels = [(x_min,y) for y in range(y_min,y_max)]
-        top_pixels = [(x, y_max) for x in range(x_min,x_max)]
-        right_pixels = [(x_max,y) for y in range(y_min,y_max)]
-        pixels = bottom_pixels + left_pixels + top_pixels + right_pixels
-    	bools = [inpoly(pixel[0],pixel[1],x_vertices,y_vertices) for pixel in pixels]
-        if max(bools) == 1:
-            delete_numbers.append(number)
-    print "Delete numbers", delete_numbers
-    new_table = asciidata.create(catalog.ncols,catalog.nrows)
-    for i in range(catalog.nrows):
-        if catalog['NUMBER'][i] not in delete_numbers:
-             for k in range(catalog.ncols):
-                 new_table[k][i] = catalog[k][i]
-    #Get rid of empty rows
-    row_number = 0
-    while True:
-        try:
-            if new_table[0][row_number] is None:
-                new_table.delete(row_number)
-            else:
-                row_number += 1
-        except:
-            break
-    #Write out to another catalog
-    new_table.writeto("manual_filter.cat")
-    new_catalog = open("manual_filter.cat")
-    old_catalog = open(orig_name)
-    final_catalog = open("final_catalog.cat", "w")
-    for line in old_catalog.readlines():
-        if line[0] == "#":
-            final_catalog.write(line)
-        else:
-            break
-    for line in new_catalog:
-        final_catalog.write(line)
-    old_catalog.close()
-    final_catalog.close()
-    final = open("final_catalog.cat", "r")
-    rewrite = open(orig_name, "w")
-    for line in final.readlines():
-        rewrite.write(line)
-    #Optional clean
-    if clean:
-        subprocess.call(["rm", "final_catalog.cat"])
-        subprocess.call(["rm", "manual_filter.cat"])
\ No newline at end of file
+    clean_catalog(catalog, catalog, [("manual_mask", lambda cat, keep: manual_keep(cat, keep, [(x_vertices, y_vertices)]))], renumber_rows=False)
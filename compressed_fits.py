@@ -0,0 +1,118 @@
+'''
+Script Name: compressed_fits.py
+
+########### Description ##########
+
+Tile-compressed FITS (the fpack convention: an empty primary HDU followed by one CompImageHDU per image) for the
+image products the pipeline writes, in place of uncompressed float64/float32 images.
+
+The compression of each kind of product is set by a dict {kind : setting}, kind one of "images", "ivar", "psf",
+"mask" (the stamp directories of postage_stamps) or "segmentation" (segmentation maps and stamp masks), and
+setting
+
+None        -- written uncompressed, as before
+"lossless"  -- RICE_1 for integer images, GZIP_1 without quantization for float images (bit-exact)
+q (a float) -- float images quantized to q levels per noise sigma (estimated on each compression tile, a row
+               of the image) with subtractive dithering and RICE_1 compressed; integer images lossless as above
+
+Kinds missing from the dict are written uncompressed, and so are images of fewer than min_pixels pixels: a
+compressed HDU costs two more 2880-byte header blocks (and the empty primary HDU one), which is more than it saves
+on a small stamp. Two presets:
+
+lossless  -- every kind lossless
+quantized -- images and ivar quantized with q = 16, psf, mask and segmentation lossless
+
+Masks and segmentation maps hold 0/1 or small labels, so compressed ones are cast to the smallest integer type
+that holds them first.
+
+The images SExtractor reads (tiles, weights, detection and background-subtracted images) are not compressed.
+Compressed stamps are only read by SExtractor in generate_masks without native=True, which needs a SExtractor
+built with tile-compression support.
+
+Readers go through image_hdu / image_hdus / read_image, which skip the empty primary HDU of a compressed file, so
+compressed and uncompressed products (and .fits.fz tiles) are read the same way.
+
+########## Usage ##########
+
+write_image(mask, "mask.fits", kind="mask", compression=quantized)
+data = read_image("mask.fits")
+'''
+
+import numpy as np
+import pyfits
+
+lossless = {"images" : "lossless", "ivar" : "lossless", "psf" : "lossless", "mask" : "lossless", "segmentation" : "lossless"}
+quantized = dict(lossless, images=16.0, ivar=16.0)
+min_pixels = 64*64
+
+#Smallest integer type holding every value of a mask or segmentation map (pyfits reads compressed 8-bit images
+#back as signed, so 16 bits at least)
+def label_type(data):
+    if data.size == 0 or (data.min() >= -32768 and data.max() <= 32767):
+        return np.int16
+    return np.int32
+
+#One image HDU of kind with data (and header, a full image header), compressed as compression says. primary=True
+#gives the first HDU of an uncompressed file; a compressed HDU is never primary.
+def new_image_hdu(data, header=None, kind="images", compression=None, primary=False):
+    setting = compression_setting([data], kind, compression)
+    if setting is None:
+        if primary:
+            return pyfits.PrimaryHDU(data, header=header)
+        return pyfits.ImageHDU(data, header=header)
+    if kind in ("mask", "segmentation"):
+        data = np.asarray(data).astype(label_type(data))
+    if data.dtype.kind == "f":
+        if setting == "lossless":
+            return pyfits.CompImageHDU(data, header=header, compression_type="GZIP_1", quantize_level=0.0)
+        return pyfits.CompImageHDU(data, header=header, compression_type="RICE_1", quantize_level=float(setting), quantize_method=1)
+    return pyfits.CompImageHDU(data, header=header, compression_type="RICE_1")
+
+#The setting images of kind are written with, None if they are not compressed
+def compression_setting(images, kind, compression):
+    if compression is None or min(np.size(image) for image in images) < min_pixels:
+        return None
+    return compression.get(kind)
+
+#HDU list of images of one kind, one HDU per image, with the keywords[k] dict set in the header of image k
+def image_hdulist(images, kind="images", compression=None, keywords=None):
+    compressed = compression_setting(images, kind, compression) is not None
+    if not compressed:
+        compression = None
+    hdulist = pyfits.HDUList()
+    if compressed:
+        hdulist.append(pyfits.PrimaryHDU())
+    for k in range(len(images)):
+        hdu = new_image_hdu(images[k], kind=kind, compression=compression, primary=(k == 0 and not compressed))
+        if keywords is not None:
+            for key, value in keywords[k].items():
+                hdu.header[key] = value
+        hdulist.append(hdu)
+    return hdulist
+
+def write_image(data, out_name, header=None, kind="images", compression=None):
+    hdu = new_image_hdu(data, header, kind, compression, primary=True)
+    if isinstance(hdu, pyfits.CompImageHDU):
+        pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(out_name, clobber=True)
+    else:
+        hdu.writeto(out_name, clobber=True)
+
+#The HDUs of an open file that hold an image, in order (compressed or not)
+def image_hdus(hdulist):
+    return [hdu for hdu in hdulist if isinstance(hdu, pyfits.CompImageHDU) or (hdu.is_image and hdu.header.get('NAXIS', 0) > 0)]
+
+#The k-th image HDU of an open file: the primary HDU of an uncompressed image, the first extension of a compressed one
+def image_hdu(hdulist, k=0):
+    return image_hdus(hdulist)[k]
+
+def read_image(fname, k=0):
+    f = pyfits.open(fname)
+    data = image_hdu(f, k).data
+    f.close()
+    return data
+
+def read_header(fname, k=0):
+    f = pyfits.open(fname)
+    header = image_hdu(f, k).header
+    f.close()
+    return header
@@ -0,0 +1,260 @@
+'''
+Script Name: detection.py
+
+In-process source detection with NumPy/SciPy, for small jobs where spawning SExtractor and writing
+config, parameter and catalog files costs more than the detection itself (postage stamps, noiseless
+TinyTim star fields). It follows the same steps as SExtractor, in simplified form:
+
+1) Background and background RMS from a mesh of sigma-clipped boxes, median filtered and interpolated
+2) Optional smoothing with the SExtractor default 3x3 convolution kernel
+3) Thresholding and 8-connected component labelling, dropping components smaller than minarea
+4) Multi-threshold deblending: a component is split when, at some level between the detection threshold
+   and its peak, it contains two or more branches each holding more than mincont of its flux. The
+   remaining pixels are assigned to the nearest branch.
+
+Everything is returned as arrays, nothing is written to disk, so detect() can be called from a thread
+or process pool.
+
+########## Usage ##########
+
+objects, labels = detect(data, weight=weight, thresh=1.0, minarea=18)
+
+objects is a record array with one row per detection and the fields
+NUMBER, X_IMAGE, Y_IMAGE, XMIN_IMAGE, XMAX_IMAGE, YMIN_IMAGE, YMAX_IMAGE, FLUX, PEAK, NPIX
+using the SExtractor conventions (1-indexed pixel coordinates, inclusive bounds). labels is the
+segmentation image, where pixels of object NUMBER n are n and background is 0.
+
+For noiseless images (TinyTim fields) pass background=0. and absolute_thresh instead of thresh.
+'''
+
+import numpy as np
+from scipy import ndimage
+
+#SExtractor default.conv
+default_kernel = np.array([[1.,2.,1.],
+                           [2.,4.,2.],
+                           [1.,2.,1.]])/16.
+
+#8-connectivity, as in SExtractor
+connectivity = np.ones((3,3), dtype=bool)
+
+#Sigma-clipped statistics along axis 1 of a 2d array, ignoring NaNs.
+#Returns the SExtractor mode estimate (2.5*median - 1.5*mean, or the median if the distribution is
+#too skewed) and the standard deviation of each row.
+#Clipping only ever removes the extremes, so each row is sorted once and the surviving values are
+#tracked as a window [lo, hi) of the sorted row, with means and variances from prefix sums.
+def clipped_stats(values, nsigma=3.0, niter=5):
+    ordered = np.sort(values, axis=1)
+    (nrows, ncols) = ordered.shape
+    rows = np.arange(nrows)
+    filled = np.where(np.isfinite(ordered), ordered, 0.).astype(np.float64)
+    s1 = np.zeros((nrows, ncols+1))
+    s2 = np.zeros((nrows, ncols+1))
+    np.cumsum(filled, axis=1, out=s1[:,1:])
+    np.cumsum(filled**2, axis=1, out=s2[:,1:])
+    del filled
+    lo = np.zeros(nrows, dtype=int)
+    hi = np.isfinite(ordered).sum(axis=1)
+    for i in range(niter+1):
+        count = np.maximum(hi - lo, 1)
+        med = 0.5*(ordered[rows, np.minimum(lo + (count-1)//2, ncols-1)] + ordered[rows, np.minimum(lo + count//2, ncols-1)])
+        mean = (s1[rows,hi] - s1[rows,lo])/count
+        std = np.sqrt(np.maximum((s2[rows,hi] - s2[rows,lo])/count - mean**2, 0.))
+        if i == niter:
+            break
+        with np.errstate(invalid='ignore'):
+            new_lo = np.maximum(lo, (ordered < (med - nsigma*std)[:,None]).sum(axis=1))
+            new_hi = np.minimum(hi, (ordered <= (med + nsigma*std)[:,None]).sum(axis=1))
+        new_hi = np.maximum(new_hi, new_lo + 1)
+        if (new_lo == lo).all() and (new_hi == hi).all():
+            break
+        (lo, hi) = (new_lo, np.minimum(new_hi, hi))
+    mode = 2.5*med - 1.5*mean
+    skewed = np.abs(mean - med)/np.where(std > 0, std, 1.) > 0.3
+    mode[skewed] = med[skewed]
+    return mode, std
+
+#Background and background RMS maps at full resolution.
+#Pixels with zero weight are left out of the statistics. Meshes with no valid pixels are filled
+#from their neighbours before filtering.
+def background_map(data, weight=None, back_size=64, filter_size=3, nsigma=3.0):
+    back_size = int(min(back_size, data.shape[0], data.shape[1]))
+    mode, std = background_mesh(data, weight, back_size, filter_size, nsigma)
+    return expand_mesh(mode, data.shape, back_size), expand_mesh(std, data.shape, back_size)
+
+#The background and RMS of each back_size x back_size mesh, filtered, before background_map expands them
+def background_mesh(data, weight=None, back_size=64, filter_size=3, nsigma=3.0):
+    (ny, nx) = data.shape
+    back_size = int(min(back_size, nx, ny))
+    nmy = int(np.ceil(float(ny)/back_size))
+    nmx = int(np.ceil(float(nx)/back_size))
+    padded = np.empty((nmy*back_size, nmx*back_size), dtype=np.float32)
+    padded[:,:] = np.nan
+    padded[:ny,:nx] = data
+    if weight is not None:
+        padded[:ny,:nx][weight <= 0] = np.nan
+    meshes = padded.reshape(nmy, back_size, nmx, back_size).swapaxes(1,2).reshape(nmy*nmx, back_size*back_size)
+    valid = np.isfinite(meshes).any(axis=1)
+    mode = np.zeros(nmy*nmx)
+    std = np.zeros(nmy*nmx)
+    if valid.any():
+        mode[valid], std[valid] = clipped_stats(meshes[valid], nsigma=nsigma)
+    del padded, meshes
+    mode = mode.reshape(nmy, nmx)
+    std = std.reshape(nmy, nmx)
+    valid = valid.reshape(nmy, nmx)
+    if valid.any() and not valid.all():
+        #nearest valid mesh
+        indices = ndimage.distance_transform_edt(~valid, return_distances=False, return_indices=True)
+        mode = mode[indices[0], indices[1]]
+        std = std[indices[0], indices[1]]
+    if filter_size > 1:
+        mode = ndimage.median_filter(mode, size=filter_size, mode='nearest')
+        std = ndimage.median_filter(std, size=filter_size, mode='nearest')
+    return mode, std
+
+#Bilinear interpolation of a mesh of values defined at the mesh centres up to the full image size.
+#Done separably (first along x for every mesh row, then along y) so only one full-size array is made.
+def expand_mesh(mesh, shape, back_size):
+    (ny, nx) = shape
+    (nmy, nmx) = mesh.shape
+    #pixel centre coordinates in units of meshes, relative to the first mesh centre
+    yy = np.clip((np.arange(ny) + 0.5)/back_size - 0.5, 0, nmy-1)
+    xx = (np.arange(nx) + 0.5)/back_size - 0.5
+    rows = np.array([np.interp(xx, np.arange(nmx), mesh[j]) for j in range(nmy)], dtype=np.float32)
+    y0 = np.minimum(np.floor(yy).astype(int), max(nmy-2, 0))
+    y1 = np.minimum(y0 + 1, nmy-1)
+    fy = (yy - y0).astype(np.float32)[:,None]
+    return (1 - fy)*rows[y0] + fy*rows[y1]
+
+#Splits one component (boolean mask sub_mask over image cut sub) into several when it holds multiple
+#significant branches, i.e. branches with at least minarea pixels and more than mincont of the flux.
+#Returns an integer array with labels 1..n over the cut (0 outside the component).
+def deblend(sub, sub_mask, floor, nthresh=32, mincont=0.005, minarea=5, depth=0, max_depth=3):
+    out = sub_mask.astype(np.int32)
+    values = sub[sub_mask]
+    peak = values.max()
+    total = values.sum()
+    if depth >= max_depth or peak <= floor or total <= 0:
+        return out
+    if floor > 0:
+        levels = floor*(peak/floor)**(np.arange(1, nthresh)/float(nthresh))
+    else:
+        levels = floor + (peak - floor)*np.arange(1, nthresh)/float(nthresh)
+    for level in levels:
+        branches, nbranch = ndimage.label(sub_mask & (sub > level), structure=connectivity)
+        if nbranch < 2:
+            continue
+        flux = ndimage.sum(np.where(sub_mask, sub, 0.), branches, index=np.arange(1, nbranch+1))
+        area = np.bincount(branches.ravel(), minlength=nbranch+1)[1:]
+        significant = np.where((flux > mincont*total) & (area >= minarea))[0] + 1
+        if len(significant) < 2:
+            continue
+        #seed every significant branch, then give every other component pixel to the nearest seed
+        seeds = np.zeros(sub.shape, dtype=np.int32)
+        for k in range(len(significant)):
+            seeds[branches == significant[k]] = k + 1
+        indices = ndimage.distance_transform_edt(seeds == 0, return_distances=False, return_indices=True)
+        assigned = seeds[indices[0], indices[1]]
+        assigned[~sub_mask] = 0
+        out = np.zeros(sub.shape, dtype=np.int32)
+        n = 0
+        for k in range(1, len(significant)+1):
+            child = deblend(sub, assigned == k, level, nthresh=nthresh, mincont=mincont, minarea=minarea, depth=depth+1, max_depth=max_depth)
+            out[child > 0] = child[child > 0] + n
+            n += child.max()
+        return out
+    return out
+
+#Runs the full detection. See the module docstring for the output format.
+#thresh is in units of the background RMS, absolute_thresh (if given) is in image units.
+#background and rms can be full-size maps or scalars; by default they are measured with background_map.
+def detect(data, weight=None, thresh=1.5, absolute_thresh=None, minarea=5, back_size=64, filter_size=3,
+           background=None, rms=None, kernel=default_kernel, deblend_nthresh=32, deblend_mincont=0.005):
+    data = np.asarray(data, dtype=np.float32)
+    if background is None or (rms is None and absolute_thresh is None):
+        bkg, bkg_rms = background_map(data, weight=weight, back_size=back_size, filter_size=filter_size)
+        if background is None:
+            background = bkg
+        if rms is None:
+            rms = bkg_rms
+    sub = data - background
+    if weight is not None:
+        sub[weight <= 0] = 0.
+    if kernel is not None:
+        filtered = ndimage.convolve(sub, kernel, mode='constant')
+    else:
+        filtered = sub
+    if absolute_thresh is not None:
+        level = absolute_thresh
+    else:
+        level = thresh*rms
+    detected = filtered > level
+    labels, n = ndimage.label(detected, structure=connectivity)
+    #drop small components
+    if n > 0:
+        area = np.bincount(labels.ravel())
+        small = area < minarea
+        small[0] = False
+        labels[small[labels]] = 0
+    #deblend each component into the final label image
+    out = np.zeros(labels.shape, dtype=np.int32)
+    n = 0
+    slices = ndimage.find_objects(labels)
+    for k in range(len(slices)):
+        if slices[k] is None:
+            continue
+        cut = slices[k]
+        component = labels[cut] == k + 1
+        floor = np.min(level[cut][component]) if np.ndim(level) > 0 else level
+        if deblend_mincont < 1:
+            parts = deblend(filtered[cut], component, floor, nthresh=deblend_nthresh, mincont=deblend_mincont, minarea=minarea)
+        else:
+            parts = component.astype(np.int32)
+        view = out[cut]
+        view[parts > 0] = parts[parts > 0] + n
+        n += parts.max()
+    return measure(sub, out, n), out
+
+#Centroids, bounding boxes and fluxes of the n objects in a label image.
+#Only the labelled pixels are visited, so the cost does not depend on the amount of background.
+def measure(sub, labels, n):
+    index = np.arange(1, n+1)
+    flat = np.flatnonzero(labels)
+    lab = labels.ravel()[flat]
+    values = sub.ravel()[flat].astype(np.float64)
+    (yy, xx) = np.divmod(flat, labels.shape[1])
+    npix = np.bincount(lab, minlength=n+1)[1:]
+    flux = np.bincount(lab, weights=values, minlength=n+1)[1:]
+    #peak: last value of each label after sorting by (label, value)
+    order = np.lexsort((values, lab))
+    peak = values[order][np.cumsum(npix) - 1] if n > 0 else np.zeros(0)
+    #flux-weighted barycentre over positive pixels; the geometric centre if there are none
+    positive = np.where(values > 0, values, 0.)
+    weight = np.bincount(lab, weights=positive, minlength=n+1)[1:]
+    good = weight > 0
+    norm = np.where(good, weight, 1.)
+    area = np.maximum(npix, 1)
+    x = np.where(good, np.bincount(lab, weights=positive*xx, minlength=n+1)[1:]/norm, np.bincount(lab, weights=xx, minlength=n+1)[1:]/area)
+    y = np.where(good, np.bincount(lab, weights=positive*yy, minlength=n+1)[1:]/norm, np.bincount(lab, weights=yy, minlength=n+1)[1:]/area)
+    xmin = np.zeros(n, dtype=np.int32)
+    xmax = np.zeros(n, dtype=np.int32)
+    ymin = np.zeros(n, dtype=np.int32)
+    ymax = np.zeros(n, dtype=np.int32)
+    slices = ndimage.find_objects(labels, max_label=n)
+    for k in range(n):
+        if slices[k] is None:
+            continue
+        (ys, xs) = slices[k]
+        (ymin[k], ymax[k]) = (ys.start + 1, ys.stop)
+        (xmin[k], xmax[k]) = (xs.start + 1, xs.stop)
+    return np.rec.fromarrays([index, x + 1., y + 1., xmin, xmax, ymin, ymax, flux, peak, npix],
+        names="NUMBER,X_IMAGE,Y_IMAGE,XMIN_IMAGE,XMAX_IMAGE,YMIN_IMAGE,YMAX_IMAGE,FLUX,PEAK,NPIX")
+
+#Label of the detection closest to the centre of the image, or 0 if there are none.
+def central_object(objects, shape):
+    if len(objects) == 0:
+        return 0
+    (ny, nx) = shape
+    d2 = (objects.X_IMAGE - 0.5*(nx+1))**2 + (objects.Y_IMAGE - 0.5*(ny+1))**2
+    return objects.NUMBER[np.argmin(d2)]
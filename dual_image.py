@@ -0,0 +1,81 @@
+'''
+Script Name: dual_image.py
+
+########### Description ##########
+
+Dual-image mode: the tiles of every filter are detected once, on a combined detection image, instead of each
+filter detecting its own objects and the catalogs being matched on the sky afterwards.
+
+make_detection_image combines the drizzled tiles of one pointing (e.g. f606w and f814w, which share the pixel
+grid) into their inverse-variance weighted mean,
+
+detection = sum(weight_b*image_b)/sum(weight_b),   detection weight = sum(weight_b)
+
+written with its weight map next to the first tile. GalaxyCatalog(..., detection=(detection, detection_weight))
+then runs SExtractor in dual-image mode (sex detection.fits,image.fits) for the bright and the faint pass, so
+every filter gets the same objects, positions, shapes and segmentation, and photometry (MAG_AUTO, FLUX_AUTO,
+MU_MAX, ...) measured in its own image. The NUMBER of an object is its row in the merged bright and faint
+catalog (renumbered after the merge), which is the same in every filter because the bright segmentation map and
+the faint filtering only depend on the detection. Cleaning keeps those NUMBERs instead of renumbering.
+
+assoc_catalogs.assoc_by_number then associates the objects whose NUMBER survived the cleaning and passes the
+assoc cuts in every filter, so there is no sky cross-match.
+
+########## Usage ##########
+
+python dual_image.py detection_606_17 f606w_tile_drz.fits f606w_tile_wht.fits f814w_tile_drz.fits f814w_tile_wht.fits
+
+or dual_image = True in run.py.
+'''
+
+import os
+import sys
+import numpy as np
+import pyfits
+import instrument
+
+#Inverse-variance weighted mean of the images (all on one pixel grid), computed block_rows rows at a time from
+#memory maps. Writes out_name + ".fits" and out_name + "_wht.fits" and returns their names.
+def make_detection_image(files, weight_files, out_name, block_rows=512):
+    with instrument.Stage("detection_image", tile=files[0]):
+        images = [pyfits.open(name, memmap=True) for name in files]
+        weights = [pyfits.open(name, memmap=True) for name in weight_files]
+        shape = images[0][0].data.shape
+        for hdulist in images + weights:
+            if hdulist[0].data.shape != shape:
+                raise ValueError("The tiles of a detection image must share the pixel grid: " + str(hdulist[0].data.shape) + " != " + str(shape))
+        detection = np.zeros(shape, dtype=np.float32)
+        detection_weight = np.zeros(shape, dtype=np.float32)
+        for start in range(0, shape[0], block_rows):
+            rows = slice(start, min(start + block_rows, shape[0]))
+            total = np.zeros((rows.stop - rows.start, shape[1]), dtype=np.float64)
+            total_weight = np.zeros_like(total)
+            for b in range(len(files)):
+                weight = np.asarray(weights[b][0].data[rows], dtype=np.float64)
+                total += weight*images[b][0].data[rows]
+                total_weight += weight
+            covered = total_weight > 0
+            detection[rows][covered] = total[covered]/total_weight[covered]
+            detection_weight[rows] = total_weight
+        header = images[0][0].header
+        for hdulist in images + weights:
+            hdulist.close()
+        detection_name = out_name + ".fits"
+        weight_name = out_name + "_wht.fits"
+        pyfits.PrimaryHDU(detection, header=header).writeto(detection_name, clobber=True)
+        pyfits.PrimaryHDU(detection_weight, header=header).writeto(weight_name, clobber=True)
+    return detection_name, weight_name
+
+#make_detection_image for every tile. image_lists and weight_lists hold one list per filter, in the same tile
+#order; the detection image of tile i is written as <out_dir>/detection_<i>. Returns [(detection, weight), ...].
+def make_detection_images(image_lists, weight_lists, out_dir="."):
+    detections = []
+    for i in range(len(image_lists[0])):
+        out_name = os.path.join(out_dir, "detection_" + str(i))
+        detections.append(make_detection_image([images[i] for images in image_lists], [weights[i] for weights in weight_lists], out_name))
+    return detections
+
+if __name__ == "__main__":
+    files = sys.argv[2::2]
+    weight_files = sys.argv[3::2]
+    print "Wrote", make_detection_image(files, weight_files, sys.argv[1])
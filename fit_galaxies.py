@@ -0,0 +1,289 @@
+'''
+Script Name: fit_galaxies.py
+
+Parametric fits of the postage stamps written by postage_stamps, as a replacement for the IDL fitting
+code. It reads the same input files as that code (made by modified_make_input: NAME, RA, DEC,
+DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL) and writes a RAWFIT table with the columns analyze_fitting uses:
+
+NAME, RA, DEC
+FIT_DVC, CHISQ_DVC, STAT_DVC           de Vaucouleurs
+FIT_SER, CHISQ_SER, STAT_SER           single Sersic (started from the de Vaucouleurs fit)
+FIT_EXPDVC, CHISQ_EXPDVC, STAT_EXPDVC  bulge + disk
+FLUXRATIO_EXPDVC                       bulge to total flux ratio
+
+The FIT_* arrays have the 8 parameters per profile described in modified_make_input: surface
+brightness at the half light radius, half light radius (semimajor axis, pixels), Sersic index, axis
+ratio, isophote shape (always 0), x and y of the centre (0-indexed stamp pixels) and position angle
+(radians counterclockwise from the x-axis). CHISQ_* is the reduced chi-square and STAT_* follows the
+MPFIT convention of the IDL code: 0 improper input or failed fit, 1-4 converged, 5 maximum number of
+iterations reached.
+
+Models are rendered with GalSim, convolved with the PSF stamp, and fitted with
+scipy.optimize.least_squares. Internally every profile is described by log flux, log radius, Sersic
+index, conformal shear (eta1, eta2) and centre, so that all parameters except the Sersic index are
+unbounded. Only pixels near the galaxy (its mask, grown by a few pixels) are fitted when a mask stamp exists.
+
+Galaxies are fitted in a pool of processes.
+
+########## Usage ##########
+
+fit_sample("assoc_606_01_input.fits", "/path/to/stamps_606_01/", "/path/to/output/", nproc=8)
+
+or
+
+python fit_galaxies.py <input.fits> <stamp directory> <output directory> [nproc] [filter]
+'''
+
+import galsim
+import numpy as np
+import pyfits
+import os
+import sys
+import time
+import multiprocessing
+from scipy import ndimage
+from scipy.optimize import least_squares
+from scipy.special import gammaincinv, gammaln
+from compressed_fits import image_hdus
+
+#Sersic index range supported by galsim.Sersic
+n_range = (0.3, 6.2)
+
+#Looser than the GalSim defaults; the stamps are small and the fit only needs relative accuracy
+gsparams = galsim.GSParams(folding_threshold=1.e-2, maxk_threshold=1.e-2)
+
+#least_squares status -> MPFIT status used by the IDL code
+status_map = {-1 : 0, 0 : 5, 1 : 1, 2 : 2, 3 : 3, 4 : 4}
+
+#log of the total flux of a Sersic profile with unit surface brightness at the half light radius,
+#semimajor axis a and axis ratio q: F = 2 pi n exp(b) b^(-2n) Gamma(2n) q a^2 I_e
+def log_sersic_norm(n, a, q):
+    b = gammaincinv(2.*n, 0.5)
+    return np.log(2*np.pi*n) + b - 2*n*np.log(b) + gammaln(2.*n) + np.log(q) + 2*np.log(a)
+
+#RAWFIT parameters of one profile -> internal [log F, log a, n, eta1, eta2, x, y]
+def to_internal(p):
+    (Ie, a, n, q, c, x, y, pa) = p
+    q = np.clip(q, 0.05, 1.)
+    a = max(a, 0.3)
+    eta = -np.log(q)
+    logF = np.log(max(Ie, 1.e-10)) + log_sersic_norm(n, a, q)
+    return np.array([logF, np.log(a), n, eta*np.cos(2*pa), eta*np.sin(2*pa), x, y])
+
+#internal parameters -> RAWFIT parameters of one profile
+def to_rawfit(u):
+    (logF, loga, n, eta1, eta2, x, y) = u
+    a = np.exp(loga)
+    q = np.exp(-np.hypot(eta1, eta2))
+    pa = 0.5*np.arctan2(eta2, eta1)
+    Ie = np.exp(logF - log_sersic_norm(n, a, q))
+    return np.array([Ie, a, n, q, 0., x, y, pa])
+
+class GalaxyFit:
+
+    def __init__(self, image, ivar, psf, mask=None, grow=3):
+        self.image = np.asarray(image, dtype=np.float64)
+        (self.ny, self.nx) = self.image.shape
+        weight = np.where(ivar > 0, ivar, 0.)
+        if mask is not None and mask.any():
+            fit_region = ndimage.binary_dilation(mask > 0, iterations=grow)
+            weight = weight*fit_region
+        self.sigma_inv = np.sqrt(weight)
+        self.nPixels = int((weight > 0).sum())
+        psf = np.asarray(psf, dtype=np.float64)
+        self.psf = galsim.InterpolatedImage(galsim.Image(psf/psf.sum(), scale=1.0), gsparams=gsparams)
+        self.model = galsim.ImageD(self.nx, self.ny, scale=1.0)
+        #centre of the drawn image in 0-indexed pixel coordinates
+        self.x0 = 0.5*(self.nx - 1)
+        self.y0 = 0.5*(self.ny - 1)
+
+    #Flux and flux-weighted centre of the fitted pixels, used to start the fits
+    def moments(self):
+        w = np.where(self.sigma_inv > 0, np.maximum(self.image, 0.), 0.)
+        flux = w.sum()
+        if flux <= 0:
+            return 1., self.x0, self.y0
+        (yy, xx) = np.indices(self.image.shape)
+        return flux, (w*xx).sum()/flux, (w*yy).sum()/flux
+
+    def render(self, components):
+        gals = []
+        for (logF, loga, n, eta1, eta2, x, y) in components:
+            q = np.exp(-np.hypot(eta1, eta2))
+            gal = galsim.Sersic(n, half_light_radius=np.exp(loga)*np.sqrt(q), flux=np.exp(logF), gsparams=gsparams)
+            gal = gal.shear(galsim.Shear(eta1=eta1, eta2=eta2)).shift(x - self.x0, y - self.y0)
+            gals.append(gal)
+        #the TinyTim PSF stamps already include the pixel response
+        galsim.Convolve(galsim.Add(gals), self.psf).drawImage(image=self.model, method='no_pixel')
+        return self.model.array
+
+    #Fits a model of one or more profiles. VAL and FIX are the 8*ncomp starting values and fixed flags
+    #from the input file. The starting fluxes are rescaled so that they add up to the image flux (split
+    #evenly if any surface brightness is 0), and a centre of (0,0) is replaced by the image centroid.
+    #Returns (RAWFIT parameters, reduced chi-square, status, flux of each profile).
+    def fit(self, VAL, FIX, max_nfev=400):
+        ncomp = len(VAL)/8
+        flux, xc, yc = self.moments()
+        components = []
+        free = []
+        lower = []
+        upper = []
+        for k in range(ncomp):
+            p = np.array(VAL[8*k:8*k+8], dtype=np.float64)
+            fix = FIX[8*k:8*k+8]
+            p[1] = np.clip(p[1], 0.5, 0.5*max(self.nx, self.ny))
+            p[2] = np.clip(p[2], n_range[0], n_range[1])
+            if p[5] == 0 and p[6] == 0:
+                p[5] = xc
+                p[6] = yc
+            components.append(to_internal(p))
+            #all profiles share the centre of the first one
+            free.append([fix[0] == 0, fix[1] == 0, fix[2] == 0,
+                         not (fix[3] == 1 and fix[7] == 1), not (fix[3] == 1 and fix[7] == 1),
+                         fix[5] == 0 and k == 0, fix[6] == 0 and k == 0])
+            lower.append([-np.inf, np.log(0.3), n_range[0], -np.inf, -np.inf, -np.inf, -np.inf])
+            upper.append([np.inf, np.log(self.nx + self.ny), n_range[1], np.inf, np.inf, np.inf, np.inf])
+        components = np.array(components)
+        if min(VAL[0::8]) <= 0:
+            components[:,0] = np.log(flux/ncomp)
+        else:
+            components[:,0] += np.log(flux) - np.log(np.exp(components[:,0]).sum())
+        free = np.array(free, dtype=bool)
+        lower = np.array(lower)[free]
+        upper = np.array(upper)[free]
+        x0 = np.clip(components[free], lower + 1.e-6, upper - 1.e-6)
+
+        def unpack(theta):
+            c = components.copy()
+            c[free] = theta
+            c[1:,5] = c[0,5]
+            c[1:,6] = c[0,6]
+            return c
+
+        def residuals(theta):
+            return ((self.render(unpack(theta)) - self.image)*self.sigma_inv).ravel()
+
+        try:
+            result = least_squares(residuals, x0, bounds=(lower, upper), x_scale='jac', max_nfev=max_nfev)
+        except Exception as e:
+            print "Fit failed:", e
+            return np.zeros(8*ncomp), np.nan, 0, np.zeros(ncomp)
+        best = unpack(result.x)
+        chisq = 2*result.cost/max(self.nPixels - len(x0), 1)
+        params = np.concatenate([to_rawfit(u) for u in best])
+        return params, chisq, status_map.get(result.status, 0), np.exp(best[:,0])
+
+#Image of a stamp file, compressed or not. A multiband stamp (postage_stamps.get_multiband_stamps) has one HDU
+#per band with FILTER in its header; filter picks the band, and is needed when there is more than one.
+def read_stamp(fname, filter=None):
+    f = pyfits.open(fname)
+    hdus = image_hdus(f)
+    if len(hdus) > 1 or filter is not None:
+        bands = [hdu for hdu in hdus if hdu.header.get('FILTER') == filter]
+        if len(bands) == 0:
+            f.close()
+            raise ValueError(fname + " has no HDU with FILTER = " + str(filter))
+        hdus = bands
+    data = hdus[0].data
+    f.close()
+    return data
+
+#Stamp file names by galaxy NAME in <stamp_dir>/images (<name>.0_<ra>_<dec>.processed.fits)
+def index_stamps(stamp_dir):
+    stamps = {}
+    for image in os.listdir(os.path.join(stamp_dir, "images")):
+        if not image.endswith(".processed.fits"):
+            continue
+        name = int(image.split("_")[0].split(".")[0])
+        stamps[name] = image[:len(image)-15]
+    return stamps
+
+#Fits DVC, SER and EXPDVC to one galaxy. Top-level so it can run in a multiprocessing pool.
+#job is (name, ra, dec, stamp root name, stamp_dir, DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL, filter)
+def fit_galaxy(job):
+    (name, ra, dec, root, stamp_dir, DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL, filter) = job
+    row = {'NAME' : name, 'RA' : ra, 'DEC' : dec,
+           'FIT_DVC' : np.zeros(8), 'CHISQ_DVC' : np.nan, 'STAT_DVC' : 0,
+           'FIT_SER' : np.zeros(8), 'CHISQ_SER' : np.nan, 'STAT_SER' : 0,
+           'FIT_EXPDVC' : np.zeros(16), 'CHISQ_EXPDVC' : np.nan, 'STAT_EXPDVC' : 0,
+           'FLUXRATIO_EXPDVC' : np.nan}
+    if root is None:
+        print "No stamp for galaxy", name
+        return row
+    try:
+        image = read_stamp(os.path.join(stamp_dir, "images", root + ".processed.fits"), filter)
+        ivar = read_stamp(os.path.join(stamp_dir, "ivar", root + ".wht.fits"), filter)
+        psf = read_stamp(os.path.join(stamp_dir, "psf", root + ".psf.fits"), filter)
+        mask_file = os.path.join(stamp_dir, "mask", root + ".processed.mask.fits")
+        mask = None
+        if os.path.exists(mask_file):
+            mask = read_stamp(mask_file, filter)
+        galaxy = GalaxyFit(image, ivar, psf, mask=mask)
+    except Exception as e:
+        print "Could not read stamps for galaxy", name, ":", e
+        return row
+    (row['FIT_DVC'], row['CHISQ_DVC'], row['STAT_DVC'], flux) = galaxy.fit(DVC_VAL, DVC_FIX)
+    #the Sersic fit starts from the de Vaucouleurs one, with the index free
+    if row['STAT_DVC'] != 0:
+        SER_VAL = row['FIT_DVC'].copy()
+    else:
+        SER_VAL = np.array(DVC_VAL, dtype=np.float64)
+    SER_FIX = np.array(DVC_FIX).copy()
+    SER_FIX[2] = 0
+    (row['FIT_SER'], row['CHISQ_SER'], row['STAT_SER'], flux) = galaxy.fit(SER_VAL, SER_FIX)
+    (row['FIT_EXPDVC'], row['CHISQ_EXPDVC'], row['STAT_EXPDVC'], flux) = galaxy.fit(EXPDVC_VAL, EXPDVC_FIX)
+    if row['STAT_EXPDVC'] != 0:
+        row['FLUXRATIO_EXPDVC'] = flux[0]/flux.sum()
+    return row
+
+def write_rawfit(rows, out_name):
+    cols = [pyfits.Column(name='NAME', format='J', array=np.array([r['NAME'] for r in rows], dtype=np.int32)),
+            pyfits.Column(name='RA', format='D', array=np.array([r['RA'] for r in rows])),
+            pyfits.Column(name='DEC', format='D', array=np.array([r['DEC'] for r in rows]))]
+    for (profile, nparams) in [('DVC', 8), ('SER', 8), ('EXPDVC', 16)]:
+        cols.append(pyfits.Column(name='FIT_' + profile, format=str(nparams) + 'D', array=np.array([r['FIT_' + profile] for r in rows]).reshape(len(rows), nparams)))
+        cols.append(pyfits.Column(name='CHISQ_' + profile, format='D', array=np.array([r['CHISQ_' + profile] for r in rows])))
+        cols.append(pyfits.Column(name='STAT_' + profile, format='J', array=np.array([r['STAT_' + profile] for r in rows], dtype=np.int32)))
+    cols.append(pyfits.Column(name='FLUXRATIO_EXPDVC', format='D', array=np.array([r['FLUXRATIO_EXPDVC'] for r in rows])))
+    hdu = pyfits.new_table(pyfits.ColDefs(cols))
+    hdu.writeto(out_name, clobber=True)
+
+#Fits rows start to end (exclusive) of an input file with galaxies from stamp_dir, in nproc processes.
+#The output is written to <out_dir>/RAWFIT<start>.<end-1>.fits, like the IDL code, and its name returned.
+#filter picks the band of multiband stamps (see read_stamp).
+def fit_sample(input_file, stamp_dir, out_dir, nproc=None, start=0, end=None, filter=None):
+    hdulist = pyfits.open(input_file)
+    data = hdulist[1].data
+    if end is None:
+        end = len(data)
+    stamps = index_stamps(stamp_dir)
+    jobs = []
+    for i in range(start, end):
+        name = int(data.field('NAME')[i])
+        jobs.append((name, data.field('RA')[i], data.field('DEC')[i], stamps.get(name), stamp_dir,
+                     np.array(data.field('DVC_FIX')[i]), np.array(data.field('DVC_VAL')[i]),
+                     np.array(data.field('EXPDVC_FIX')[i]), np.array(data.field('EXPDVC_VAL')[i]), filter))
+    hdulist.close()
+    print "Fitting", len(jobs), "galaxies from", input_file
+    s = time.time()
+    pool = multiprocessing.Pool(processes=nproc)
+    try:
+        rows = pool.map(fit_galaxy, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print "Time:", time.time()-s
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out_name = os.path.join(out_dir, "RAWFIT%05d.%05d.fits" % (start, end-1))
+    write_rawfit(rows, out_name)
+    return out_name
+
+if __name__ == "__main__":
+    nproc = None
+    if len(sys.argv) > 4:
+        nproc = int(sys.argv[4])
+    filter = None
+    if len(sys.argv) > 5:
+        filter = int(sys.argv[5])
+    fit_sample(sys.argv[1], sys.argv[2], sys.argv[3], nproc=nproc, filter=filter)
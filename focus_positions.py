@@ -67,7 +67,11 @@ import pyfits
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+import multiprocessing
 import galsim
+import detection
+import instrument
+from cleanutils import renumber
 from scipy.optimize import curve_fit
 
 '''
@@ -82,7 +86,8 @@ Steps:
 
 ###### Modify the filenames below to get TT fits files into GalSim image format. ######
 
-def get_tt_files(filter, root):
+#Focus position (um) -> TT field file name
+def get_tt_file_dict(filter, root):
     if filter == 606:
          focusDict = {-1 : root + "F606W_TT/TinyTim_f-1.fits",
                    -2 : root + "F606W_TT/TinyTim_f-2.fits",
@@ -120,6 +125,12 @@ def get_tt_files(filter, root):
                       5  : root + "F814W_TT/TinyTim_f5.fits"}
     else:
         raise ValueError("No data for input filter.")
+    return focusDict
+
+#With a store (image_store.ImageStore) the fields are read-only views of the shared copies instead of arrays of
+#this process
+def get_tt_files(filter, root, store=None):
+    focusDict = get_tt_file_dict(filter, root)
     tt_list = []
     for i in range(-10,6):
         tt_list.append(focusDict[i])
@@ -127,6 +138,10 @@ def get_tt_files(filter, root):
     tt_galsim_images = []
     for image in tt_list:
         print "importing image", i
+        if store is not None:
+            tt_galsim_images.append(galsim.Image(store.array(image)))
+            i += 1
+            continue
         f = pyfits.open(image)
         image_data = f[0].data 
         img = galsim.Image(image_data)
@@ -180,17 +195,30 @@ def run_sextractor_tt(file,output_params,out_name,clean=True):
     subprocess.call(["rm", config_fname])
     subprocess.call(["rm", param_fname])
 
+#In-process replacement for run_sextractor_tt: finds the star centroids of a noiseless TT field with
+#detection.detect and writes them (1-indexed, like SExtractor) to out_name as X_IMAGE Y_IMAGE columns.
+#The TT stars are isolated, so deblending is turned off (it would split the Airy rings off the cores).
+def find_tt_centroids(file, out_name, minarea=5):
+    f = pyfits.open(file)
+    data = f[0].data
+    f.close()
+    objects, labels = detection.detect(data, background=0., absolute_thresh=1e-10, minarea=minarea, kernel=None, deblend_mincont=1.)
+    out = open(out_name, "w")
+    out.write("#   1 X_IMAGE                Object position along x                                    [pixel]\n")
+    out.write("#   2 Y_IMAGE                Object position along y                                    [pixel]\n")
+    for i in range(len(objects)):
+        out.write("%11.3f %11.3f\n" % (objects.X_IMAGE[i], objects.Y_IMAGE[i]))
+    out.close()
+    return objects
+
 '''
 for key in tt_606:
     run_sextractor_tt(tt_606[key], output_params, "TinyTim_f" + str(key) + ".stars.dat", clean=True)
+or, without SExtractor:
+for key in tt_606:
+    find_tt_centroids(tt_606[key], "TinyTim_f" + str(key) + ".stars.dat")
 '''
 
-def renumber(catalog):
-    cat = asciidata.open(catalog)
-    for i in range(cat.nrows):
-        cat['NUMBER'][i] = i
-    cat.writeto(catalog)
-    
 def select_good_stars(catalog, out_name, nstars=10):
     renumber(catalog)
     cat = asciidata.open(catalog)
@@ -216,12 +244,15 @@ def select_good_stars(catalog, out_name, nstars=10):
         star_table[2][i] = r
     star_table.writeto(out_name)
 
-def get_subImages(image_star_table, image, stamp_size = 6.):
+def get_subImages(image_star_table, image, stamp_size = 6., store=None):
     subImages = []
     table = asciidata.open(image_star_table)
     #out_table = asciidata.create(4,table.nrows)
-    f = pyfits.open(image)
-    image_data = f[0].data
+    if store is not None:
+        image_data = store.array(image)
+    else:
+        f = pyfits.open(image)
+        image_data = f[0].data
     img = galsim.Image(image_data)
     for i in range(table.nrows):
         x0 = table[0][i]
@@ -297,9 +328,10 @@ def find_focus_position(focus_list, cost_list, plot=True):
         plt.show()
     return -b/(2*a), (1/(2*a**2))*np.sqrt(a**2*sigma_b**2 + b**2*sigma_a**2)   
     
-def getMoments(image_star_table, image, tt_galsim_images, tt_star_file, match_dist = 200., stamp_size = 6., plot=True):  
+#With interactive=False every star is accepted without writing Star*.fits or prompting (for batch runs and benchmarks)
+def getMoments(image_star_table, image, tt_galsim_images, tt_star_file, match_dist = 200., stamp_size = 6., plot=True, interactive=True, store=None):  
     #One subimage for each star
-    subImages = get_subImages(image_star_table, image, stamp_size = stamp_size)
+    subImages = get_subImages(image_star_table, image, stamp_size = stamp_size, store=store)
     #One centroid for each star
     tt_centroids = match_to_tt(image_star_table, tt_star_file, dist=match_dist)
     #One list of tt_subimages for each star
@@ -308,14 +340,16 @@ def getMoments(image_star_table, image, tt_galsim_images, tt_star_file, match_di
     subImage_moments = []
     keep = []
     i = 10
-    for im in subImages:
-        im.write("Star" + str(i) + ".fits")
-        i += 1
+    if interactive:
+        for im in subImages:
+            im.write("Star" + str(i) + ".fits")
+            i += 1
     i = 10
     for im in subImages:
-        print "View image", "Star" + str(i) + ".fits"
-        accept = ""
-        accept = raw_input("Accept? (y/n) -->")
+        accept = "y"
+        if interactive:
+            print "View image", "Star" + str(i) + ".fits"
+            accept = raw_input("Accept? (y/n) -->")
         if accept == "y":
             print "Input accepted."
             try:
@@ -341,28 +375,59 @@ def getMoments(image_star_table, image, tt_galsim_images, tt_star_file, match_di
         tt_moment_lists.append(tt_moments)
     cost = np.asarray(get_cost(subImage_moments, tt_moment_lists))
     focus, focus_err = find_focus_position(np.asarray(range(-10,6)), cost, plot=plot)
-    subprocess.call(["rm", "-rf", "Star*.fits"])
+    if interactive:
+        subprocess.call("rm -f Star*.fits", shell=True)
     return focus, len(keep)
 
-def focus(catalogs, filenames, tt_galsim_images, tt_star_file, out_name, match_dist = 200., stamp_size = 6., nstars=20, plot=False, generate_new_star_files=True, histogram = True):
+#The TT images of focus() for its worker processes, which inherit them when they are forked, so TT images from
+#get_tt_files(..., store) are not copied for each worker
+_tt_galsim_images = []
+
+#Top-level for multiprocessing: job is (catalog, filename, tt_star_file, match_dist, stamp_size, store)
+def _tile_focus(job):
+    (catalog, filename, tt_star_file, match_dist, stamp_size, store) = job
+    return getMoments(catalog+".stars", filename, _tt_galsim_images, tt_star_file, match_dist=match_dist, stamp_size=stamp_size, plot=False, interactive=False, store=store)
+
+#With processes (and interactive=False, plot=False) the tiles are measured in that many worker processes. A
+#store (image_store.ImageStore) has the tiles read through it and should have made tt_galsim_images too.
+def focus(catalogs, filenames, tt_galsim_images, tt_star_file, out_name, match_dist = 200., stamp_size = 6., nstars=20, plot=False, generate_new_star_files=True, histogram = True, interactive=True, store=None, processes=None):
     if generate_new_star_files:
         n = 0
         for catalog in catalogs:
-            select_good_stars(catalog, catalog+".stars", nstars=nstars)
-            print "generating star file", n
+            with instrument.Stage("select_stars", rows_in=catalog, tile=filenames[n]) as s:
+                select_good_stars(catalog, catalog+".stars", nstars=nstars)
+                s.rows_out = catalog+".stars"
             n += 1
     foci = []
     err = []
+    results = None
+    if processes is not None and not interactive and not plot:
+        global _tt_galsim_images
+        _tt_galsim_images = tt_galsim_images
+        jobs = [(catalogs[i], filenames[i], tt_star_file, match_dist, stamp_size, store) for i in range(len(filenames))]
+        with instrument.Stage("focus", rows_in=len(filenames)) as s:
+            pool = multiprocessing.Pool(processes=processes)
+            try:
+                results = pool.map(_tile_focus, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            s.rows_out = sum(n for (f, n) in results)
     out = open(out_name, "w")
     for i in range(len(filenames)):
-        focus, focus_nstars = getMoments(catalogs[i]+".stars", filenames[i], tt_galsim_images, tt_star_file, match_dist=match_dist, stamp_size=stamp_size, plot=plot)
+        if results is not None:
+            focus, focus_nstars = results[i]
+        else:
+            with instrument.Stage("focus", rows_in=catalogs[i]+".stars", tile=filenames[i]) as s:
+                focus, focus_nstars = getMoments(catalogs[i]+".stars", filenames[i], tt_galsim_images, tt_star_file, match_dist=match_dist, stamp_size=stamp_size, plot=plot, interactive=interactive, store=store)
+                s.rows_out = focus_nstars
         print "Focus is", focus, "using", focus_nstars, "stars for calibration."
         out.write(filenames[i] + " ")
         out.write(str(focus) + " ")
         out.write(str(focus_nstars) + "\n")
-        out.close()
         foci.append(focus)
         err.append(focus_nstars)
+    out.close()
     if histogram:
         plt.hist(foci, bins=20)
         plt.xlabel("focus position (um)")
@@ -377,13 +442,15 @@ def label_catalogs(focus_text_file, catalogs):
          split = line.split()
          filename = split[0]
          focus = np.float32(split[1])
-         catalog = asciidata.open(catalogs[n])
-         for i in range(catalog.nrows):
-              catalog['FILENAME'][i] = filename
-              catalog['FOCUS'][i] = focus
-         catalog['FILENAME'].set_colcomment('Original name of image file for object')
-         catalog['FOCUS'].set_colcomment('Focus position in um')
-         catalog.writeto((catalogs[n])[:len(catalogs[n])-4] + ".focus.cat")
+         with instrument.Stage("label_focus", rows_in=catalogs[n], tile=filename) as s:
+              catalog = asciidata.open(catalogs[n])
+              for i in range(catalog.nrows):
+                   catalog['FILENAME'][i] = filename
+                   catalog['FOCUS'][i] = focus
+              catalog['FILENAME'].set_colcomment('Original name of image file for object')
+              catalog['FOCUS'].set_colcomment('Focus position in um')
+              catalog.writeto((catalogs[n])[:len(catalogs[n])-4] + ".focus.cat")
+              s.rows_out = catalog.nrows
          n += 1
 
 
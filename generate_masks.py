@@ -8,6 +8,10 @@ import matplotlib.pyplot as plt
 import time
 import subprocess
 import os
+import sys
+import multiprocessing
+import detection
+from compressed_fits import read_image, write_image
 
 faint_config_dict = { 'DETECT_MINAREA' : 18 ,
     'DETECT_THRESH' : 1.0 ,
@@ -40,7 +44,13 @@ output_params = ["NUMBER",
 "FLUXERR_AUTO"]  
 
 #Get an initial segmentation map for the postage stamps
-def run_sextractor(file,weight_file,use_dict=faint_config_dict,output_params=output_params,clean=True): 
+#The segmentation check image is written to mask_name and the catalog to cat_name. Both default to
+#the stamp's own directory, but absolute paths can be given so no chdir or mv is needed afterwards.
+def run_sextractor(file,weight_file,use_dict=faint_config_dict,output_params=output_params,clean=True,mask_name=None,cat_name=None): 
+    if mask_name is None:
+        mask_name = file[:len(file)-5] + ".mask.fits"
+    if cat_name is None:
+        cat_name = file + ".cat"
     #Create params_file and write out to a file
     param_ascii = asciidata.create(1,len(output_params))
     row_counter = 0
@@ -55,9 +65,9 @@ def run_sextractor(file,weight_file,use_dict=faint_config_dict,output_params=out
         
     #File-Specific Configurations
     config_ascii[0][0] = 'CATALOG_NAME'
-    config_ascii[1][0] = file + ".cat"
+    config_ascii[1][0] = cat_name
     config_ascii[0][1] = 'PARAMETERS_NAME'
-    config_ascii[1][1] = file + ".param"
+    config_ascii[1][1] = param_fname
     config_ascii[0][2] = 'WEIGHT_TYPE'
     config_ascii[1][2] = 'MAP_WEIGHT'
     config_ascii[0][3] = 'WEIGHT_IMAGE'
@@ -65,7 +75,7 @@ def run_sextractor(file,weight_file,use_dict=faint_config_dict,output_params=out
     config_ascii[0][4] = 'CHECKIMAGE_TYPE'
     config_ascii[1][4] = 'SEGMENTATION'
     config_ascii[0][5] = 'CHECKIMAGE_NAME'
-    config_ascii[1][5] = file[:len(file)-5] + ".mask.fits"
+    config_ascii[1][5] = mask_name
     row_counter = 6
     for key, value in use_dict.iteritems():
         config_ascii[0][row_counter] = key
@@ -78,61 +88,114 @@ def run_sextractor(file,weight_file,use_dict=faint_config_dict,output_params=out
     subprocess.call(["sex", file , "-c", config_fname])
     if clean:
         #Optional Clean
-        subprocess.call(["rm", config_fname])
-        subprocess.call(["rm", param_fname])
+        os.remove(config_fname)
+        os.remove(param_fname)
 
 #Make the "real" segmentation map by identifying the object detection in the center of the stamp.
-
-def make_seg_map(init_map):
+#The map is overwritten in place unless out_name is given, tile-compressed as compression says (see compressed_fits.py).
+def make_seg_map(init_map, out_name=None, compression=None):
+    if out_name is None:
+        out_name = init_map
     #identify centroid
-    hdulist = pyfits.open(init_map)
-    x_dim = int(hdulist[0].header['NAXIS1'])
-    y_dim = int(hdulist[0].header['NAXIS2'])
-    x_c = x_dim/2
-    y_c = y_dim/2
-    data = hdulist[0].data
-    mainObjNumber = data[y_c, x_c]
-    #Make an empty numpy array of zeros in those dimensions
-    segmentation_map_array = np.zeros((x_dim, y_dim))
-    for x in range(x_dim):
-        for y in range(y_dim):
-            if data[y,x] == mainObjNumber:
-                segmentation_map_array[y,x] = 1
+    data = read_image(init_map)
+    (y_dim, x_dim) = data.shape
+    mainObjNumber = data[y_dim/2, x_dim/2]
+    #Pixels belonging to the central detection are 1, everything else (including other objects) is 0.
+    #If nothing was detected at the center the mask is empty rather than the whole background.
+    if mainObjNumber == 0:
+        segmentation_map_array = np.zeros(data.shape, dtype=np.int16)
+    else:
+        segmentation_map_array = (data == mainObjNumber).astype(np.int16)
     #Write out to a fits file
-	hdu_out = pyfits.PrimaryHDU(segmentation_map_array)
-    hdu_out.writeto(init_map,clobber=True)
+    write_image(segmentation_map_array, out_name, kind="mask", compression=compression)
 
-#run_sextractor("/Users/bemi/JPL/606_01/images/0.0_214.233_52.44053.processed.fits", "/Users/bemi/JPL/606_01/ivar/0.0_214.233_52.44053.wht.fits")
-#make_seg_map("/Users/bemi/JPL/606_01/images/0.0_214.233_52.44053.processed.mask.fits")
+#Same mask as run_sextractor + make_seg_map, but detected in-process with detection.detect using the
+#faint configuration. The whole stamp is a single background mesh. No catalog is written.
+def make_seg_map_native(image, weight, out_name, use_dict=faint_config_dict, compression=None):
+    data = read_image(image)
+    weight_data = read_image(weight)
+    objects, labels = detection.detect(data, weight=weight_data, thresh=use_dict['DETECT_THRESH'],
+        minarea=use_dict['DETECT_MINAREA'], back_size=max(data.shape), filter_size=1,
+        deblend_nthresh=use_dict['DEBLEND_NTHRESH'], deblend_mincont=use_dict['DEBLEND_MINCONT'])
+    (y_dim, x_dim) = labels.shape
+    mainObjNumber = labels[y_dim/2, x_dim/2]
+    if mainObjNumber == 0:
+        segmentation_map_array = np.zeros(labels.shape, dtype=np.int16)
+    else:
+        segmentation_map_array = (labels == mainObjNumber).astype(np.int16)
+    write_image(segmentation_map_array, out_name, kind="mask", compression=compression)
 
-### Script to run ###
+#Runs SExtractor on a single stamp and writes its mask and catalog straight into mask_dir and cat_dir.
+#With native=True the mask is made in-process with make_seg_map_native instead.
+#Returns the name of the mask file.
+def make_mask(image, weight, mask_dir, cat_dir, clean=True, native=False, compression=None):
+    base = os.path.basename(image)
+    mask_name = os.path.join(mask_dir, base[:len(base)-5] + ".mask.fits")
+    if native:
+        make_seg_map_native(image, weight, mask_name, compression=compression)
+        return mask_name
+    cat_name = os.path.join(cat_dir, base + ".cat")
+    run_sextractor(image, weight, clean=clean, mask_name=mask_name, cat_name=cat_name)
+    make_seg_map(mask_name, compression=compression)
+    return mask_name
 
-f = open("data_directories.txt")
-directories = []
-for line in f.readlines():
-    directories.append(line.strip())
-f.close()    
+#multiprocessing needs a top-level function taking a single argument
+def _make_mask_star(args):
+    try:
+        return make_mask(*args)
+    except Exception as e:
+        print "Mask failed for", args[0], ":", e
+        return None
 
-root = "/Users/bemi/JPL/"
-for dir in ["606_01"]:
-    os.chdir(root + dir)
-    subprocess.call(["mkdir", "mask"])
-    subprocess.call(["mkdir", "cats"])
-    image_dir = root + dir + "/images/"
-    images = os.listdir(image_dir)
-    images = [str(image) for image in images]
-    os.chdir(root)
-    for image in images:
-        if image[len(image)-15:len(image)] != ".processed.fits":
+#Lists the postage stamps in <stamp_dir>/images that have a matching <stamp_dir>/ivar weight file.
+def list_stamps(stamp_dir):
+    image_dir = os.path.join(stamp_dir, "images")
+    ivar_dir = os.path.join(stamp_dir, "ivar")
+    stamps = []
+    for image in sorted(os.listdir(image_dir)):
+        if not image.endswith(".processed.fits"):
             continue
-        if image == ".DS_Store":
-            continue
-        im = root + dir + "/images/" + image
-        weight = root + dir + "/ivar/" + image[:len(image)-15] + ".wht.fits"
-        print im, weight
-        run_sextractor(im, weight)
-        map = image[:len(image)-15] + ".processed.mask.fits"
-        print root + dir + "/images/" + map
-        make_seg_map(root + dir + "/images/" + map)
-        subprocess.call(["mv", root + dir + "/images/" + map, "/Users/bemi/JPL/" + dir + "/mask"])
-        subprocess.call(["mv", root + dir + "/images/" + image + ".cat", "/Users/bemi/JPL/" + dir + "/cats"])
\ No newline at end of file
+        weight = image[:len(image)-15] + ".wht.fits"
+        stamps.append((os.path.join(image_dir, image), os.path.join(ivar_dir, weight)))
+    return stamps
+
+#Generates masks for every stamp in a stamp directory (with images/ and ivar/ subdirectories, as written
+#by postage_stamps). Masks go to <stamp_dir>/mask and SExtractor catalogs to <stamp_dir>/cats.
+#Stamps are processed in a pool of nproc processes (default: number of cores).
+#native=True detects in-process (see make_seg_map_native) instead of running SExtractor on every stamp.
+#compression sets the tile compression of the masks (see compressed_fits.py).
+def generate_masks(stamp_dir, nproc=None, clean=True, native=False, compression=None):
+    mask_dir = os.path.join(stamp_dir, "mask")
+    cat_dir = os.path.join(stamp_dir, "cats")
+    for d in [mask_dir, cat_dir]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    jobs = [(image, weight, mask_dir, cat_dir, clean, native, compression) for (image, weight) in list_stamps(stamp_dir)]
+    print "Generating", len(jobs), "masks in", stamp_dir
+    s = time.time()
+    pool = multiprocessing.Pool(processes=nproc)
+    try:
+        masks = pool.map(_make_mask_star, jobs, chunksize=max(1, len(jobs)/(8*(nproc or multiprocessing.cpu_count()))))
+    finally:
+        pool.close()
+        pool.join()
+    nFailed = masks.count(None)
+    print "Made", len(masks)-nFailed, "masks,", nFailed, "failed. Time:", time.time()-s
+    return masks
+
+### Script to run ###
+#python generate_masks.py <root> [data_directories.txt]
+#where the text file lists the stamp directories (relative to root) to process.
+
+if __name__ == "__main__":
+    root = sys.argv[1]
+    directory_file = "data_directories.txt"
+    if len(sys.argv) > 2:
+        directory_file = sys.argv[2]
+    f = open(directory_file)
+    directories = []
+    for line in f.readlines():
+        directories.append(line.strip())
+    f.close()
+    for dir in directories:
+        generate_masks(os.path.join(root, dir))
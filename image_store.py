@@ -0,0 +1,88 @@
+'''
+Script Name: image_store.py
+
+########### Description ##########
+
+Read-only store of the large images (the 16 TinyTim fields of each filter, the drz/wht tiles and segmentation
+maps) shared by every process that reads them, in place of each worker loading its own copy with pyfits.
+
+The first time an image is asked for, it is copied (block_rows rows at a time, decompressed if it is a
+tile-compressed file, in native byte order) to a .npy file in the store directory, named after the FITS file,
+its size and modification time. Every later request, in this or any other process, memory-maps that .npy
+read-only: the views handed out are zero-copy, and all the processes mapping the same image share its pages in
+the page cache, so n workers cost the memory of one copy (and only of the pages they touch), not n.
+
+A store pickles as its directory only, so it can be passed to multiprocessing workers, which map the images again
+on their side. Processes filling the store at the same time write under temporary names and rename, so a reader
+never maps a partial file.
+
+The store is a cache: delete the directory to free the disk space; images changed on disk are copied again.
+
+########## Usage ##########
+
+store = ImageStore("image_store")
+data = store.array("EGS_10134_01_acs_wfc_f606w_30mas_unrot_drz.fits")
+
+python image_store.py image_store file1.fits [file2.fits ...]
+
+fills the store ahead of a parallel run.
+'''
+
+import os
+import sys
+import hashlib
+import numpy as np
+import pyfits
+from compressed_fits import image_hdu
+
+class ImageStore:
+    def __init__(self, directory="image_store", block_rows=1024):
+        self.directory = directory
+        self.block_rows = block_rows
+        self.arrays = {}
+
+    #Only the directory crosses to another process; the memory maps are made again there
+    def __getstate__(self):
+        return {"directory" : self.directory, "block_rows" : self.block_rows, "arrays" : {}}
+
+    #The .npy copy of image k of fname, named after the file, its size and modification time
+    def npy_name(self, fname, k=0):
+        stat = os.stat(fname)
+        key = hashlib.sha1(repr((os.path.abspath(fname), k, stat.st_size, stat.st_mtime))).hexdigest()
+        return os.path.join(self.directory, os.path.basename(fname) + "." + key[:16] + ".npy")
+
+    #Read-only memory-mapped view of image k of fname, copied into the store the first time
+    def array(self, fname, k=0):
+        if (fname, k) not in self.arrays:
+            name = self.npy_name(fname, k)
+            if not os.path.exists(name):
+                self.add(fname, k, name)
+            self.arrays[(fname, k)] = np.load(name, mmap_mode="r")
+        return self.arrays[(fname, k)]
+
+    def add(self, fname, k, name):
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        f = pyfits.open(fname, memmap=True)
+        data = image_hdu(f, k).data
+        temporary = os.path.join(self.directory, "." + os.path.basename(name) + "." + str(os.getpid()) + ".tmp")
+        out = np.lib.format.open_memmap(temporary, mode="w+", dtype=data.dtype.newbyteorder("="), shape=data.shape)
+        for start in range(0, data.shape[0], self.block_rows):
+            out[start:start + self.block_rows] = data[start:start + self.block_rows]
+        out.flush()
+        del out, data
+        f.close()
+        os.rename(temporary, name)
+
+    #Drops this process's memory maps (the files stay in the store)
+    def close(self):
+        self.arrays = {}
+
+if __name__ == "__main__":
+    store = ImageStore(sys.argv[1])
+    for fname in sys.argv[2:]:
+        data = store.array(fname)
+        print fname, data.shape, data.dtype, "->", store.npy_name(fname)
@@ -0,0 +1,191 @@
+'''
+Script Name: instrument.py
+
+########### Description ##########
+
+Per-stage instrumentation for the pipeline. Every stage of HST_Sextractor_new, cleanutils, focus_positions,
+assoc_catalogs and postage_stamps runs inside
+
+with instrument.Stage("edge_clean", rows_in=snr_catalog, tile=file) as s:
+    ...
+    s.rows_out = edge_catalog
+
+and, once a log is configured, writes one JSON line per stage and tile with:
+
+stage, tile, parent    -- the stage name, the tile it ran on and the enclosing stage (stages nest, and a nested
+                          stage inherits the tile and any other fields of the stage around it)
+wall_s, user_s, sys_s  -- wall time and CPU time of this process
+child_user_s, ...      -- CPU time of the subprocesses (SExtractor, rm, ...) that finished during the stage
+maxrss_mb              -- peak resident memory of this process so far (the kernel only keeps a high-water mark)
+child_maxrss_mb        -- peak resident memory of the largest subprocess started through instrument.call
+                          during the stage (SExtractor runs go through it)
+rows_in, rows_out      -- objects going into and coming out of the stage. A catalog file name can be given
+                          instead of a number; it is counted when the stage starts (rows_in) or ends
+                          (rows_out), and only if the log is on.
+status                 -- "ok", or "failed" with the exception (the exception is re-raised)
+
+Stages named in CG_PROFILE are also profiled (see profiling.py).
+
+The log is off unless CG_INSTRUMENT_LOG is set to a file name or configure() is called, in which case records are
+appended to that file.
+
+########## Usage ##########
+
+python instrument.py pipeline_stages.jsonl
+
+prints the total time and peak memory per stage and the object attrition through the stages of each tile.
+'''
+
+import os
+import sys
+import time
+import json
+import errno
+import socket
+import resource
+import subprocess
+import profiling
+
+log_name = os.environ.get("CG_INSTRUMENT_LOG")
+_stack = []
+
+def configure(out_name):
+    global log_name
+    log_name = out_name
+
+def enabled():
+    return log_name is not None
+
+#Number of objects in an ascii catalog (lines that are neither comments nor blank)
+def count_rows(catalog):
+    n = 0
+    f = open(catalog)
+    for line in f:
+        if line[0] != "#" and line.strip() != "":
+            n += 1
+    f.close()
+    return n
+
+def _rows(value):
+    if value is None or not isinstance(value, basestring):
+        return value
+    if not os.path.exists(value):
+        return None
+    return count_rows(value)
+
+def _mb(kb):
+    return round(kb/1024., 1)
+
+#Drop-in for subprocess.call that waits with os.wait4, so that the peak memory of the child (e.g. SExtractor)
+#is charged to the enclosing stage.
+def call(args, **kwargs):
+    process = subprocess.Popen(args, **kwargs)
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    for s in _stack:
+        s.child_maxrss = max(s.child_maxrss, usage.ru_maxrss)
+    return process.returncode
+
+class Stage:
+    def __init__(self, name, rows_in=None, **fields):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.fields = fields
+        self.child_maxrss = 0
+
+    def __enter__(self):
+        if len(_stack) > 0:
+            parent = _stack[-1]
+            inherited = dict(parent.fields)
+            inherited.update(self.fields)
+            self.fields = inherited
+            self.parent = parent.name
+        else:
+            self.parent = None
+        _stack.append(self)
+        if enabled():
+            self.rows_in = _rows(self.rows_in)
+        self.start_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start = time.time()
+        self.profile = profiling.start(self.name, self.fields.get("tile"))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        profiling.stop(self.profile)
+        wall = time.time() - self.start
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _stack.remove(self)
+        if not enabled():
+            return False
+        record = dict(self.fields)
+        record.update({"stage" : self.name,
+                       "parent" : self.parent,
+                       "time" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+                       "host" : socket.gethostname(),
+                       "pid" : os.getpid(),
+                       "wall_s" : round(wall, 3),
+                       "user_s" : round(usage_self.ru_utime - self.start_self.ru_utime, 3),
+                       "sys_s" : round(usage_self.ru_stime - self.start_self.ru_stime, 3),
+                       "child_user_s" : round(usage_children.ru_utime - self.start_children.ru_utime, 3),
+                       "child_sys_s" : round(usage_children.ru_stime - self.start_children.ru_stime, 3),
+                       "maxrss_mb" : _mb(usage_self.ru_maxrss),
+                       "child_maxrss_mb" : _mb(self.child_maxrss),
+                       "rows_in" : _rows(self.rows_in),
+                       "rows_out" : _rows(self.rows_out)})
+        if exc_type is None:
+            record["status"] = "ok"
+        else:
+            record["status"] = "failed"
+            record["error"] = exc_type.__name__ + ": " + str(exc_value)
+        out = open(log_name, "a")
+        out.write(json.dumps(record, sort_keys=True) + "\n")
+        out.close()
+        return False
+
+def read_log(name):
+    f = open(name)
+    records = [json.loads(line) for line in f if line.strip() != ""]
+    f.close()
+    return records
+
+def summary(name):
+    records = read_log(name)
+    names = []
+    totals = {}
+    for record in records:
+        if record["stage"] not in totals:
+            names.append(record["stage"])
+            totals[record["stage"]] = [0, 0., 0., 0.]
+        total = totals[record["stage"]]
+        total[0] += 1
+        total[1] += record["wall_s"]
+        total[2] += record["user_s"] + record["child_user_s"]
+        total[3] = max(total[3], record["maxrss_mb"], record["child_maxrss_mb"])
+    print "%-24s %6s %12s %12s %12s" % ("#stage", "calls", "wall_s", "cpu_s", "maxrss_mb")
+    for stage_name in names:
+        total = totals[stage_name]
+        print "%-24s %6d %12.3f %12.3f %12.1f" % (stage_name, total[0], total[1], total[2], total[3])
+    tiles = []
+    for record in records:
+        if record.get("tile") is not None and record["tile"] not in tiles:
+            tiles.append(record["tile"])
+    for tile in tiles:
+        print "\n#attrition for", tile
+        for record in records:
+            if record.get("tile") == tile and (record["rows_in"] is not None or record["rows_out"] is not None):
+                print "%-24s %10s -> %-10s %s" % (record["stage"], record["rows_in"], record["rows_out"], record["status"])
+
+if __name__ == "__main__":
+    summary(sys.argv[1])
@@ -0,0 +1,254 @@
+'''
+Script Name: master_catalog.py
+
+########### Description ##########
+
+A single SQLite master catalog of every object of every tile and band, in place of reopening the per-tile ascii
+catalogs for each survey-wide question. The objects table has one row per catalog object, with every column of
+the ascii catalog (NUMBER, X_IMAGE, ..., IS_STAR, SNR, FILENAME, FOCUS, ASSOC as the pipeline added them) and:
+
+band      -- 606, 814, ...
+tile      -- the image file of the tile (FILENAME), or the catalog name if the catalog has no FILENAME yet
+catalog   -- the ascii catalog the row came from
+removed   -- 0 for objects in the clean catalog. Objects that cleaning removed can be ingested too (see
+             ingest_rejected), with REMOVED_EDGE for the edge cut and REMOVED_MASK for the diffraction-spike,
+             overlap and manual masks.
+cell_ra, cell_dec -- sky grid cell of (ALPHA_SKY, DELTA_SKY), cell_size degrees on a side
+list_index -- position of the catalog in its catalog list file (build sets it), which pairs the tiles of the
+             bands as assoc_all does
+
+Rows are indexed by (cell_dec, cell_ra), (band, tile) and (band, ASSOC), so cone and box searches, the per-tile
+association and the stamp selection are index range queries. Cone and box searches read the cells that cover
+the region and keep the objects inside it.
+
+associate() redoes assoc_all for every tile from the database (the multi-band matching of assoc_catalogs_multi,
+the same cuts and survey-unique ASSOC ids, the tiles of the bands paired by list_index) and writes ASSOC back to
+every band.
+
+########## Usage ##########
+
+python master_catalog.py build master.db f606w_catalogs.txt f814w_catalogs.txt [assoc]
+python master_catalog.py cone master.db ra dec radius_arcsec [band]
+
+build ingests every catalog of the catalog list files (the band is taken from the list name, e.g. f606w), with
+the objects cleaning removed from its _rejected.cat when there is one (606_17.focus.cat -> 606_17_rejected.cat),
+and, with assoc, associates all the bands. cone prints the objects within radius of (ra, dec).
+'''
+
+import os
+import re
+import sys
+import sqlite3
+import numpy as np
+import sextractor_io
+from assoc_catalogs import group_assoc
+from selection import assoc_selection
+
+REMOVED_EDGE = 1
+REMOVED_MASK = 2
+
+core_columns = ["band", "tile", "catalog", "removed", "cell_ra", "cell_dec", "list_index"]
+
+#Column names and rows (tuples of values) of an ascii catalog
+def read_catalog(catalog):
+    cat = sextractor_io.read_catalog(catalog)
+    return cat.names, zip(*[cat[name].tolist() for name in cat.names])
+
+class MasterCatalog:
+    def __init__(self, db_name, cell_size=10./3600):
+        self.db_name = db_name
+        self.connection = sqlite3.connect(db_name)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS objects (id INTEGER PRIMARY KEY, band INTEGER, tile TEXT, catalog TEXT, "
+                                "removed INTEGER DEFAULT 0, cell_ra INTEGER, cell_dec INTEGER)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)")
+        stored = self.connection.execute("SELECT value FROM settings WHERE key = 'cell_size'").fetchone()
+        if stored is None:
+            self.connection.execute("INSERT INTO settings VALUES ('cell_size', ?)", (cell_size,))
+            self.cell_size = cell_size
+        else:
+            self.cell_size = stored[0]
+        self.columns = [row[1] for row in self.connection.execute("PRAGMA table_info(objects)")]
+        self.add_columns(["list_index", "ALPHA_SKY", "DELTA_SKY", "NUMBER", "ASSOC"])
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sky ON objects (cell_dec, cell_ra)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS tiles ON objects (band, tile)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS assoc ON objects (band, ASSOC)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def add_columns(self, names):
+        for name in names:
+            if name not in self.columns:
+                self.connection.execute('ALTER TABLE objects ADD COLUMN "%s"' % name)
+                self.columns.append(name)
+
+    def cells(self, ra, dec):
+        return int(np.floor(ra/self.cell_size)), int(np.floor(dec/self.cell_size))
+
+    #Adds the rows of an ascii catalog, list_index-th in its catalog list. Re-ingesting a catalog replaces its rows.
+    def ingest(self, catalog, band, tile=None, removed=0, rows=None, names=None, list_index=None):
+        if rows is None:
+            names, rows = read_catalog(catalog)
+        self.add_columns(names)
+        if tile is None:
+            if "FILENAME" in names and len(rows) > 0:
+                tile = rows[0][names.index("FILENAME")]
+            else:
+                tile = catalog
+        if removed == 0:
+            self.connection.execute("DELETE FROM objects WHERE catalog = ? AND band = ?", (catalog, band))
+        ra_index = names.index("ALPHA_SKY")
+        dec_index = names.index("DELTA_SKY")
+        sql = "INSERT INTO objects (%s) VALUES (%s)" % (",".join(core_columns + ['"%s"' % name for name in names]),
+                                                        ",".join("?"*(len(core_columns) + len(names))))
+        values = []
+        for row in rows:
+            cell_ra, cell_dec = self.cells(float(row[ra_index]), float(row[dec_index]))
+            values.append([band, tile, catalog, removed, cell_ra, cell_dec, list_index] + list(row[:len(names)]))
+        self.connection.executemany(sql, values)
+        self.connection.commit()
+        return len(values)
+
+    #Adds the objects that cleaning removed from a tile, from the _rejected.cat catalog GalaxyCatalog.generate_catalog
+    #writes (its REJECTED_BY column names the cleaning step)
+    def ingest_rejected(self, rejected_catalog, band, tile=None, list_index=None):
+        names, rows = read_catalog(rejected_catalog)
+        reason = names.index("REJECTED_BY")
+        if tile is None:
+            tile = rejected_catalog
+            if "FILENAME" in names and len(rows) > 0:
+                tile = rows[0][names.index("FILENAME")]
+        self.connection.execute("DELETE FROM objects WHERE catalog = ? AND band = ?", (rejected_catalog, band))
+        edge_rows = [row for row in rows if row[reason] == "edge_clean"]
+        mask_rows = [row for row in rows if row[reason] != "edge_clean"]
+        n = self.ingest(rejected_catalog, band, tile, REMOVED_EDGE, edge_rows, names, list_index)
+        n += self.ingest(rejected_catalog, band, tile, REMOVED_MASK, mask_rows, names, list_index)
+        return n
+
+    def query(self, where="1", parameters=(), columns="*"):
+        cursor = self.connection.execute("SELECT %s FROM objects WHERE %s" % (columns, where), parameters)
+        names = [description[0] for description in cursor.description]
+        return names, cursor.fetchall()
+
+    #Objects with ra_min <= ALPHA_SKY <= ra_max and dec_min <= DELTA_SKY <= dec_max
+    def box(self, ra_min, ra_max, dec_min, dec_max, band=None, where="removed = 0", parameters=()):
+        cell_ra_min, cell_dec_min = self.cells(ra_min, dec_min)
+        cell_ra_max, cell_dec_max = self.cells(ra_max, dec_max)
+        sql = "cell_dec BETWEEN ? AND ? AND cell_ra BETWEEN ? AND ? AND ALPHA_SKY BETWEEN ? AND ? AND DELTA_SKY BETWEEN ? AND ? AND " + where
+        parameters = (cell_dec_min, cell_dec_max, cell_ra_min, cell_ra_max, ra_min, ra_max, dec_min, dec_max) + tuple(parameters)
+        if band is not None:
+            sql += " AND band = ?"
+            parameters += (band,)
+        return self.query(sql, parameters)
+
+    #Objects within radius (degrees) of (ra, dec)
+    def cone(self, ra, dec, radius, band=None, where="removed = 0", parameters=()):
+        dra = radius/max(np.cos(np.radians(min(abs(dec) + radius, 89.9))), 1e-6)
+        names, rows = self.box(ra - dra, ra + dra, dec - radius, dec + radius, band, where, parameters)
+        ra_index, dec_index = names.index("ALPHA_SKY"), names.index("DELTA_SKY")
+        keep = []
+        for row in rows:
+            dx = (row[ra_index] - ra)*np.cos(np.radians(dec))
+            dy = row[dec_index] - dec
+            if dx*dx + dy*dy <= radius*radius:
+                keep.append(row)
+        return names, keep
+
+    def tiles(self, band):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT tile FROM objects WHERE band = ? ORDER BY tile", (band,))]
+
+    #{list_index : tile} of the clean catalogs of a band
+    def list_tiles(self, band):
+        rows = self.connection.execute("SELECT DISTINCT list_index, tile FROM objects WHERE band = ? AND removed = 0 AND list_index IS NOT NULL", (band,))
+        return dict((row[0], row[1]) for row in rows)
+
+    #The tile the rows of a catalog were ingested under (the catalog name itself if it has none)
+    def catalog_tile(self, catalog, band):
+        row = self.connection.execute("SELECT tile FROM objects WHERE catalog = ? AND band = ? LIMIT 1", (catalog, band)).fetchone()
+        return catalog if row is None else row[0]
+
+    def column(self, band, tile, name, dtype=np.float64):
+        rows = self.connection.execute('SELECT "%s" FROM objects WHERE band = ? AND tile = ? AND removed = 0 ORDER BY id' % name, (band, tile)).fetchall()
+        return np.array([np.nan if row[0] is None else row[0] for row in rows], dtype=dtype)
+
+    def set_focus(self, band, tile, focus):
+        self.add_columns(["FOCUS"])
+        self.connection.execute("UPDATE objects SET FOCUS = ? WHERE band = ? AND tile = ?", (focus, band, tile))
+        self.connection.commit()
+
+    #assoc_catalogs_multi on the tiles of every band (the tiles with the same list_index, as assoc_all pairs the
+    #catalog lists; a band with no rows for an index takes part with no objects), with the assoc cuts on the
+    #columns ingested so far. The ids run on from first_id across the tiles, as assoc_all gives them. Returns the
+    #next free id.
+    def associate(self, bands, tolerance=1/18000., min_bands=None, first_id=0):
+        next_id = first_id
+        list_tiles = [self.list_tiles(band) for band in bands]
+        for index in sorted(set(sum([tiles.keys() for tiles in list_tiles], []))):
+            tiles = [tiles.get(index) for tiles in list_tiles]
+            ids = []
+            alphas = []
+            deltas = []
+            goods = []
+            for band, tile in zip(bands, tiles):
+                ids.append(self.column(band, tile, "id", np.int64))
+                alphas.append(self.column(band, tile, "ALPHA_SKY"))
+                deltas.append(self.column(band, tile, "DELTA_SKY"))
+                names = [name for name in assoc_selection.columns() if name in self.columns]
+                goods.append(assoc_selection.passes(dict((name, self.column(band, tile, name)) for name in names), names))
+            assocs, n = group_assoc(alphas, deltas, goods, next_id, tolerance, min_bands)
+            for band, tile in zip(bands, tiles):
+                if tile is not None:
+                    self.connection.execute("UPDATE objects SET ASSOC = -1 WHERE band = ? AND tile = ?", (band, tile))
+            updates = []
+            for b in range(len(bands)):
+                associated = np.where(assocs[b] >= 0)[0]
+                updates += [(int(assocs[b][k]), int(ids[b][k])) for k in associated]
+            self.connection.executemany("UPDATE objects SET ASSOC = ? WHERE id = ?", updates)
+            next_id += n
+        self.connection.commit()
+        return next_id
+
+    #The associated objects of one tile and band that postage_stamps cuts
+    def stamp_objects(self, band, tile):
+        return self.query("band = ? AND tile = ? AND removed = 0 AND ASSOC >= 0 ORDER BY id", (band, tile))
+
+def band_from_name(name):
+    found = re.search("f([0-9]{3})w", os.path.basename(name))
+    return int(found.group(1))
+
+#The _rejected.cat GalaxyCatalog.generate_catalog writes next to a catalog: 606_17.focus.cat -> 606_17_rejected.cat
+def rejected_name(catalog):
+    return os.path.join(os.path.dirname(catalog), os.path.basename(catalog).split(".")[0] + "_rejected.cat")
+
+def build(db_name, catalog_list_files, assoc=False):
+    master = MasterCatalog(db_name)
+    bands = []
+    for list_file in catalog_list_files:
+        band = band_from_name(list_file)
+        bands.append(band)
+        f = open(list_file)
+        catalogs = [line.strip() for line in f.readlines() if line.strip() != ""]
+        f.close()
+        for i in range(len(catalogs)):
+            print "Ingested", master.ingest(catalogs[i], band, list_index=i), "objects from", catalogs[i]
+            rejected = rejected_name(catalogs[i])
+            if os.path.exists(rejected):
+                tile = master.catalog_tile(catalogs[i], band)
+                print "Ingested", master.ingest_rejected(rejected, band, tile, i), "removed objects from", rejected
+    if assoc:
+        print master.associate(bands), "objects associated."
+    master.close()
+
+if __name__ == "__main__":
+    if sys.argv[1] == "build":
+        build(sys.argv[2], [arg for arg in sys.argv[3:] if arg != "assoc"], "assoc" in sys.argv[3:])
+    elif sys.argv[1] == "cone":
+        master = MasterCatalog(sys.argv[2])
+        band = int(sys.argv[6]) if len(sys.argv) > 6 else None
+        names, rows = master.cone(float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5])/3600., band)
+        print " ".join(names)
+        for row in rows:
+            print " ".join(str(value) for value in row)
+        master.close()
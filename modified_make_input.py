@@ -1,6 +1,10 @@
 import numpy as np
 import pyfits
+import asciidata
+import heapq
 import os
+import sys
+from compressed_fits import read_header
 
 '''
 f = open("data_directories.txt")
@@ -14,18 +18,17 @@ f = open("data_directories.txt")
        ...
 '''    
     
-def make_input(path, out_name):
-    #list of ids, ra, and dec, or whatever identifiers you use for the galaxies
-    #you would read this in from someplace else          
-    
-    ### Script to run ###
+#Galaxies from the stamp file names in a directory of postage stamps (<assoc>.0_<ra>_<dec>.processed.fits).
+#The stamp size is read from the header, so no pixels are loaded.
+#Returns lists of names, ra, dec and stamp sizes (in pixels on a side).
+def read_galaxies_from_stamps(path):
     names = []
     ra = []
     dec = []
-
+    sizes = []
     images = os.listdir(path)
     images = [str(image) for image in images]
-    for image in images:
+    for image in sorted(images):
         if image[len(image)-15:len(image)] != ".processed.fits":
             continue
         if image == ".DS_Store":
@@ -34,13 +37,194 @@ def make_input(path, out_name):
         name_string = split[0]
         ra_string = split[1]
         dec_string = split[2]
-        name = int(name_string[:len(name_string)-2])
+        name = int(name_string.split(".")[0])
         alpha = float(ra_string)
         split_dec = dec_string.split(".")
         delta = float(split_dec[0] + "." + split_dec[1])
+        header = read_header(os.path.join(path, image))
         names.append(name)
         ra.append(alpha)
         dec.append(delta)
+        sizes.append(max(header['NAXIS1'], header['NAXIS2']))
+    return names, ra, dec, sizes
+
+#Galaxies from an associated (.focus.cat) catalog: every row with an ASSOC id.
+#The stamp size is the one postage_stamps will cut, 2*4*FLUX_RADIUS + 1 pixels on a side.
+def read_galaxies_from_catalog(catalog):
+    names = []
+    ra = []
+    dec = []
+    sizes = []
+    cat = asciidata.open(catalog)
+    for i in range(cat.nrows):
+        assoc = cat['ASSOC'][i]
+        if assoc is None or assoc == -1:
+            continue
+        names.append(int(assoc))
+        ra.append(cat['ALPHA_SKY'][i])
+        dec.append(cat['DELTA_SKY'][i])
+        sizes.append(2*int(4.0*cat['FLUX_RADIUS'][i]) + 1)
+    return names, ra, dec, sizes
+
+#Estimated relative cost of fitting one galaxy. Every model evaluation is an FFT convolution over the
+#stamp, so the cost goes as npix*log(npix) with npix the number of stamp pixels.
+def fit_cost(stamp_size):
+    npix = np.asarray(stamp_size, dtype=np.float64)**2
+    return npix*np.log2(np.maximum(npix, 2.))
+
+#Splits galaxies into n_shards groups of nearly equal total cost (longest processing time first:
+#each galaxy, most expensive first, goes to the currently cheapest shard).
+#Returns a list of index arrays, each in increasing order.
+def balance_shards(costs, n_shards):
+    heap = [(0., k) for k in range(n_shards)]
+    shards = [[] for k in range(n_shards)]
+    for i in np.argsort(costs)[::-1]:
+        (total, k) = heapq.heappop(heap)
+        shards[k].append(i)
+        heapq.heappush(heap, (total + costs[i], k))
+    return [np.sort(np.asarray(shard, dtype=int)) for shard in shards]
+
+#Name of shard k of n for an output file name
+def shard_name(out_name, k, n_shards):
+    if n_shards == 1:
+        return out_name
+    root, ext = os.path.splitext(out_name)
+    return root + "_shard%02d" % k + ext
+
+#Parameters seeded from a previous fit: radius, Sersic index, axis ratio and position angle of each
+#profile. The surface brightness depends on the band and the centre on the stamp, so those are left
+#to the fitting code as for the defaults.
+seeded_parameters = [1,2,3,7]
+
+#Reads the NAME column and the requested fit columns from one or more RAWFIT output files.
+#Rows whose fits failed (STAT 0 or 5, as in analyze_fitting) or are not finite are dropped.
+def read_rawfit(rawfit_files, fit_name):
+    if isinstance(rawfit_files, str):
+        rawfit_files = [rawfit_files]
+    names = []
+    fits = []
+    for rawfit in rawfit_files:
+        hdulist = pyfits.open(rawfit)
+        data = hdulist[1].data
+        if 'FIT_' + fit_name not in data.columns.names:
+            hdulist.close()
+            continue
+        fit = np.array(data.field('FIT_' + fit_name), dtype=np.float64)
+        good = np.isfinite(fit).all(axis=1) & (fit[:,1] > 0)
+        if 'STAT_' + fit_name in data.columns.names:
+            stat = data.field('STAT_' + fit_name)
+            good &= (stat != 0) & (stat != 5)
+        names.append(np.array(data.field('NAME'), dtype=np.int64)[good])
+        fits.append(fit[good])
+        hdulist.close()
+    if len(names) == 0:
+        return np.zeros(0, dtype=np.int64), None
+    return np.concatenate(names), np.concatenate(fits)
+
+#Rows of names found in fit_names (by galaxy NAME), as (indices into names, indices into fit_names)
+def match_names(names, fit_names):
+    if len(fit_names) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    order = np.argsort(fit_names, kind='mergesort')
+    sorted_names = fit_names[order]
+    pos = np.clip(np.searchsorted(sorted_names, names), 0, len(sorted_names)-1)
+    found = sorted_names[pos] == names
+    return np.where(found)[0], order[pos[found]]
+
+#Fills the free parameters of the DVC and EXPDVC starting values from a finished fit, matched by galaxy NAME.
+#rawfit_files can be the RAWFIT output of the other band (FIT_DVC and FIT_EXPDVC are copied) or of a
+#single-Sersic pass (FIT_SER seeds the radius, axis ratio and angle of the de Vauc. and of both components
+#of the bulge+disk, with the bulge at half the Sersic radius; the component Sersic indices keep their
+#defaults). Galaxies without a good fit keep the defaults.
+#Returns the number of galaxies seeded.
+def seed_from_rawfit(names, rawfit_files, DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL):
+    names = np.asarray(names, dtype=np.int64)
+    seeded = np.zeros(len(names), dtype=bool)
+    p = np.array(seeded_parameters)
+    ser_names, ser = read_rawfit(rawfit_files, 'SER')
+    if ser is not None:
+        (i, j) = match_names(names, ser_names)
+        shape = np.array([1,3,7])
+        bulge = ser[j].copy()
+        bulge[:,1] *= 0.5
+        set_free(DVC_VAL, DVC_FIX, i, shape, ser[j][:,shape])
+        set_free(EXPDVC_VAL, EXPDVC_FIX, i, shape, bulge[:,shape])
+        set_free(EXPDVC_VAL, EXPDVC_FIX, i, shape+8, ser[j][:,shape])
+        seeded[i] = True
+    #the same profiles fitted in the other band take precedence
+    dvc_names, dvc = read_rawfit(rawfit_files, 'DVC')
+    if dvc is not None:
+        (i, j) = match_names(names, dvc_names)
+        set_free(DVC_VAL, DVC_FIX, i, p, dvc[j][:,p])
+        seeded[i] = True
+    expdvc_names, expdvc = read_rawfit(rawfit_files, 'EXPDVC')
+    if expdvc is not None:
+        (i, j) = match_names(names, expdvc_names)
+        set_free(EXPDVC_VAL, EXPDVC_FIX, i, np.concatenate([p, p+8]), expdvc[j][:,np.concatenate([p, p+8])])
+        seeded[i] = True
+    return seeded.sum()
+
+#VAL[rows, columns] = values, except where the parameter is fixed
+def set_free(VAL, FIX, rows, columns, values):
+    current = VAL[np.ix_(rows, columns)]
+    fixed = FIX[np.ix_(rows, columns)] == 1
+    VAL[np.ix_(rows, columns)] = np.where(fixed, current, values)
+
+#The default starting values and fixed parameters for n galaxies. See write_input for the meaning of the columns.
+def default_values(n):
+    #first profile will be de Vauc with only the isophote shape fixed
+    DVC_FIX = np.ndarray((n, 8))
+    DVC_VAL = np.ndarray((n, 8))
+    #second profile will be EXP+DVC with all the de Vauc. parameters except
+    #the normalization fixed
+    EXPDVC_FIX = np.ndarray((n, 16))
+    EXPDVC_VAL = np.ndarray((n, 16))
+    DVC_FIX[:,:] = [0,0,1,0,1,0,0,0]
+    #you need to pick starting values for the size, and the axis ratio
+    #starting values for the surface brightness and the position will
+    #be set in the code, don't set the flux to zero, as the code
+    #just rescales values (so can't rescale 0)
+    DVC_VAL[:,:] = [1.0,10.,4.0,0.7,0.0,0.0,0.0,0.1]
+    #for two component fits, always put the 'bulge' (smaller +higher sersic)
+    #profile first
+    EXPDVC_FIX[:,:] = [0,0,0,0,1,0,0,0,0,0,0,0,1,0,0,0]
+    #you'll have to source the fixed values from somewhere, either
+    #based on the radius, or based on previously fitting the profiles
+    #(see seed_from_rawfit)
+    EXPDVC_VAL[:,:] = [1.0, 78.9, 4.0, 0.75, 0.0, 0.0, 0.0, 2.1801,
+                       0.0, 100.0, 1.0, 0.75, 0.0, 0.0, 0.0, 2.2]
+    return DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL
+
+#Makes the input file(s) for the fitting code.
+#Galaxies are read from catalog (an associated catalog) if it is given, otherwise from the stamp names in path.
+#With n_shards > 1 the galaxies are split into that many files of balanced estimated cost, named
+#<out_name>_shard00.fits etc., so that as many fitter processes can run at once and finish together.
+#seed_rawfit (one or a list of RAWFIT files) warm-starts the fits from previous results, see seed_from_rawfit.
+#Returns the list of files written.
+def make_input(path, out_name, catalog=None, n_shards=1, seed_rawfit=None):
+    #list of ids, ra, and dec, or whatever identifiers you use for the galaxies
+    if catalog is not None:
+        names, ra, dec, sizes = read_galaxies_from_catalog(catalog)
+    else:
+        names, ra, dec, sizes = read_galaxies_from_stamps(path)
+    names = np.asarray(names, dtype=np.int32)
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    values = default_values(len(names))
+    if seed_rawfit is not None:
+        nSeeded = seed_from_rawfit(names, seed_rawfit, *values)
+        print "Seeded", nSeeded, "of", len(names), "galaxies from", seed_rawfit
+    costs = fit_cost(sizes)
+    out_files = []
+    for k, shard in enumerate(balance_shards(costs, n_shards)):
+        fname = shard_name(out_name, k, n_shards)
+        print "Writing", len(shard), "galaxies with estimated cost", costs[shard].sum(), "to", fname
+        write_input(fname, names[shard], ra[shard], dec[shard], values=[value[shard] for value in values])
+        out_files.append(fname)
+    return out_files
+
+#values is (DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL), by default from default_values
+def write_input(out_name, names, ra, dec, values=None):
     #now, if you don't want to use the default profiles with nothing held fixed
     #you need to set the input parameters here
     #the things to set are NAMEOFPROFILE_FIX, NAMEOFPROFILE_VAL
@@ -64,34 +248,14 @@ def make_input(path, out_name):
     #6 --y coordinate of center
     #7 --position angle (radians counterclockwise from x-axis)
     
-    #first profile will be de Vauc with only the isophote shape fixed
-    DVC_FIX = np.ndarray((len(names), 8))
-    DVC_VAL = np.ndarray((len(names), 8))
-    #second profile will be EXP+DVC with all the de Vauc. parameters except
-    #the normalization fixed
-    EXPDVC_FIX = np.ndarray((len(names), 16))
-    EXPDVC_VAL = np.ndarray((len(names), 16))
-    for i in range(len(names)):
-        DVC_FIX[i,:] = [0,0,1,0,1,0,0,0]
-        #you need to pick starting values for the size, and the axis ratio
-        #starting values for the surface brightness and the position will
-        #be set in the code, don't set the flux to zero, as the code
-        #just rescales values (so can't rescale 0)
-        DVC_VAL[i,:] = [1.0,10.,4.0,0.7,0.0,0.0,0.0,0.1]
-        #for two component fits, always put the 'bulge' (smaller +higher sersic)
-        #profile first
-        EXPDVC_FIX[i,:] = [0,0,0,0,1,0,0,0,0,0,0,0,1,0,0,0]
-        #you'll have to source the fixed values from somewhere, either
-        #based on the radius, or based on previously fitting the profiles
-        EXPDVC_VAL[i,:] = [1.0, 78.9, 4.0, 0.75, 0.0, 0.0, 0.0, 2.1801,
-                            0.0, 100.0, 1.0, 0.75, 0.0, 0.0, 0.0, 2.2]
-                            
-         #it might be good to have different input scripts, for example
-         #you could make 1 input file to fit the sersic/dvc profile and after
-         #that runs, make another file for the two component fits, which 
-         #takes the olds fits as inputs for the VALs arrays
+    if values is None:
+        values = default_values(len(names))
+    (DVC_FIX, DVC_VAL, EXPDVC_FIX, EXPDVC_VAL) = values
     
-
+    #it might be good to have different input scripts, for example
+    #you could make 1 input file to fit the sersic/dvc profile and after
+    #that runs, make another file for the two component fits, which 
+    #takes the olds fits as inputs for the VALs arrays (seed_from_rawfit)
 
     #put everything into FITS format
     col1 = pyfits.Column(name='NAME', format='J', array=names)
@@ -109,8 +273,21 @@ def make_input(path, out_name):
     hdu.writeto(out_name, clobber=True)
 
 
-f = open("data_directories.txt")
-for line in f.readlines():
-    dir = line.strip()
-    make_input("/Users/bemi/JPL/assoc_" + dir + "/images", "assoc_" + dir + "_input.fits")
 
+### Script to run ###
+#python modified_make_input.py <root> [n_shards] [seed RAWFIT file]
+#makes the input for every assoc_<dir> listed in data_directories.txt
+
+if __name__ == "__main__":
+    root = sys.argv[1]
+    n_shards = 1
+    seed_rawfit = None
+    if len(sys.argv) > 2:
+        n_shards = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        seed_rawfit = sys.argv[3]
+    f = open("data_directories.txt")
+    for line in f.readlines():
+        dir = line.strip()
+        make_input(os.path.join(root, "assoc_" + dir, "images"), "assoc_" + dir + "_input.fits", n_shards=n_shards, seed_rawfit=seed_rawfit)
+    f.close()
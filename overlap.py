@@ -4,6 +4,7 @@ import pyfits
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+from cleanutils import box_pairs
 
 image_map = {}
 check_map = {}
@@ -37,30 +38,29 @@ def delete_items(catalog, delete_numbers):
                 f.write(line)
     f.close()
     
+#True for each item (alpha,delta) that lies within tolerance of any base object
+def match_any(alpha, delta, base_alpha, base_delta, tolerance = 1./18000):
+    j, k = box_pairs(alpha, delta, base_alpha, base_delta, tolerance)
+    matched = np.zeros(len(alpha), dtype=bool)
+    matched[j] = True
+    return matched
+
 def check_adjacent(base_catalog, all_catalogs, check_indices, tolerance = 1./18000):
     nDeleted = 0
     base = asciidata.open(base_catalog)
     base_alpha = [base['ALPHA_SKY'][i] for i in range(base.nrows)]
     base_delta = [base['DELTA_SKY'][i] for i in range(base.nrows)]
     for index in check_indices:
-        nDeletedInd = 0
         print "Checking for overlaps in the base catalog", base_catalog
         print "Checking against catalog", all_catalogs[index]
         check = asciidata.open(all_catalogs[index])
         check_alpha = [check['ALPHA_SKY'][i] for i in range(check.nrows)]
         check_delta = [check['DELTA_SKY'][i] for i in range(check.nrows)]
         check_number = [check['NUMBER'][i] for i in range(check.nrows)]
-        delete_numbers = []
-        for j in range(check.nrows):
-            if j % 1000 == 0:
-                print "Checking item", j
-            item_alpha = check_alpha[j]
-            item_delta = check_delta[j]
-            item_bools = [(abs(item_alpha - base_alpha[k]) < tolerance and abs(item_delta - base_delta[k]) < tolerance) for k in range(base.nrows)]
-            if True in item_bools:
-                delete_numbers.append(check_number[j])
-                nDeleted += 1
-                nDeletedInd += 1
+        matched = match_any(check_alpha, check_delta, base_alpha, base_delta, tolerance)
+        delete_numbers = set(np.asarray(check_number)[matched])
+        nDeletedInd = np.count_nonzero(matched)
+        nDeleted += nDeletedInd
         print nDeletedInd, "objects were deleted in this check."
         delete_items(all_catalogs[index], delete_numbers)
     return nDeleted
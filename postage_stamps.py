@@ -1,3 +1,4 @@
+import os
 import galsim
 import numpy as np
 import pyfits
@@ -5,6 +6,13 @@ import asciidata
 import matplotlib.pyplot as plt
 import time
 import subprocess
+import multiprocessing
+from focus_positions import get_tt_file_dict, get_star_file
+import instrument
+from sextractor_io import read_catalog
+from async_writer import AsyncWriter
+import compressed_fits
+from scheduler import tile_footprint_mb
 
 class CatalogObject:
    x_axis_length = 7500
@@ -40,7 +48,7 @@ class CatalogObject:
        if not self.is_within_image():
            raise ValueError("The postage stamp is outside the CCD boundary.")
        else:
-           if image_data == None:
+           if image_data is None:
                f = pyfits.open(self.fname)
                image_data = f[0].data
                f.close()
@@ -54,6 +62,16 @@ class CatalogObject:
               b = galsim.BoundsI(self.leftBound, self.rightBound+1, self.bottomBound, self.topBound)
            stamp = im.subImage(b)
            return stamp
+
+   #Cuts the segmentation map of the whole tile at the same bounds as the image stamp, and relabels it
+   #so that pixels of the object at the stamp center are 1 and everything else is 0.
+   def mask_stamp(self, seg_data):
+       stamp = self.postage_stamp(image_data=seg_data)
+       label = central_label(seg_data, self.x, self.y)
+       mask = galsim.ImageS(stamp.bounds)
+       if label != 0:
+           mask.array[:,:] = (stamp.array == label)
+       return mask
         
    def get_TT_field(self, tt_dict):
         focus = int(np.round(self.focus))
@@ -93,17 +111,35 @@ class CatalogObject:
               b = galsim.BoundsI(self.left_tt, self.right_tt, self.bottom_tt, self.top_tt+1)
         if boundDifference == -1:
               b = galsim.BoundsI(self.left_tt, self.right_tt+1, self.bottom_tt, self.top_tt)
-        print "Getting tt-field"
-        s = time.time()
         tt_file = pyfits.open(tt_field)
         tt_data = tt_file[0].data
         tt_image = galsim.Image(tt_data)
         tt_file.close()
-        print "Image imported. Time=", time.time()-s
         sub = tt_image.subImage(b)  
         del tt_image
         return sub      
 
+#Label of the object at SExtractor position (x,y) in a segmentation map. If the centroid pixel itself is
+#background (possible for irregular objects), the most common label within 2 pixels of it is used instead.
+def central_label(seg_data, x, y, search=2):
+    i = int(np.round(y)) - 1
+    j = int(np.round(x)) - 1
+    label = seg_data[i,j]
+    if label != 0:
+        return label
+    near = seg_data[max(i-search,0):i+search+1, max(j-search,0):j+search+1]
+    near = near[near != 0]
+    if len(near) == 0:
+        return 0
+    labels, counts = np.unique(near, return_counts=True)
+    return labels[np.argmax(counts)]
+
+#The tile segmentation map written by GalaxyCatalog.generate_catalog for a catalog <out_name>.cat or <out_name>.focus.cat
+def segmentation_file(catalog):
+    if catalog.endswith(".focus.cat"):
+        return catalog[:len(catalog)-10] + ".seg.fits"
+    return catalog[:len(catalog)-4] + ".seg.fits"
+
 def snr_hist(catalog):
     cat = asciidata.open(catalog)
     snrs = []
@@ -117,24 +153,40 @@ def snr_hist(catalog):
     
 #snr_hist(test_catalog)
 
-def get_postage_stamps(catalog, file, weight, filter, out_name, out_path):
+#Masks are cut from the tile segmentation map (see segmentation_file) rather than by re-running SExtractor on each stamp.
+#PSF stamps are cut from the TT fields under tt_root (laid out as in focus_positions.get_tt_files).
+#The stamps are written by n_writers threads (async_writer.py) while the next ones are cut, and listed in index.txt
+#once all four files of an object are complete. compression sets the tile compression of each kind of stamp
+#(see compressed_fits.py; None writes them uncompressed).
+def get_postage_stamps(catalog, file, weight, filter, out_name, out_path, segmentation=None, tt_root=None, n_writers=4, compression=None):
+    if tt_root is None:
+        raise ValueError("tt_root is needed to cut the PSF stamps.")
+    directories = stamp_directories(out_path, out_name)
+    writer = AsyncWriter(n_writers, index_name=os.path.join(out_path, out_name, "index.txt"))
+    tt_dict = get_tt_file_dict(filter, tt_root)
+    tt_stars = get_star_file(filter, tt_root)
+    if segmentation is None:
+        segmentation = segmentation_file(catalog)
     cat = asciidata.open(catalog)
     print "Catalog opened."
     f = pyfits.open(file)
     g = pyfits.open(weight)
+    h = pyfits.open(segmentation)
     print "File opened."
-    image_data = f[0].data
-    weight_data = g[0].data
+    image_data = compressed_fits.image_hdu(f).data
+    weight_data = compressed_fits.image_hdu(g).data
+    seg_data = compressed_fits.image_hdu(h).data
     f.close()
     g.close()
+    h.close()
     image_hdulist = pyfits.HDUList()
     weight_hdulist = pyfits.HDUList()
     psf_hdulist = pyfits.HDUList()
+    mask_hdulist = pyfits.HDUList()
     snr_list = []
     nSets = 0
     nTotal = 0
     for i in range(cat.nrows):
-        print "Adding object", i
         ident = cat['NUMBER'][i]
         fname = cat['FILENAME'][i]
         fweight = fname[:len(fname)-8] + "wht.fits"
@@ -154,55 +206,51 @@ def get_postage_stamps(catalog, file, weight, filter, out_name, out_path):
         if assoc is None:
             continue
         object = CatalogObject(ident, fname, fweight, filter, x, y, ra, dec, radius, mag, focus, is_star, snr, assoc)
+        #The CCD boundary is the tile's own, not the 7500 x 7500 default
+        object.y_axis_length, object.x_axis_length = image_data.shape
         if object.assoc != -1 and \
            object.is_within_image():
             try:
                 img = object.postage_stamp(image_data=image_data)
                 weight = object.postage_stamp(image_data=weight_data)
-                psf = object.PSF()
+                psf = object.PSF(tt_dict, tt_stars)
+                mask = object.mask_stamp(seg_data)
             except:
                 continue
             img_data = img.array
             wht_data = weight.array 
             psf_data = psf.array
-            if len(image_hdulist) == 0 and len(psf_hdulist) == 0:
-                image_hdulist.append(pyfits.PrimaryHDU(data=img_data))
-                weight_hdulist.append(pyfits.PrimaryHDU(data=wht_data))
-                psf_hdulist.append(pyfits.PrimaryHDU(data=psf_data))
-            else:
-                image_hdulist.append(pyfits.ImageHDU(data=img_data))
-                weight_hdulist.append(pyfits.ImageHDU(data=wht_data))
-                psf_hdulist.append(pyfits.ImageHDU(data=psf_data))
+            mask_data = mask.array
+            image_hdulist = compressed_fits.image_hdulist([img_data], "images", compression)
+            weight_hdulist = compressed_fits.image_hdulist([wht_data], "ivar", compression)
+            psf_hdulist = compressed_fits.image_hdulist([psf_data], "psf", compression)
+            mask_hdulist = compressed_fits.image_hdulist([mask_data], "mask", compression)
             del img
             del weight
             del psf
+            del mask
             del object
             nTotal += 1
-        else:
-            print "Object skipped."
-        if len(image_hdulist) == 1:
-            try: 
-                 galsim.fits.writeFile(str(assoc) + ".0_" + str(ra) + "_" + str(dec) + ".processed.fits", image_hdulist, dir=out_path + out_name + "/images/")
-                 galsim.fits.writeFile(str(assoc) + ".0_" + str(ra) + "_" + str(dec) + ".wht.fits", weight_hdulist, dir=out_path + out_name + "/ivar/")
-                 galsim.fits.writeFile(str(assoc) + ".0_" + str(ra) + "_" + str(dec) + ".psf.fits", psf_hdulist, dir=out_path + out_name + "/psf/")
-            except:
-                 subprocess.call(["mkdir", out_path + out_name])
-                 subprocess.call(["mkdir", out_path + out_name + "/images/"])
-                 subprocess.call(["mkdir", out_path + out_name + "/ivar/"])
-                 subprocess.call(["mkdir", out_path + out_name + "/psf/"])
-                 galsim.fits.writeFile(str(assoc) + ".0_" + str(ra) + "_" + str(dec) + ".processed.fits", image_hdulist, dir=out_path + out_name + "/images/")
-                 galsim.fits.writeFile(str(assoc) + ".0_" + str(ra) + "_" + str(dec) + ".wht.fits", weight_hdulist, dir=out_path+ out_name + "/ivar/")
-                 galsim.fits.writeFile(str(assoc) + ".0_" + str(ra) + "_" + str(dec) + ".psf.fits", psf_hdulist, dir=out_path + out_name + "/psf/")
+        if len(image_hdulist) > 0:
+            stamp_name = str(assoc) + ".0_" + str(ra) + "_" + str(dec)
+            writer.write_fits(image_hdulist, os.path.join(directories["images"], stamp_name + ".processed.fits"))
+            writer.write_fits(weight_hdulist, os.path.join(directories["ivar"], stamp_name + ".wht.fits"))
+            writer.write_fits(psf_hdulist, os.path.join(directories["psf"], stamp_name + ".psf.fits"))
+            writer.write_fits(mask_hdulist, os.path.join(directories["mask"], stamp_name + ".processed.mask.fits"), index_line=stamp_name)
             del image_hdulist
             del weight_hdulist
             del psf_hdulist
+            del mask_hdulist
             image_hdulist = pyfits.HDUList()
             psf_hdulist = pyfits.HDUList()
             weight_hdulist = pyfits.HDUList()
+            mask_hdulist = pyfits.HDUList()
             nSets += 1
+    writer.close()
     print "total objects counted", nTotal
+    return nTotal
         
-def get_postage_stamps_all(catalog_list_file, image_list_file, filter, out_path, start=0):
+def get_postage_stamps_all(catalog_list_file, image_list_file, filter, out_path, start=0, tt_root=None, compression=None):
     f = open(catalog_list_file)
     lines = f.readlines()
     g = open(image_list_file)
@@ -210,6 +258,214 @@ def get_postage_stamps_all(catalog_list_file, image_list_file, filter, out_path,
     f.close()
     g.close()
     for i in range(start,len(lines)):
-        get_postage_stamps(lines[i].strip(), image_lines[i].strip(), (image_lines[i].strip())[:len(image_lines[i].strip())-8] + "wht.fits", filter, "stamps_" + image_lines[i].strip(), out_path)
+        with instrument.Stage("postage_stamps", rows_in=lines[i].strip(), tile=image_lines[i].strip()) as s:
+            s.rows_out = get_postage_stamps(lines[i].strip(), image_lines[i].strip(), (image_lines[i].strip())[:len(image_lines[i].strip())-8] + "wht.fits", filter, "stamps_" + image_lines[i].strip(), out_path, tt_root=tt_root, compression=compression)
     
-                
\ No newline at end of file
+                
+#Square bounds (xmin, xmax, ymin, ymax), inclusive and 1-indexed like galsim.BoundsI, of a stamp of half-size
+#stampL around (x,y). Same arithmetic as CatalogObject.postage_stamp.
+def stamp_bounds(x, y, stampL):
+    left, right = int(x - stampL), int(x + stampL)
+    bottom, top = int(y - stampL), int(y + stampL)
+    boundDifference = (right - left) - (top - bottom)
+    if boundDifference == 1:
+        top += 1
+    if boundDifference == -1:
+        right += 1
+    return left, right, bottom, top
+
+#Cuts bounds out of a (memory-mapped) array without touching the rest of it
+def cut_stamp(data, bounds, image_type=None):
+    left, right, bottom, top = bounds
+    array = np.array(data[bottom-1:top, left-1:right])
+    if image_type is not None:
+        array = array.astype(image_type)
+    return galsim.Image(array, xmin=left, ymin=bottom)
+
+#One band of a tile for get_multiband_stamps: the catalog rows by ASSOC id, and the image, weight and
+#segmentation map opened once as memory maps, so each stamp only reads its own pages. With a store
+#(image_store.ImageStore) the images and TT fields are its shared views instead.
+class BandTile:
+    def __init__(self, catalog, file, filter, tt_root, segmentation=None, store=None):
+        self.filter = filter
+        self.file = file
+        self.cat = read_catalog(catalog)
+        assoc = self.cat['ASSOC'] if self.cat.nrows > 0 else np.zeros(0, dtype=np.int64)
+        self.rows = dict((int(assoc[i]), i) for i in np.where(assoc >= 0)[0])
+        if segmentation is None:
+            segmentation = segmentation_file(catalog)
+        self.store = store
+        names = (file, file[:len(file)-8] + "wht.fits", segmentation)
+        if store is not None:
+            self.hdus = []
+            self.image_data, self.weight_data, self.seg_data = [store.array(name) for name in names]
+        else:
+            self.hdus = [pyfits.open(name, memmap=True) for name in names]
+            self.image_data, self.weight_data, self.seg_data = [compressed_fits.image_hdu(hdu).data for hdu in self.hdus]
+        self.tt_dict = get_tt_file_dict(filter, tt_root)
+        stars = np.loadtxt(get_star_file(filter, tt_root), ndmin=2, comments="#")
+        self.tt_x, self.tt_y = stars[:,0], stars[:,1]
+        self.tt_hdus = {}
+
+    def value(self, name, assoc):
+        return self.cat[name][self.rows[assoc]]
+
+    #TT field of a focus, opened once per tile
+    def tt_data(self, focus):
+        focus = int(np.round(focus))
+        if self.store is not None:
+            return self.store.array(self.tt_dict[focus])
+        if focus not in self.tt_hdus:
+            self.tt_hdus[focus] = pyfits.open(self.tt_dict[focus], memmap=True)
+        return self.tt_hdus[focus][0].data
+
+    #First TT star within 400 pixels of (x,y), as CatalogObject.find_nearest_centroid
+    def tt_centroid(self, x, y, match_dist=400.):
+        near = np.where((np.abs(self.tt_x - x) < match_dist) & (np.abs(self.tt_y - y) < match_dist))[0]
+        if len(near) == 0:
+            raise ValueError("No star found")
+        return self.tt_x[near[0]], self.tt_y[near[0]]
+
+    def inside(self, bounds):
+        left, right, bottom, top = bounds
+        ny, nx = self.image_data.shape
+        return left >= 1 and bottom >= 1 and right <= nx and top <= ny
+
+    def close(self):
+        for hdu in self.hdus + self.tt_hdus.values():
+            hdu.close()
+
+#The ASSOC ids found in every band of a tile, in order
+def common_assoc(bands):
+    common = set(bands[0].rows.keys())
+    for band in bands[1:]:
+        common &= set(band.rows.keys())
+    return sorted(common)
+
+#Bounds shared by the stamps of an object in every band: centred on the mean position of the object over the
+#bands and as large as the largest 4*FLUX_RADIUS (the bands of a tile share the pixel grid). Returns
+#(bounds, stampL), or None if the stamp is not inside every image.
+def object_bounds(bands, assoc):
+    x = np.mean([band.value('X_IMAGE', assoc) for band in bands])
+    y = np.mean([band.value('Y_IMAGE', assoc) for band in bands])
+    stampL = max(4.0*band.value('FLUX_RADIUS', assoc) for band in bands)
+    bounds = stamp_bounds(x, y, stampL)
+    if not all(band.inside(bounds) for band in bands):
+        return None
+    return bounds, stampL
+
+#Image, ivar and PSF stamps of an object in every band, {"images" : [...], "ivar" : [...], "psf" : [...]}
+def object_stamps(bands, assoc, bounds, stampL):
+    stamps = {"images" : [], "ivar" : [], "psf" : []}
+    for band in bands:
+        stamps["images"].append(cut_stamp(band.image_data, bounds))
+        stamps["ivar"].append(cut_stamp(band.weight_data, bounds))
+        x_tt, y_tt = band.tt_centroid(band.value('X_IMAGE', assoc), band.value('Y_IMAGE', assoc))
+        stamps["psf"].append(cut_stamp(band.tt_data(band.value('FOCUS', assoc)), stamp_bounds(x_tt, y_tt, stampL)))
+    return stamps
+
+#Mask stamps of an object in every band, cut from the segmentation maps (see CatalogObject.mask_stamp)
+def object_masks(bands, assoc, bounds):
+    masks = []
+    for band in bands:
+        seg = cut_stamp(band.seg_data, bounds)
+        label = central_label(band.seg_data, band.value('X_IMAGE', assoc), band.value('Y_IMAGE', assoc))
+        mask = galsim.ImageS(seg.bounds)
+        if label != 0:
+            mask.array[:,:] = (seg.array == label)
+        masks.append(mask)
+    return masks
+
+stamp_suffixes = {"images" : ".processed.fits", "ivar" : ".wht.fits", "psf" : ".psf.fits", "mask" : ".processed.mask.fits"}
+
+#The directories of each kind of stamp under out_path/out_name, made if needed
+def stamp_directories(out_path, out_name):
+    directories = {}
+    for kind in stamp_suffixes:
+        directories[kind] = os.path.join(out_path, out_name, kind)
+        if not os.path.isdir(directories[kind]):
+            os.makedirs(directories[kind])
+    return directories
+
+#Writes each kind of stamp of an object as one file with one HDU per band, named <assoc>.0_<ra>_<dec> as the
+#single-band stamps, through writer (an AsyncWriter) if
+#given. The object goes into the writer's index after its last file. A compressed file has an empty primary HDU
+#before the bands (read them with compressed_fits.image_hdus).
+def write_object_stamps(stamps, filters, assoc, ra, dec, directories, writer=None, compression=None):
+    kinds = sorted(stamps.keys())
+    for kind in kinds:
+        hdulist = compressed_fits.image_hdulist([stamp.array for stamp in stamps[kind]], kind, compression, [{'FILTER' : filter} for filter in filters])
+        name = str(assoc) + ".0_" + str(ra) + "_" + str(dec)
+        if writer is None:
+            galsim.fits.writeFile(name + stamp_suffixes[kind], hdulist, dir=directories[kind] + "/")
+        else:
+            writer.write_fits(hdulist, os.path.join(directories[kind], name + stamp_suffixes[kind]), index_line=name if kind == kinds[-1] else None)
+
+#Image, ivar, PSF and mask stamps of every associated object of one tile in every band, in one pass over the
+#association. The stamps of an object have the same bounds in every band (see object_bounds).
+#Each object is written as one file per kind under out_path/out_name/{images,ivar,psf,mask}/, with one HDU per
+#band in the order of filters (FILTER in each header), ready for galsim.ChromaticRealGalaxy.
+def get_multiband_stamps(catalogs, files, filters, out_name, out_path, tt_roots, segmentations=None, n_writers=4, compression=None, store=None):
+    if segmentations is None:
+        segmentations = [None]*len(catalogs)
+    bands = [BandTile(catalogs[b], files[b], filters[b], tt_roots[b], segmentations[b], store) for b in range(len(catalogs))]
+    directories = stamp_directories(out_path, out_name)
+    writer = AsyncWriter(n_writers, index_name=os.path.join(out_path, out_name, "index.txt"))
+    nTotal = 0
+    for assoc in common_assoc(bands):
+        found = object_bounds(bands, assoc)
+        if found is None:
+            continue
+        bounds, stampL = found
+        try:
+            stamps = object_stamps(bands, assoc, bounds, stampL)
+            stamps["mask"] = object_masks(bands, assoc, bounds)
+        except (ValueError, IndexError):
+            continue
+        write_object_stamps(stamps, filters, assoc, bands[0].value('ALPHA_SKY', assoc), bands[0].value('DELTA_SKY', assoc), directories, writer, compression)
+        nTotal += 1
+    writer.close()
+    for band in bands:
+        band.close()
+    print "total objects counted", nTotal
+    return nTotal
+
+#One tile of get_multiband_stamps_all, top-level for multiprocessing: job is (catalogs, files, filters, out_path,
+#tt_roots, compression, store)
+def _multiband_tile(job):
+    (catalogs, files, filters, out_path, tt_roots, compression, store) = job
+    with instrument.Stage("postage_stamps", rows_in=catalogs[0], tile=files[0]) as s:
+        s.rows_out = get_multiband_stamps(catalogs, files, filters, "stamps_" + os.path.basename(files[0]), out_path, tt_roots,
+                                          compression=compression, store=store)
+    return s.rows_out
+
+#get_multiband_stamps on every tile. The lists hold one entry per band (catalog and image list files, filters,
+#TT roots), with the tiles in the same order in every list. With processes the tiles are cut in that many worker
+#processes, which should share a store (image_store.ImageStore) so the TT fields are mapped once, not per worker.
+#With a scheduler (scheduler.Scheduler) the tiles run as its tasks instead, admitted within its memory budget.
+def get_multiband_stamps_all(catalog_list_files, image_list_files, filters, out_path, start=0, tt_roots=None, compression=None, store=None, processes=None, scheduler=None):
+    if tt_roots is None:
+        raise ValueError("tt_roots are needed to cut the PSF stamps.")
+    catalogs = []
+    images = []
+    for b in range(len(filters)):
+        f = open(catalog_list_files[b])
+        catalogs.append([line.strip() for line in f.readlines() if line.strip() != ""])
+        f.close()
+        g = open(image_list_files[b])
+        images.append([line.strip() for line in g.readlines() if line.strip() != ""])
+        g.close()
+    jobs = [([c[i] for c in catalogs], [im[i] for im in images], filters, out_path, tt_roots, compression, store)
+            for i in range(start, len(catalogs[0]))]
+    if scheduler is not None:
+        tt_file = get_tt_file_dict(filters[0], tt_roots[0])[0]
+        return scheduler.run([("postage_stamps", job[1][0], _multiband_tile, (job,), tile_footprint_mb("postage_stamps", job[1], job[0], tt_file))
+                              for job in jobs])
+    if processes is None:
+        return map(_multiband_tile, jobs)
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        return pool.map(_multiband_tile, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,140 @@
+'''
+Script Name: profiling.py
+
+########### Description ##########
+
+On-demand profiling of pipeline stages, without editing run.py. The stages are the ones instrument.py times
+(generate_catalog, sextractor_bright, ..., diffraction_mask, delete_overlap, focus, assoc, postage_stamps; see
+the stage field of the instrument log), and are chosen with environment variables:
+
+CG_PROFILE           comma-separated stage names to profile, or "all" (profiling is off if unset)
+CG_PROFILE_MODE      cprofile -- deterministic cProfile of every call, written as <name>.prof (pstats format)
+                     sample   -- statistical sampler: every CG_PROFILE_INTERVAL seconds of CPU time the current
+                                 Python stack is recorded, written as <name>.collapsed (one "frame;frame;... count"
+                                 line per stack, the input of flamegraph.pl and speedscope)
+                     both     -- both of the above (the default)
+CG_PROFILE_DIR       where the dumps go (default "profiles")
+CG_PROFILE_INTERVAL  sampling interval in seconds of CPU time (default 0.005)
+
+e.g. CG_PROFILE=diffraction_mask,focus,postage_stamps python run.py
+
+<name> is <stage>.<tile>.<pid>.<n>, so there is one dump per stage and tile. Only one stage is profiled at a time:
+a chosen stage nested in another chosen stage is covered by the outer profile. The sampler only sees CPU time of
+this process; time spent waiting on SExtractor shows up in the child_user_s of the instrument log instead.
+
+When CG_PROFILE is unset the only cost is a set lookup at the start of each stage.
+
+########## Usage ##########
+
+python profiling.py profiles [stage] [nlines=30]
+
+prints the functions with the most cumulative time over all the .prof dumps (of one stage, if given).
+'''
+
+import os
+import re
+import sys
+import glob
+import signal
+import cProfile
+import pstats
+
+stages = set(name.strip() for name in os.environ.get("CG_PROFILE", "").split(",") if name.strip() != "")
+mode = os.environ.get("CG_PROFILE_MODE", "both")
+out_dir = os.environ.get("CG_PROFILE_DIR", "profiles")
+interval = float(os.environ.get("CG_PROFILE_INTERVAL", "0.005"))
+_active = [None]
+_counter = [0]
+
+def wanted(stage_name):
+    return stage_name in stages or "all" in stages
+
+#Statistical profiler: a SIGPROF timer interrupts the process every interval seconds of CPU time and the
+#handler counts the Python stack it interrupted.
+class Sampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        #Restart system calls interrupted by the timer instead of failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def write(self, out_name):
+        f = open(out_name, "w")
+        for stack in sorted(self.counts.keys()):
+            f.write(stack + " " + str(self.counts[stack]) + "\n")
+        f.close()
+
+def dump_name(stage_name, tile):
+    if tile is None:
+        tile = "none"
+    tile = re.sub("[^A-Za-z0-9_.-]", "_", os.path.basename(str(tile)))
+    _counter[0] += 1
+    return os.path.join(out_dir, "%s.%s.%d.%d" % (stage_name, tile, os.getpid(), _counter[0]))
+
+#Starts profiling a stage; returns None (nothing to stop) if the stage is not chosen or another one is running
+def start(stage_name, tile=None):
+    if not wanted(stage_name) or _active[0] is not None:
+        return None
+    profile = {"name" : dump_name(stage_name, tile)}
+    if mode in ("sample", "both"):
+        profile["sampler"] = Sampler(interval)
+        profile["sampler"].start()
+    if mode in ("cprofile", "both"):
+        profile["cprofile"] = cProfile.Profile()
+        profile["cprofile"].enable()
+    _active[0] = profile
+    return profile
+
+def stop(profile):
+    if profile is None:
+        return
+    if "cprofile" in profile:
+        profile["cprofile"].disable()
+    if "sampler" in profile:
+        profile["sampler"].stop()
+    _active[0] = None
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if "cprofile" in profile:
+        profile["cprofile"].dump_stats(profile["name"] + ".prof")
+    if "sampler" in profile:
+        profile["sampler"].write(profile["name"] + ".collapsed")
+
+def report(profile_dir, stage_name=None, nlines=30):
+    pattern = "*.prof" if stage_name is None else stage_name + ".*.prof"
+    names = sorted(glob.glob(os.path.join(profile_dir, pattern)))
+    if len(names) == 0:
+        print "No profiles in", profile_dir
+        return
+    stats = pstats.Stats(names[0])
+    for name in names[1:]:
+        stats.add(name)
+    print len(names), "profiles"
+    stats.sort_stats("cumulative").print_stats(nlines)
+
+if __name__ == "__main__":
+    stage_name = None
+    nlines = 30
+    for arg in sys.argv[2:]:
+        if arg.startswith("nlines="):
+            nlines = int(arg.split("=", 1)[1])
+        else:
+            stage_name = arg
+    report(sys.argv[1], stage_name, nlines)
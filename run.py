@@ -2,14 +2,20 @@ import HST_Sextractor_new
 import overlap
 import assoc_catalogs
 import postage_stamps
+import instrument
+import selection
+import master_catalog
+import stream_pipeline
+import compressed_fits
+from dual_image import make_detection_images
+from image_store import ImageStore
+from scheduler import Scheduler, tile_footprint_mb
 import gc
 import time
 
 ### Modify the filenames and paths below to point to your images, etc. ###
 ### Required inputs are described below. ##
 
-#No functionality for more than 2 filters right now.
-n_filters = 2
 
 image_file = ["f606w_filenames.txt", "f814w_filenames.txt"] #Text file listing the names of the images, in the same order for both filters. 
 background_file = ["f606w_backgrounds.txt", "f814w_backgrounds.txt"] #Text file listing the names of the inverse weight files, in the same order for both filters.
@@ -19,11 +25,28 @@ out_name = ["f606w_example", "f814w_example"] #The outname prefixes of the inter
 tt_root_dir = ["/Users/bemi/JPL/", "/Users/bemi/JPL/"] #Where the TT files are stored.
 tt_star_file = [tt_root_dir[0] + "F606W_TT/606_stars.txt", tt_root_dir[1] + "F814W_TT/814_stars.txt"] #The full path name of where the TT centroid lists are. (Text file, x-centroid and y-centroid are the columns)
 catalog_list_file = ["f606w_catalogs.txt", "f814w_catalogs.txt"] #The name of the text file generated listing the names of all the catalogs.
+n_filters = len(filter)
 postage_stamp_path = "/Users/bemi/" #Where the script will put the postage stamps.
+stage_log = "pipeline_stages.jsonl" #Time, memory and object counts of every step of every tile are appended here. (None to turn off)
+master_catalog_file = "master.db" #SQLite catalog of every object in every tile and band, with a sky index (None to skip). See master_catalog.py.
+multiband_stamps = False #Cut the stamps of every filter of an associated object together, with the same bounds, into one file per object with one HDU per filter. (False for the separate stamps of each filter)
+dual_image = False #Detect every filter on one combined detection image (SExtractor dual-image mode, see dual_image.py), so the objects are the same in every filter and are associated by NUMBER instead of by position. (Needs the tiles of every filter on the same pixel grid)
+background_cache = None #Directory where the background and RMS maps of each tile are cached, so SExtractor does not measure them in both passes (replaces SExtractor's own background, which changes the catalogs). See background.py. None lets SExtractor measure them.
+subtiles = None #(n_x, n_y) to run SExtractor on n_x x n_y overlapping sub-tiles of each tile in parallel (e.g. (2, 2) on 4 cores). See subtiles.py. (None for one run per tile)
+stream_objects = False #Stream each associated galaxy through stamps, masks, a quality screen and the fitting input in one pass (stream_pipeline.py), writing the input of each tile every 500 galaxies as fit_input_<image>_part*.fits, to fit with that tile's stamps_<image> directory. (False for the stamps only)
+compression = None #Tile compression of the stamps, masks and segmentation maps: compressed_fits.lossless, compressed_fits.quantized (image and ivar stamps quantized to 16 levels per noise sigma, the rest lossless) or None for uncompressed files. See compressed_fits.py.
+image_store = None #Directory where the TT fields and tiles are kept as .npy files that every process memory-maps, so parallel workers share one copy of each (e.g. "image_store"). See image_store.py. (None to read them with pyfits in each process)
+stamp_processes = None #Number of worker processes cutting the multiband stamps of different tiles at once (None for one tile at a time). Use with image_store. Also caps the processes of memory_budget_mb (one per CPU if None).
+memory_budget_mb = None #Memory (MB) the tiles processed at once may use: catalog generation and the multiband stamps then run on several tiles in worker processes, admitted while their estimated footprints fit. See scheduler.py. (None for one tile at a time)
+schedule_log = "schedule.jsonl" #Where the scheduler's admission decisions are appended.
+early_selection = False #Drop the objects that fail the assoc cuts (selection.assoc_selection) as soon as their columns exist, instead of carrying them to assoc. False keeps every object, as before.
 
 ################### No need to modify code below this line for most users. ############################
 
-def get_focus_catalogs(image_file, background_file, filter, manual_mask_file, out_name, tt_root_dir, tt_star_file, catalog_list_file):
+if stage_log is not None:
+    instrument.configure(stage_log)
+
+def get_focus_catalogs(image_file, background_file, filter, manual_mask_file, out_name, tt_root_dir, tt_star_file, catalog_list_file, detections=None):
     #file import
     f = open(image_file)
     g = open(background_file)
@@ -46,46 +69,69 @@ def get_focus_catalogs(image_file, background_file, filter, manual_mask_file, ou
         #You should modify the names of the catalogs so each catalog has a unique identifier. This could just be the filename of the image. 
         #out_cat_name = files[i]
         out_cat_name = str(filter) + "_" + (files[i])[10:12]
-        cat = HST_Sextractor_new.GalaxyCatalog(files[i], backgrounds[i], filter, out_cat_name, manual_mask_file)
+        cat = HST_Sextractor_new.GalaxyCatalog(files[i], backgrounds[i], filter, out_cat_name, manual_mask_file,
+                                               selection=selection.assoc_selection if early_selection else None,
+                                               detection=None if detections is None else detections[i],
+                                               background_cache=background_cache, subtiles=subtiles, compression=compression)
         f.write(out_cat_name + ".focus.cat" + "\n")
-        cat.generate_catalog()
+        if scheduler is None:
+            cat.generate_catalog()
         catalogs.append(cat)
+    if scheduler is not None:
+        catalogs = scheduler.run([("generate_catalog", cat.file, HST_Sextractor_new.generate_catalog, (cat,), tile_footprint_mb("generate_catalog", [cat.file]))
+                                  for cat in catalogs])
     
     #adding focus positions    
     cat_list = HST_Sextractor_new.GalaxyCatalogList(catalogs, filter)
-    cat_list.add_focus(out_name + "_focus.txt", tt_root_dir)
+    cat_list.add_focus(out_name + "_focus.txt", tt_root_dir, store=store)
 
     #deleting duplicates from overlap
     #nDeleted = overlap.overlap_all(cat_list.catalogs)
     #print nDeleted, "objects deleted"
 
+store = None
+if image_store is not None:
+    store = ImageStore(image_store)
+
+scheduler = None
+if memory_budget_mb is not None:
+    scheduler = Scheduler(memory_budget_mb, processes=stamp_processes, log_name=schedule_log)
+
+detections = None
+if dual_image:
+    image_lists = []
+    background_lists = []
+    for i in range(n_filters):
+        f = open(image_file[i])
+        image_lists.append([line.strip() for line in f.readlines() if line.strip() != ""])
+        f.close()
+        g = open(background_file[i])
+        background_lists.append([line.strip() for line in g.readlines() if line.strip() != ""])
+        g.close()
+    detections = make_detection_images(image_lists, background_lists)
+
 for i in range(n_filters):
-    get_focus_catalogs(image_file[i], background_file[i], filter[i], manual_mask_file[i], out_name[i], tt_root_dir[i], tt_star_file[i], catalog_list_file[i])
+    get_focus_catalogs(image_file[i], background_file[i], filter[i], manual_mask_file[i], out_name[i], tt_root_dir[i], tt_star_file[i], catalog_list_file[i], detections)
     gc.collect()
     
 
 #associate catalogs
-catalogs_1 = []
-catalogs_2 = []
-f = open(catalog_list_file[0])
-g = open(catalog_list_file[1])
-for line in f.readlines():
-    catalogs_1.append(line.strip())
-for line in g.readlines():
-    catalogs_2.append(line.strip())
-f.close()
-g.close()
-
-for i in range(len(catalogs_1)):
-    s = time.time()
-    print "Associating catalog", i
-    assoc_catalogs.assoc_catalogs_opt(catalogs_1[i], catalogs_2[i])
-    print "Time:", time.time()-s
-
-#get postage stamps
+catalog_lists = []
 for i in range(n_filters):
-    postage_stamps.get_postage_stamps_all(catalog_list_file[i], image_file[i], filter[i], postage_stamp_path)
-    
+    f = open(catalog_list_file[i])
+    catalog_lists.append([line.strip() for line in f.readlines() if line.strip() != ""])
+    f.close()
 
+print assoc_catalogs.assoc_all(catalog_lists, by_number=dual_image), "objects associated in", n_filters, "filters."
 
+if master_catalog_file is not None:
+    master_catalog.build(master_catalog_file, catalog_list_file)
 
+#get postage stamps
+if stream_objects:
+    stream_pipeline.run(catalog_list_file, image_file, filter, tt_root_dir, postage_stamp_path, "fit_input.fits", compression=compression, store=store)
+elif multiband_stamps:
+    postage_stamps.get_multiband_stamps_all(catalog_list_file, image_file, filter, postage_stamp_path, tt_roots=tt_root_dir, compression=compression, store=store, processes=stamp_processes, scheduler=scheduler)
+else:
+    for i in range(n_filters):
+        postage_stamps.get_postage_stamps_all(catalog_list_file[i], image_file[i], filter[i], postage_stamp_path, tt_root=tt_root_dir[i], compression=compression)
@@ -0,0 +1,150 @@
+'''
+Script Name: scheduler.py
+
+########### Description ##########
+
+Runs tile-level work (catalog generation, stamp cutting) in worker processes, admitting a task only while the
+estimated memory of everything running fits in a budget, so several tiles can share a node without running it
+out of memory.
+
+The estimate of a stage on a tile comes from the image dimensions, the number of bands and objects and the size
+of the TT fields it holds (footprint_mb):
+
+generate_catalog -- 40 bytes per tile pixel (the image, weight, background-subtracted image and RMS map, the
+                    float64 mesh expansions and the segmentation map of the bright objects) and 2 kB per object
+                    (asciidata rows through the cleaning steps)
+postage_stamps   -- 12 bytes per pixel and band (the drz, wht and int32 segmentation map, read whole or
+                    memory-mapped and touched everywhere), one TT field per band (a tile has one focus) and 20 kB
+                    per object (catalog rows and stamps queued for writing)
+focus            -- 4 bytes per tile pixel and the 16 TT fields
+
+plus base_mb for the interpreter and its modules. tile_footprint_mb reads the dimensions from the FITS headers
+and counts the catalog rows. Pages of an image_store shared between workers are counted in every task, so the
+estimate errs on the safe side.
+
+Scheduler(budget_mb, processes).run(tasks) starts the tasks in submission order, first fit: a task that does not
+fit waits and the next ones that fit go ahead. A task larger than the whole budget runs, alone, once nothing
+else is running. Each worker process runs one task and exits, so its memory goes back to the system. Results
+come back in the order of the tasks; the first failure stops the rest and is raised.
+
+Every decision is printed and, with log_name, appended to that file as a JSON line:
+
+event        -- "admit", "wait" (logged once per task), "done" or "failed"
+task, tile   -- the task name and the tile
+memory_mb    -- the estimate of the task
+in_use_mb    -- the estimated memory of the tasks running after the decision
+budget_mb, running
+peak_mb      -- on "done", the peak resident memory the worker reached (to compare with the estimate)
+reason       -- on "admit", "fits" or "over budget, alone"
+
+########## Usage ##########
+
+scheduler = Scheduler(16000, processes=8, log_name="schedule.jsonl")
+memory = tile_footprint_mb("postage_stamps", [f606w_tile, f814w_tile], [f606w_catalog, f814w_catalog], tt_file)
+results = scheduler.run([("postage_stamps", f606w_tile, function, (args,), memory), ...])
+
+memory_budget_mb in run.py schedules catalog generation and the multiband stamps this way.
+'''
+
+import os
+import time
+import json
+import resource
+import multiprocessing
+import instrument
+from compressed_fits import read_header
+
+bytes_per_pixel = {"generate_catalog" : 40, "postage_stamps" : 12, "focus" : 4}
+bytes_per_object = {"generate_catalog" : 2048, "postage_stamps" : 20480, "focus" : 0}
+tt_fields = {"generate_catalog" : 0, "postage_stamps" : 1, "focus" : 16}
+base_mb = 150.
+
+#Estimated peak memory (MB) of a stage on a tile of shape pixels in n_bands bands with n_objects objects, holding
+#tt_fields[stage] float32 TT fields of tt_shape pixels per band
+def footprint_mb(stage, shape, n_objects=0, n_bands=1, tt_shape=(0, 0)):
+    tile = bytes_per_pixel[stage]*shape[0]*shape[1]
+    tt = tt_fields[stage]*4*tt_shape[0]*tt_shape[1]
+    return base_mb + (n_bands*(tile + tt) + bytes_per_object[stage]*n_objects)/2.**20
+
+#footprint_mb of a stage on the tiles of one pointing (one file per band), with the rows of the catalogs that
+#exist already and the dimensions of tt_file (any TT field of the filter)
+def tile_footprint_mb(stage, files, catalogs=None, tt_file=None):
+    header = read_header(files[0])
+    shape = (int(header['NAXIS2']), int(header['NAXIS1']))
+    n_objects = 0
+    for catalog in catalogs or []:
+        if os.path.exists(catalog):
+            n_objects += instrument.count_rows(catalog)
+    tt_shape = (0, 0)
+    if tt_file is not None:
+        tt_header = read_header(tt_file)
+        tt_shape = (int(tt_header['NAXIS2']), int(tt_header['NAXIS1']))
+    return footprint_mb(stage, shape, n_objects, len(files), tt_shape)
+
+#Top-level for multiprocessing: job is (function, args). Returns the result and the peak memory of the worker.
+def _run_task(job):
+    (function, args) = job
+    result = function(*args)
+    return result, round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024., 1)
+
+class Scheduler:
+    def __init__(self, budget_mb, processes=None, log_name=None, poll_s=0.5):
+        self.budget_mb = budget_mb
+        self.processes = processes or multiprocessing.cpu_count()
+        self.log_name = log_name
+        self.poll_s = poll_s
+
+    def log(self, event, task, in_use, running, **fields):
+        record = {"event" : event, "task" : task[0], "tile" : task[1], "memory_mb" : round(task[4], 1),
+                  "in_use_mb" : round(in_use, 1), "budget_mb" : self.budget_mb, "running" : running,
+                  "time" : time.strftime("%Y-%m-%dT%H:%M:%S")}
+        record.update(fields)
+        print "Scheduler:", event, task[0], task[1], "(%.0f MB, %.0f/%.0f MB in use, %d running)" % (task[4], in_use, self.budget_mb, running), fields.get("reason", "")
+        if self.log_name is not None:
+            out = open(self.log_name, "a")
+            out.write(json.dumps(record, sort_keys=True) + "\n")
+            out.close()
+
+    #Runs tasks, (name, tile, function, args, memory_mb) with function top-level, and returns their results in order
+    def run(self, tasks):
+        pool = multiprocessing.Pool(processes=self.processes, maxtasksperchild=1)
+        pending = range(len(tasks))
+        running = {}
+        waiting = set()
+        results = [None]*len(tasks)
+        in_use = 0.
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for k in list(pending):
+                    if len(running) >= self.processes:
+                        break
+                    task = tasks[k]
+                    if in_use + task[4] <= self.budget_mb or len(running) == 0:
+                        reason = "fits" if in_use + task[4] <= self.budget_mb else "over budget, alone"
+                        running[k] = pool.apply_async(_run_task, ((task[2], task[3]),))
+                        pending.remove(k)
+                        in_use += task[4]
+                        self.log("admit", task, in_use, len(running), reason=reason)
+                    elif k not in waiting:
+                        waiting.add(k)
+                        self.log("wait", task, in_use, len(running))
+                done = [k for k in running if running[k].ready()]
+                if len(done) == 0:
+                    time.sleep(self.poll_s)
+                    continue
+                for k in done:
+                    task = tasks[k]
+                    in_use -= task[4]
+                    try:
+                        results[k], peak = running.pop(k).get()
+                    except Exception, e:
+                        self.log("failed", task, in_use, len(running), error=type(e).__name__ + ": " + str(e))
+                        raise
+                    self.log("done", task, in_use, len(running), peak_mb=peak)
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        return results
@@ -0,0 +1,109 @@
+'''
+Script Name: selection.py
+
+########### Description ##########
+
+Declarative object selection, so that the quality cuts of the association can be applied as early in the
+pipeline as their columns exist instead of only in assoc_catalogs.
+
+A Selection is a list of Cuts, each (column + offset) <op> value, and a list of context cuts. Objects that pass a
+context cut are always kept, because later stages need them even though they are never candidates themselves:
+the stars, which make the diffraction-spike masks and calibrate the focus.
+
+assoc_selection holds the cuts of assoc_catalogs_opt:
+
+SNR > 20, MAG_AUTO + 21.1 < 22.5, 0 < FLUX_RADIUS < 500, IS_STAR == 0 (stars kept as context)
+
+Selection.keep evaluates every cut whose column is in the catalog, so it can run at any stage; nothing is dropped
+before the context columns exist. GalaxyCatalog.generate_catalog, given a selection, applies it to the catalog
+right after the star-galaxy classification (MAG_AUTO, FLUX_RADIUS and IS_STAR exist) and again as the first
+cleaning step after SNR is added, so the S/N, masking, overlap, focus labelling, assoc and stamp stages only see
+the candidates and the stars.
+
+Dropping the objects early changes one thing: an object that fails the cuts can no longer cause a candidate to be
+removed as its overlapping neighbour, or block it by being its first match in the other band.
+'''
+
+import numpy as np
+import instrument
+from sextractor_io import read_catalog, write_catalog
+
+operators = {">" : np.greater,
+             ">=" : np.greater_equal,
+             "<" : np.less,
+             "<=" : np.less_equal,
+             "==" : np.equal,
+             "!=" : np.not_equal}
+
+class Cut:
+    def __init__(self, column, op, value, offset=0.):
+        if op not in operators:
+            raise ValueError("Unknown operator " + op)
+        self.column = column
+        self.op = op
+        self.value = value
+        self.offset = offset
+
+    #columns is anything indexed by column name (a sextractor_io catalog, a dict of arrays)
+    def __call__(self, columns):
+        values = np.asarray(columns[self.column])
+        if self.offset != 0:
+            values = values + self.offset
+        return operators[self.op](values, self.value)
+
+    def __repr__(self):
+        offset = "" if self.offset == 0 else ("%+g" % self.offset)
+        return "%s%s %s %g" % (self.column, offset, self.op, self.value)
+
+class Selection:
+    def __init__(self, cuts, context=()):
+        self.cuts = list(cuts)
+        self.context = list(context)
+
+    def columns(self):
+        return sorted(set(cut.column for cut in self.cuts + self.context))
+
+    #The cuts that can be evaluated on the given column names
+    def ready(self, names):
+        return [cut for cut in self.cuts if cut.column in names]
+
+    def passes(self, columns, names=None):
+        if names is None:
+            names = columns.keys()
+        result = None
+        for cut in self.ready(names):
+            result = cut(columns) if result is None else result & cut(columns)
+        return result
+
+    #Candidates (every cut that can be evaluated passes) and context objects. Everything is kept until the
+    #context columns exist.
+    def keep(self, columns, names):
+        n = len(columns[names[0]])
+        if any(cut.column not in names for cut in self.context):
+            return np.ones(n, dtype=bool)
+        keep = self.passes(columns, names)
+        if keep is None:
+            return np.ones(n, dtype=bool)
+        for cut in self.context:
+            keep = keep | cut(columns)
+        return keep
+
+    def __repr__(self):
+        return "Selection(" + ", ".join(repr(cut) for cut in self.cuts) + "; context " + ", ".join(repr(cut) for cut in self.context) + ")"
+
+assoc_selection = Selection([Cut("SNR", ">", 20.),
+                             Cut("MAG_AUTO", "<", 22.5, offset=21.1),
+                             Cut("FLUX_RADIUS", ">", 0.),
+                             Cut("FLUX_RADIUS", "<", 500.),
+                             Cut("IS_STAR", "==", 0)],
+                            context=[Cut("IS_STAR", "==", 1)])
+
+#Rewrites a catalog in place with only the objects the selection keeps
+def apply_selection(catalog, selection):
+    with instrument.Stage("selection", rows_in=catalog) as s:
+        cat = read_catalog(catalog)
+        keep = selection.keep(cat, cat.names) if cat.nrows > 0 else np.zeros(0, dtype=bool)
+        write_catalog(cat, catalog, rows=keep)
+        s.rows_out = int(np.count_nonzero(keep))
+    print cat.nrows - s.rows_out, "objects dropped by", selection
+    return keep
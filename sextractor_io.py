@@ -0,0 +1,239 @@
+'''
+Script Name: sextractor_io.py
+
+########### Description ##########
+
+Fast reader and writer for SExtractor ASCII_HEAD catalogs (the .cat, .focus.cat, ... files of the pipeline),
+in place of opening them with asciidata, which reads and writes them cell by cell.
+
+read_catalog parses the "# n NAME comment" header once and loads the body in bulk into one NumPy array per
+column: int64 if every value of the column is an integer, float64 if every value is a number (a "Null" value
+becomes nan), and strings otherwise (e.g. FILENAME). Vector columns (a gap in the column numbers) are split into
+NAME, NAME_1, NAME_2, ... Rows whose first value is "Null" (rows asciidata blanked out) are dropped by default,
+as delete_null does.
+
+write_catalog writes the header lines as they were read and the rows as they were read, so a catalog that was
+read and written back is byte-for-byte the same, and a subset of rows is the same bytes as the corresponding
+lines. A column assigned with cat[name] = values is rewritten in its own field, right-aligned to the width it had
+and with the same number of decimals (or exponent format) as the values it replaces. New columns (add_column)
+get a SExtractor-style header line and are appended at the end of each row.
+
+########## Usage ##########
+
+cat = read_catalog("606_17.cat")
+good = cat['SNR'] > 20
+cat['NUMBER'] = np.arange(cat.nrows)
+write_catalog(cat, "606_17_good.cat", rows=good)
+'''
+
+import re
+import numpy as np
+
+header_re = re.compile(r"^#\s*(\d+)\s+(\S+)\s*(.*?)\s*$")
+token_re = re.compile(r"\S+")
+
+class Catalog:
+    def __init__(self, header, names, lines, columns, comments):
+        self.header = header
+        self.names = names
+        self.lines = lines
+        self.columns = columns
+        self.comments = comments
+        self.nrows = len(lines)
+        self.modified = set()
+        self.added = []
+        self.formats = {}
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        if name not in self.columns:
+            self.add_column(name, values)
+            return
+        values = np.asarray(values)
+        if len(values) != self.nrows:
+            raise ValueError("Column " + name + " needs " + str(self.nrows) + " values, got " + str(len(values)))
+        self.columns[name] = values
+        self.modified.add(name)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def add_column(self, name, values, comment="", format=None):
+        values = np.asarray(values)
+        if len(values) != self.nrows:
+            raise ValueError("Column " + name + " needs " + str(self.nrows) + " values, got " + str(len(values)))
+        self.names.append(name)
+        self.columns[name] = values
+        self.comments[name] = comment
+        self.added.append(name)
+        if format is not None:
+            self.formats[name] = format
+
+def typed_column(tokens):
+    try:
+        return tokens.astype(np.int64)
+    except ValueError:
+        pass
+    try:
+        return tokens.astype(np.float64)
+    except ValueError:
+        pass
+    null = tokens == "Null"
+    if np.any(null):
+        try:
+            values = np.where(null, "nan", tokens).astype(np.float64)
+            return values
+        except ValueError:
+            pass
+    return tokens
+
+def read_catalog(name, skip_null=True):
+    f = open(name)
+    all_lines = f.readlines()
+    f.close()
+    header = []
+    numbered = []
+    n_header = 0
+    for line in all_lines:
+        if line[:1] != "#":
+            break
+        header.append(line)
+        n_header += 1
+        found = header_re.match(line)
+        if found is not None:
+            numbered.append((int(found.group(1)), found.group(2), found.group(3)))
+    lines = []
+    for line in all_lines[n_header:]:
+        stripped = line.lstrip()
+        if stripped == "" or stripped[0] == "#":
+            continue
+        if skip_null and stripped[:4] == "Null" and (len(stripped) == 4 or stripped[4].isspace()):
+            continue
+        lines.append(line)
+    names = []
+    comments = {}
+    for k in range(len(numbered)):
+        index, column_name, comment = numbered[k]
+        width = numbered[k+1][0] - index if k + 1 < len(numbered) else 1
+        for j in range(max(width, 1)):
+            element = column_name if j == 0 else column_name + "_" + str(j)
+            names.append(element)
+            comments[element] = comment
+    split = [line.split() for line in lines]
+    if len(numbered) > 0 and len(split) > 0:
+        #The last column may be a vector column too: its length is only known from the rows
+        extra = len(split[0]) - len(names)
+        for j in range(1, extra + 1):
+            names.append(numbered[-1][1] + "_" + str(j))
+            comments[names[-1]] = numbered[-1][2]
+    for i in range(len(split)):
+        if len(split[i]) != len(names):
+            raise ValueError(name + ": row " + str(i + 1) + " has " + str(len(split[i])) + " values for " + str(len(names)) + " columns")
+    columns = {}
+    if len(split) > 0:
+        tokens = np.array(split, dtype=str)
+        for j in range(len(names)):
+            columns[names[j]] = typed_column(tokens[:,j])
+    else:
+        for column_name in names:
+            columns[column_name] = np.zeros(0)
+    return Catalog(header, names, lines, columns, comments)
+
+#printf format that writes a value like the token it replaces
+def token_format(token, value):
+    if isinstance(value, (int, long, np.integer)):
+        return "%d"
+    if isinstance(value, (float, np.floating)):
+        lower = token.lower()
+        if "e" in lower:
+            mantissa = lower.split("e")[0]
+            decimals = len(mantissa.split(".")[1]) if "." in mantissa else 0
+            return "%." + str(decimals) + "e"
+        if "." in token:
+            return "%." + str(len(token.split(".")[1])) + "f"
+        try:
+            int(token)
+            return "%.0f"
+        except ValueError:
+            return "%g"
+    return "%s"
+
+def python_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+#Replaces the tokens number j in fields with texts[j], right-aligned to the end of the token they replace
+def rewrite_line(line, fields, texts):
+    spans = []
+    last = fields[-1]
+    for match in token_re.finditer(line):
+        spans.append(match.span())
+        if len(spans) > last:
+            break
+    pieces = []
+    position = 0
+    for j in fields:
+        start, end = spans[j]
+        field_start = spans[j-1][1] + 1 if j > 0 else 0
+        pieces.append(line[position:field_start])
+        pieces.append(texts[j].rjust(end - field_start))
+        position = end
+    pieces.append(line[position:])
+    return "".join(pieces)
+
+#The values of a column as text, formatted like the column's token in the first row (SExtractor writes every
+#row of a column with the same format), or with the format given to add_column
+def column_texts(cat, name, rows):
+    values = cat.columns[name]
+    if len(rows) == 0:
+        return []
+    if name in cat.added:
+        format = cat.formats.get(name)
+        if format is None:
+            format = "%d" if values.dtype.kind in "iub" else ("%.6g" if values.dtype.kind == "f" else "%s")
+    else:
+        token = cat.lines[rows[0]].split()[cat.names.index(name)]
+        format = token_format(token, python_value(values[rows[0]]))
+    selected = values[rows]
+    texts = [format % value for value in selected.tolist()]
+    if selected.dtype.kind == "f":
+        for n in np.where(np.isnan(selected))[0]:
+            texts[n] = "Null"
+    return texts
+
+def header_line(index, name, comment):
+    return ("#%4d %-22s %s" % (index, name, comment)).rstrip() + "\n"
+
+#Writes the catalog (or the rows selected by a boolean mask or an index array)
+def write_catalog(cat, name, rows=None):
+    if rows is None:
+        rows = np.arange(cat.nrows)
+    else:
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.where(rows)[0]
+    original = [j for j in range(len(cat.names)) if cat.names[j] not in cat.added]
+    modified = sorted(j for j in original if cat.names[j] in cat.modified)
+    f = open(name, "w")
+    for line in cat.header:
+        f.write(line)
+    n_columns = len(original)
+    for name_added in cat.added:
+        n_columns += 1
+        f.write(header_line(n_columns, name_added, cat.comments[name_added]))
+    modified_texts = [column_texts(cat, cat.names[j], rows) for j in modified]
+    added_texts = [column_texts(cat, column_name, rows) for column_name in cat.added]
+    for n in range(len(rows)):
+        line = cat.lines[rows[n]]
+        if len(modified) > 0:
+            texts = {}
+            for k in range(len(modified)):
+                texts[modified[k]] = modified_texts[k][n]
+            line = rewrite_line(line, modified, texts)
+        if len(added_texts) > 0:
+            line = line.rstrip("\n") + " " + " ".join(texts_added[n] for texts_added in added_texts) + "\n"
+        f.write(line)
+    f.close()
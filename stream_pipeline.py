@@ -0,0 +1,211 @@
+'''
+Script Name: stream_pipeline.py
+
+########### Description ##########
+
+Object-level pipeline from the associated catalogs to the input of the fitting code, in one pass, instead of
+cutting every stamp of the survey (postage_stamps), then listing the stamp directories again for the masks
+(generate_masks) and the fitting input (modified_make_input).
+
+Each associated galaxy goes through the stages
+
+objects  -- the ASSOC ids found in every band of each tile (catalogs and images of every band, memory-mapped)
+stamps   -- image, ivar and PSF stamps with the same bounds in every band (postage_stamps.object_stamps)
+masks    -- mask stamps cut from the tile segmentation maps (postage_stamps.object_masks)
+screen   -- drops galaxies whose stamps have non-finite pixels, more than max_bad_fraction of zero-weight
+            pixels, or no object at the centre of the mask in some band
+write    -- writes the stamps as postage_stamps.get_multiband_stamps does, under out_path/stamps_<image>/ with its
+            index.txt, on a pool of writer threads (async_writer.py), tile-compressed as compression says
+            (compressed_fits.py)
+inputs   -- adds the galaxy to the fitting input of its tile (modified_make_input.write_input), written every
+            rows_per_file galaxies and at the end of the tile as <out_name>_<image>_part0000.fits, ..._part0001.fits,
+            ... Each part holds one tile, so it fits with that tile's stamp directory:
+            fit_galaxies.fit_sample(part, stamp_dir, out_dir) for every (part, stamp_dir) run returns.
+
+Every stage runs in its own thread and hands its output to the next through a queue of at most queue_size
+galaxies, so memory stays flat however large the survey is (the stages block on full queues) and the cutting,
+screening and writing overlap. The first input file is ready, with its stamps on disk, once rows_per_file
+galaxies of the first tile (or the whole first tile) are through, not after the whole survey.
+
+########## Usage ##########
+
+python stream_pipeline.py fit_input f606w_catalogs.txt,f814w_catalogs.txt f606w_filenames.txt,f814w_filenames.txt 606,814 tt_root606,tt_root814 out_path [rows_per_file=500] [queue_size=16]
+'''
+
+import os
+import sys
+import threading
+import Queue
+import numpy as np
+import instrument
+from postage_stamps import BandTile, common_assoc, object_bounds, object_stamps, object_masks, stamp_directories, write_object_stamps
+from modified_make_input import write_input
+from async_writer import AsyncWriter
+
+_done = object()
+
+#Runs stage (a generator function of an iterator) in its own thread and yields what it yields, through a queue of
+#at most maxsize items. An exception in the stage is raised again in the consumer.
+def threaded(stage, items, maxsize=16):
+    queue = Queue.Queue(maxsize)
+    failure = []
+    def run():
+        try:
+            for item in stage(items):
+                queue.put(item)
+        except Exception, e:
+            failure.append(sys.exc_info())
+        queue.put(_done)
+    thread = threading.Thread(target=run, name=stage.__name__)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = queue.get()
+        if item is _done:
+            break
+        yield item
+    thread.join()
+    if len(failure) > 0:
+        raise failure[0][0], failure[0][1], failure[0][2]
+
+#One galaxy per associated object of every tile: {"tile", "bands", "filters", "assoc"}. The bands of a tile are
+#not closed here; their memory maps go away with the last galaxy that refers to them. A store
+#(image_store.ImageStore) has the images and TT fields read through it.
+def associated_objects(tiles, store=None):
+    for (catalogs, files, filters, tt_roots) in tiles:
+        bands = [BandTile(catalogs[b], files[b], filters[b], tt_roots[b], store=store) for b in range(len(catalogs))]
+        for assoc in common_assoc(bands):
+            yield {"tile" : files[0], "bands" : bands, "filters" : filters, "assoc" : assoc}
+
+def cut_stamps(galaxies):
+    for galaxy in galaxies:
+        found = object_bounds(galaxy["bands"], galaxy["assoc"])
+        if found is None:
+            continue
+        galaxy["bounds"], galaxy["stampL"] = found
+        try:
+            galaxy["stamps"] = object_stamps(galaxy["bands"], galaxy["assoc"], galaxy["bounds"], galaxy["stampL"])
+        except (ValueError, IndexError):
+            continue
+        yield galaxy
+
+def cut_masks(galaxies):
+    for galaxy in galaxies:
+        try:
+            galaxy["stamps"]["mask"] = object_masks(galaxy["bands"], galaxy["assoc"], galaxy["bounds"])
+        except IndexError:
+            continue
+        yield galaxy
+
+#Why a galaxy fails the quality screen, or None if it passes
+def screen_reason(galaxy, max_bad_fraction=0.1):
+    stamps = galaxy["stamps"]
+    for b in range(len(galaxy["bands"])):
+        if not np.isfinite(stamps["images"][b].array).all():
+            return "non-finite pixels"
+        if np.mean(stamps["ivar"][b].array <= 0) > max_bad_fraction:
+            return "zero-weight pixels"
+        if not stamps["mask"][b].array.any():
+            return "no central object"
+    return None
+
+def screen(galaxies, max_bad_fraction=0.1, rejected=None):
+    for galaxy in galaxies:
+        reason = screen_reason(galaxy, max_bad_fraction)
+        if reason is None:
+            yield galaxy
+        elif rejected is not None:
+            rejected[reason] = rejected.get(reason, 0) + 1
+
+#Stamps are written by an AsyncWriter per tile and listed in out_path/stamps_<image>/index.txt once complete, as
+#postage_stamps.get_multiband_stamps writes them. The writer is flushed at every rows_per_file-th galaxy of a tile
+#and closed at the end of the tile, so the stamps of a fitting input part are on disk before the part is written.
+def write_stamps(galaxies, out_path, rows_per_file=500, n_writers=4, compression=None):
+    tile = None
+    writer = None
+    for galaxy in galaxies:
+        if galaxy["tile"] != tile:
+            if writer is not None:
+                writer.close()
+            tile = galaxy["tile"]
+            stamp_dir = os.path.join(out_path, "stamps_" + os.path.basename(tile))
+            directories = stamp_directories(out_path, "stamps_" + os.path.basename(tile))
+            writer = AsyncWriter(n_writers, index_name=os.path.join(stamp_dir, "index.txt"))
+            n = 0
+        bands = galaxy["bands"]
+        ra = bands[0].value('ALPHA_SKY', galaxy["assoc"])
+        dec = bands[0].value('DELTA_SKY', galaxy["assoc"])
+        write_object_stamps(galaxy["stamps"], galaxy["filters"], galaxy["assoc"], ra, dec, directories, writer, compression)
+        n += 1
+        if n % rows_per_file == 0:
+            writer.flush()
+        #Only the row of the fitting input and where its stamps are is needed from here on
+        yield {"tile" : tile, "stamp_dir" : stamp_dir, "assoc" : galaxy["assoc"], "ra" : ra, "dec" : dec}
+    if writer is not None:
+        writer.close()
+
+#<out_name root>_<image root>_part<k>.fits, the k-th fitting input part of a tile
+def part_name(out_name, tile, k):
+    root, ext = os.path.splitext(out_name)
+    return root + "_" + os.path.splitext(os.path.basename(tile))[0] + "_part%04d" % k + (ext or ".fits")
+
+#Writes the fitting input of each tile every rows_per_file galaxies and at the end of the tile, so every part holds
+#the galaxies of one tile and fits with the stamps of one directory. Yields (file, stamp directory, galaxies in it).
+def fitting_inputs(galaxies, out_name, rows_per_file=500):
+    rows = []
+    tile = None
+    for galaxy in galaxies:
+        if galaxy["tile"] != tile:
+            if len(rows) > 0:
+                yield write_part(rows, part_name(out_name, tile, k), stamp_dir)
+            rows = []
+            k = 0
+            tile = galaxy["tile"]
+            stamp_dir = galaxy["stamp_dir"]
+        rows.append((galaxy["assoc"], galaxy["ra"], galaxy["dec"]))
+        if len(rows) == rows_per_file:
+            yield write_part(rows, part_name(out_name, tile, k), stamp_dir)
+            rows = []
+            k += 1
+    if len(rows) > 0:
+        yield write_part(rows, part_name(out_name, tile, k), stamp_dir)
+
+def write_part(rows, fname, stamp_dir):
+    names, ra, dec = zip(*rows)
+    write_input(fname, np.array(names, dtype=np.int32), np.array(ra, dtype=np.float64), np.array(dec, dtype=np.float64))
+    print "Wrote", len(rows), "galaxies to", fname
+    return fname, stamp_dir, len(rows)
+
+#Runs the whole chain on every tile. The lists hold one entry per band (catalog and image list files, filters,
+#TT roots), with the tiles in the same order in every list. Returns the (fitting input file, stamp directory) of
+#every part, as fit_galaxies.fit_sample takes them.
+def run(catalog_list_files, image_list_files, filters, tt_roots, out_path, out_name, rows_per_file=500, queue_size=16, max_bad_fraction=0.1, compression=None, store=None):
+    lists = []
+    for list_file in list(catalog_list_files) + list(image_list_files):
+        f = open(list_file)
+        lists.append([line.strip() for line in f.readlines() if line.strip() != ""])
+        f.close()
+    n_bands = len(filters)
+    tiles = [([lists[b][i] for b in range(n_bands)], [lists[n_bands + b][i] for b in range(n_bands)], filters, tt_roots)
+             for i in range(len(lists[0]))]
+    rejected = {}
+    with instrument.Stage("stream_pipeline") as s:
+        galaxies = threaded(lambda items: associated_objects(items, store), tiles, queue_size)
+        galaxies = threaded(cut_stamps, galaxies, queue_size)
+        galaxies = threaded(cut_masks, galaxies, queue_size)
+        galaxies = threaded(lambda items: screen(items, max_bad_fraction, rejected), galaxies, queue_size)
+        galaxies = threaded(lambda items: write_stamps(items, out_path, rows_per_file, compression=compression), galaxies, queue_size)
+        parts = list(fitting_inputs(galaxies, out_name, rows_per_file))
+        s.rows_out = sum(n for (fname, stamp_dir, n) in parts)
+    for reason in sorted(rejected.keys()):
+        print rejected[reason], "galaxies rejected for", reason
+    return [(fname, stamp_dir) for (fname, stamp_dir, n) in parts]
+
+if __name__ == "__main__":
+    options = {"rows_per_file" : "500", "queue_size" : "16"}
+    for arg in sys.argv[7:]:
+        key, value = arg.split("=", 1)
+        options[key] = value
+    run(sys.argv[2].split(","), sys.argv[3].split(","), [int(filter) for filter in sys.argv[4].split(",")],
+        [root if root.endswith("/") else root + "/" for root in sys.argv[5].split(",")], sys.argv[6], sys.argv[1],
+        int(options["rows_per_file"]), int(options["queue_size"]))
@@ -0,0 +1,216 @@
+'''
+Script Name: subtiles.py
+
+########### Description ##########
+
+Runs SExtractor on a tile as n_x x n_y overlapping sub-tiles in parallel, instead of one single-threaded run on the
+whole tile, and stitches the results into the catalog (and check images) one run would have written.
+
+The tile is cut into a grid of cores that cover it exactly; each sub-image is a core plus margin pixels on every
+side (clipped at the tile edges), written with CRPIX shifted so ALPHA_SKY and DELTA_SKY are unchanged. The margin
+has to be larger than the biggest object, so that every object lies whole in the sub-image whose core holds its
+centroid. The sub-images are written next to the catalog (named after CATALOG_NAME and the input file), not next
+to the input tiles. The SExtractor configuration of the full run is copied for each sub-image with its own
+CATALOG_NAME, WEIGHT_IMAGE and CHECKIMAGE_NAME, and the runs go through instrument.call on a pool of threads (one
+per CPU by default).
+
+Stitching shifts X_IMAGE, Y_IMAGE and XMIN/XMAX/YMIN/YMAX_IMAGE back to tile pixels and keeps, of each sub-tile,
+the objects whose centroid is in its core, so objects seen twice in a margin are kept once. NUMBER is renumbered
+1..n over the tile. A SEGMENTATION check image is stitched from the cores, with the labels renumbered to match
+(pixels of a margin duplicate get the label of the object that was kept). Other check images are stitched from
+the cores as they are.
+
+Dual-image runs ("sex detection.fits,image.fits") split both images the same way.
+
+GalaxyCatalog(..., subtiles=(n_x, n_y)) runs both passes of generate_catalog this way.
+
+########## Usage ##########
+
+run_sextractor_split("606_17_drz.fits", "606_17_faint.config", (2, 2), margin=500)
+'''
+
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pyfits
+import instrument
+from sextractor_io import read_catalog, write_catalog, Catalog
+from cleanutils import box_pairs
+
+pixel_columns = {"X_IMAGE" : 0, "XMIN_IMAGE" : 0, "XMAX_IMAGE" : 0, "Y_IMAGE" : 1, "YMIN_IMAGE" : 1, "YMAX_IMAGE" : 1}
+
+#Cores and cut-outs of an n_x x n_y split of an image of nx x ny pixels, as (x0, x1, y0, y1) 0-indexed and
+#half-open: [(core, cut), ...]
+def subtile_bounds(nx, ny, n_x, n_y, margin):
+    x_edges = np.linspace(0, nx, n_x + 1).astype(int)
+    y_edges = np.linspace(0, ny, n_y + 1).astype(int)
+    bounds = []
+    for j in range(n_y):
+        for i in range(n_x):
+            core = (x_edges[i], x_edges[i+1], y_edges[j], y_edges[j+1])
+            cut = (max(core[0] - margin, 0), min(core[1] + margin, nx), max(core[2] - margin, 0), min(core[3] + margin, ny))
+            bounds.append((core, cut))
+    return bounds
+
+#Writes the cut (x0, x1, y0, y1) of an image, with the WCS reference pixel moved with it
+def write_cut(file, cut, out_name):
+    f = pyfits.open(file, memmap=True)
+    header = f[0].header.copy()
+    x0, x1, y0, y1 = cut
+    data = np.array(f[0].data[y0:y1, x0:x1])
+    f.close()
+    if 'CRPIX1' in header:
+        header['CRPIX1'] = header['CRPIX1'] - x0
+        header['CRPIX2'] = header['CRPIX2'] - y0
+    pyfits.PrimaryHDU(data, header=header).writeto(out_name, clobber=True)
+
+#KEY value lines of a SExtractor configuration file, as [key, value] pairs in order
+def read_config(config_fname):
+    f = open(config_fname)
+    lines = [line.strip().split(None, 1) for line in f.readlines()]
+    f.close()
+    return [line + [""]*(2 - len(line)) for line in lines if len(line) > 0 and line[0][0] != "#"]
+
+def write_config(config, config_fname):
+    f = open(config_fname, "w")
+    for key, value in config:
+        f.write(key + " " + value + "\n")
+    f.close()
+
+def sub_name(name, k):
+    root, extension = os.path.splitext(name)
+    return root + "_sub" + str(k) + extension
+
+#Sub-image k of an input image, written under prefix (the catalog name without extension) rather than next to the
+#input, so runs of different passes or in other directories on the same tile do not overwrite each other's cuts
+def cut_name(prefix, name, k):
+    return sub_name(prefix + "_" + os.path.basename(name), k)
+
+#Objects of the sub-catalogs whose centroid is in their core, in tile pixels and renumbered, written to out_name.
+#Returns {(k, sub-tile NUMBER) : tile NUMBER} for every object kept or dropped as a margin duplicate.
+def stitch_catalogs(sub_catalogs, bounds, out_name):
+    cats = [read_catalog(name) for name in sub_catalogs]
+    kept = []
+    for k in range(len(cats)):
+        cat = cats[k]
+        (core, cut) = bounds[k]
+        if cat.nrows == 0:
+            kept.append(np.zeros(0, dtype=bool))
+            continue
+        for name in pixel_columns:
+            if name in cat:
+                cat[name] = cat[name] + cut[2*pixel_columns[name]]
+        x = cat['X_IMAGE'] - 0.5
+        y = cat['Y_IMAGE'] - 0.5
+        kept.append((x >= core[0]) & (x < core[1]) & (y >= core[2]) & (y < core[3]))
+    first = cats[0]
+    rows = [np.where(keep)[0] for keep in kept]
+    lines = []
+    for k in range(len(cats)):
+        lines += [cats[k].lines[i] for i in rows[k]]
+    columns = {}
+    for name in first.names:
+        parts = [cats[k][name][rows[k]] for k in range(len(cats)) if len(rows[k]) > 0]
+        columns[name] = np.concatenate(parts) if len(parts) > 0 else np.zeros(0)
+    stitched = Catalog(first.header, list(first.names), lines, columns, first.comments)
+    for name in pixel_columns.keys() + ["NUMBER"]:
+        if name in stitched:
+            stitched.modified.add(name)
+    stitched.columns['NUMBER'] = np.arange(1, stitched.nrows + 1)
+    write_catalog(stitched, out_name)
+    #Labels of the kept objects, then of the margin duplicates (the kept object at the same centroid)
+    numbers = {}
+    n = 0
+    for k in range(len(cats)):
+        for i in rows[k]:
+            n += 1
+            numbers[(k, int(cats[k]['NUMBER'][i]))] = n
+    for k in range(len(cats)):
+        dropped = np.where(~kept[k])[0]
+        if len(dropped) == 0 or stitched.nrows == 0:
+            continue
+        i, j = box_pairs(cats[k]['X_IMAGE'][dropped], cats[k]['Y_IMAGE'][dropped], stitched['X_IMAGE'], stitched['Y_IMAGE'], 1.0)
+        first_pair = np.ones(len(i), dtype=bool)
+        first_pair[1:] = i[1:] != i[:-1]
+        for a, b in zip(i[first_pair], j[first_pair]):
+            numbers[(k, int(cats[k]['NUMBER'][dropped[a]]))] = int(b) + 1
+    return numbers
+
+#Stitches the cores of the sub-tile check images into one image of the tile. Segmentation labels are translated
+#with numbers (from stitch_catalogs); labels without a match become background.
+def stitch_image(sub_images, bounds, shape, out_name, numbers=None):
+    header = pyfits.getheader(sub_images[0])
+    out = None
+    for k in range(len(sub_images)):
+        (core, cut) = bounds[k]
+        data = pyfits.getdata(sub_images[k])
+        if out is None:
+            out = np.zeros(shape, dtype=data.dtype)
+        part = data[core[2]-cut[2]:core[3]-cut[2], core[0]-cut[0]:core[1]-cut[0]]
+        if numbers is not None:
+            lookup = np.zeros(int(part.max()) + 1 if part.size > 0 else 1, dtype=np.int32)
+            for (sub, label), number in numbers.iteritems():
+                if sub == k and label < len(lookup):
+                    lookup[label] = number
+            part = lookup[part]
+        out[core[2]:core[3], core[0]:core[1]] = part
+    if 'CRPIX1' in header:
+        header['CRPIX1'] = header['CRPIX1'] + bounds[0][1][0]
+        header['CRPIX2'] = header['CRPIX2'] + bounds[0][1][2]
+    pyfits.PrimaryHDU(out, header=header).writeto(out_name, clobber=True)
+
+#Runs "sex images -c config_fname" as n_x x n_y sub-tiles on processes threads and stitches the catalog and check
+#images into the names config_fname gives. images is one file, or "detection,measurement" in dual-image mode.
+def run_sextractor_split(images, config_fname, subtiles, margin=500, processes=None):
+    n_x, n_y = subtiles
+    config = read_config(config_fname)
+    settings = dict(config)
+    files = images.split(",")
+    weights = [name for name in settings.get('WEIGHT_IMAGE', "").split(",") if name != ""]
+    catalog_name = settings['CATALOG_NAME']
+    prefix = os.path.splitext(catalog_name)[0]
+    check_names = [name for name in settings.get('CHECKIMAGE_NAME', "").split(",") if name != ""]
+    check_types = [name for name in settings.get('CHECKIMAGE_TYPE', "").split(",") if name != ""]
+    header = pyfits.getheader(files[0])
+    shape = (int(header['NAXIS2']), int(header['NAXIS1']))
+    bounds = subtile_bounds(shape[1], shape[0], n_x, n_y, margin)
+    with instrument.Stage("split_tile"):
+        commands = []
+        written = []
+        for k in range(len(bounds)):
+            cut = bounds[k][1]
+            sub_files = [cut_name(prefix, name, k) for name in files]
+            sub_weights = [cut_name(prefix, name, k) for name in weights]
+            for name, sub in zip(files + weights, sub_files + sub_weights):
+                write_cut(name, cut, sub)
+            sub_config = []
+            for key, value in config:
+                if key == 'CATALOG_NAME':
+                    value = sub_name(catalog_name, k)
+                elif key == 'WEIGHT_IMAGE':
+                    value = ",".join(sub_weights)
+                elif key == 'CHECKIMAGE_NAME':
+                    value = ",".join(sub_name(name, k) for name in check_names)
+                sub_config.append([key, value])
+            write_config(sub_config, sub_name(config_fname, k))
+            commands.append(["sex", ",".join(sub_files), "-c", sub_name(config_fname, k)])
+            written += sub_files + sub_weights + [sub_name(config_fname, k)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = ThreadPool(min(processes, len(commands)))
+    pool.map(instrument.call, commands)
+    pool.close()
+    pool.join()
+    with instrument.Stage("stitch_tile") as s:
+        sub_catalogs = [sub_name(catalog_name, k) for k in range(len(bounds))]
+        numbers = stitch_catalogs(sub_catalogs, bounds, catalog_name)
+        for check_type, name in zip(check_types, check_names):
+            sub_images = [sub_name(name, k) for k in range(len(bounds))]
+            stitch_image(sub_images, bounds, shape, name, numbers if check_type == "SEGMENTATION" else None)
+            written += sub_images
+        written += sub_catalogs
+        s.rows_out = catalog_name
+    for name in written:
+        if os.path.exists(name):
+            os.remove(name)
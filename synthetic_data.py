@@ -0,0 +1,338 @@
+'''
+Script Name: synthetic_data.py
+
+########### Description ##########
+
+Makes a small fake AEGIS survey that the pipeline can run on end to end, for benchmarking and regression testing
+without the real data or the TinyTim fields:
+
+-drz/wht tile pairs in f606w and f814w with a TAN WCS, laid out on a grid so that neighbouring tiles overlap
+-a galaxy population (Sersic profiles with power-law number counts and magnitude-dependent sizes) and a star
+ population, convolved with a PSF that depends on the tile focus and on the position in the tile
+-diffraction spikes on the bright stars, with the length/angle conventions of HST_Sextractor_new
+-zero-weight borders following the edge polygon used by cleanutils.edge_keep
+-fake TinyTim fields (noiseless PSF star grids for focus -10 to +5 um) and star lists in the layout that
+ focus_positions.get_tt_files and get_star_file expect
+
+Magnitudes use the pipeline convention MAG_AUTO + 25, i.e. a zeropoint of 25. Pixel positions are 1-indexed
+like SExtractor.
+
+########## Output ##########
+
+In out_dir:
+EGS_10134_<id>_acs_wfc_f606w_30mas_unrot_drz.fits and ..._wht.fits (likewise for f814w)
+f606w_filenames.txt, f606w_backgrounds.txt (likewise for f814w), as used by run.py
+F606W_TT/TinyTim_f<focus>.fits, F606W_TT/606_stars.txt (likewise for F814W_TT)
+truth_sources.txt: one line per source
+truth_focus.txt: file name and focus of each tile
+synthetic.json: the parameters the data were made with
+
+########## Usage ##########
+
+python synthetic_data.py out_dir [size] [n_tiles_x] [n_tiles_y] [seed]
+
+or make_survey(out_dir, size=2048, n_tiles=(2,1))
+'''
+
+import numpy as np
+import pyfits
+import json
+import os
+import sys
+from scipy.signal import fftconvolve
+
+pixel_scale = 0.03
+zeropoint = 25.
+survey_center = (214.85, 52.85)
+#Corners of the data region of a 7500x7500 tile, from cleanutils.edge_keep (which scales them to the tile size
+#as in_footprint does, cleanutils.tile_edge_corners)
+edge_corners = [(390.,321.), (498.,6725.), (6898.,7287.), (7002.,806.)]
+#(FWHM in pixels, spike length slope, spike length intercept, spike width, spike angle in degrees)
+band_params = {606 : (3.2, 0.0350087, 64.0863, 40.0, 2.614),
+               814 : (3.6, 0.0367020, 77.7674, 40.0, 2.180)}
+focus_range = range(-10,6)
+tt_spacing = 400
+
+def tile_id(k):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    return digits[k // 36] + digits[k % 36]
+
+#The [10:12] slice of this name is the tile id, which is what run.py uses to name the catalogs
+def tile_name(band, k):
+    return "EGS_10134_" + tile_id(k) + "_acs_wfc_f" + str(band) + "w_30mas_unrot_drz.fits"
+
+def weight_name(file):
+    return file[:len(file)-8] + "wht.fits"
+
+def tile_header(ra0, dec0, size):
+    header = pyfits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = ra0
+    header['CRVAL2'] = dec0
+    header['CRPIX1'] = 0.5*(size+1)
+    header['CRPIX2'] = 0.5*(size+1)
+    header['CD1_1'] = -pixel_scale/3600.
+    header['CD1_2'] = 0.
+    header['CD2_1'] = 0.
+    header['CD2_2'] = pixel_scale/3600.
+    header['EXPTIME'] = 1.
+    return header
+
+#Gnomonic projection onto a tile with tangent point (ra0,dec0), 1-indexed pixels with north up and east left
+def sky_to_pixel(ra, dec, ra0, dec0, size):
+    ra, dec, ra0, dec0 = np.radians(ra), np.radians(dec), np.radians(ra0), np.radians(dec0)
+    cosc = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*np.cos(dec)*np.cos(ra-ra0)
+    xi = np.cos(dec)*np.sin(ra-ra0)/cosc
+    eta = (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*np.cos(dec)*np.cos(ra-ra0))/cosc
+    scale = np.degrees(1.)*3600./pixel_scale
+    return 0.5*(size+1) - xi*scale, 0.5*(size+1) + eta*scale
+
+def pixel_to_sky(x, y, ra0, dec0, size):
+    scale = np.degrees(1.)*3600./pixel_scale
+    xi = -(np.asarray(x) - 0.5*(size+1))/scale
+    eta = (np.asarray(y) - 0.5*(size+1))/scale
+    dec0 = np.radians(dec0)
+    denom = np.cos(dec0) - eta*np.sin(dec0)
+    ra = np.radians(ra0) + np.arctan2(xi, denom)
+    dec = np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.hypot(xi, denom))
+    return np.degrees(ra), np.degrees(dec)
+
+#True for the pixels (1-indexed x, y) inside the data region of a tile of the given size
+def in_footprint(x, y, size):
+    corners = [(cx*size/7500., cy*size/7500.) for (cx, cy) in edge_corners]
+    inside = np.ones(np.broadcast(x, y).shape, dtype=bool)
+    for i in range(4):
+        (x1, y1), (x2, y2) = corners[i], corners[(i+1) % 4]
+        #The corners go clockwise, so the data region is on the right of every edge
+        inside &= (x2-x1)*(y-y1) - (y2-y1)*(x-x1) <= 0
+    return inside
+
+#Axis ratio and position angle (radians) of a shape with ellipticity (e1,e2), |e| = (1-q^2)/(1+q^2)
+def ellipticity_to_shape(e1, e2):
+    e = min(np.hypot(e1, e2), 0.95)
+    return np.sqrt((1-e)/(1+e)), 0.5*np.arctan2(e2, e1)
+
+#Area-preserving elliptical radius for a profile with axis ratio q and major axis at angle beta
+def elliptical_radius(dx, dy, q, beta):
+    xr = dx*np.cos(beta) + dy*np.sin(beta)
+    yr = -dx*np.sin(beta) + dy*np.cos(beta)
+    return np.sqrt(q*xr**2 + yr**2/q)
+
+#PSF ellipticity and FWHM at focus f (um) and tile position (x,y). The astigmatism grows linearly with the
+#distance from the best focus and rotates across the field, so different TT fields are distinguishable by
+#the star shapes the way focus_positions needs.
+def psf_shape(band, f, x, y, size):
+    fwhm = band_params[band][0]*(1 + 0.002*f**2)
+    u = x/float(size) - 0.5
+    v = y/float(size) - 0.5
+    e1 = 0.008*f*(1 + u) + 0.03*u
+    e2 = 0.005*f*(1 - v) - 0.03*v
+    return fwhm, e1, e2
+
+def moffat(dx, dy, fwhm, e1, e2, beta=2.5):
+    q, angle = ellipticity_to_shape(e1, e2)
+    alpha = fwhm/(2*np.sqrt(2**(1./beta) - 1))
+    r = elliptical_radius(dx, dy, q, angle)
+    return (1 + (r/alpha)**2)**(-beta)
+
+def sersic(dx, dy, hlr, n, q, pa):
+    b = 2*n - 1./3 + 4./(405*n)
+    r = elliptical_radius(dx, dy, q, pa)
+    return np.exp(-b*(r/hlr)**(1./n))
+
+#Offsets of the stamp pixels from (x,y) and the slices of the tile they cover
+def stamp_grid(x, y, half, shape):
+    i0 = int(np.round(y)) - 1
+    j0 = int(np.round(x)) - 1
+    ylo, yhi = max(i0-half, 0), min(i0+half+1, shape[0])
+    xlo, xhi = max(j0-half, 0), min(j0+half+1, shape[1])
+    if ylo >= yhi or xlo >= xhi:
+        return None
+    dy, dx = np.mgrid[ylo:yhi, xlo:xhi]
+    return dx + 1 - x, dy + 1 - y, (slice(ylo, yhi), slice(xlo, xhi))
+
+def psf_stamp(band, f, x, y, size, half):
+    fwhm, e1, e2 = psf_shape(band, f, x, y, size)
+    d = np.arange(-half, half+1)
+    p = moffat(d[np.newaxis,:], d[:,np.newaxis], fwhm, e1, e2)
+    return p/p.sum()
+
+def add_star(data, band, f, x, y, flux, size):
+    fwhm, e1, e2 = psf_shape(band, f, x, y, size)
+    #Bright stars get wider stamps so their Moffat wings are not cut off above the noise
+    grid = stamp_grid(x, y, int(12*fwhm + 4*np.log10(max(flux, 1.))*fwhm), data.shape)
+    if grid is None:
+        return
+    dx, dy, s = grid
+    p = moffat(dx, dy, fwhm, e1, e2)
+    data[s] += flux*p/p.sum()
+
+def add_galaxy(data, band, f, x, y, flux, hlr, n, q, pa, size):
+    half = int(min(8*hlr/np.sqrt(q), 200)) + 8
+    grid = stamp_grid(x, y, half, data.shape)
+    if grid is None:
+        return
+    dx, dy, s = grid
+    g = sersic(dx, dy, hlr, n, q, pa)
+    g *= flux/g.sum()
+    data[s] += fftconvolve(g, psf_stamp(band, f, x, y, size, 8), mode='same')
+
+#Four spikes along the (rotated) axes, with the length l = m*flux + b that cleanutils.diffraction_keep masks
+def add_spikes(data, band, x, y, flux):
+    m, b, width, theta = band_params[band][1:]
+    length = m*flux + b
+    half = int(length) + 2
+    grid = stamp_grid(x, y, half, data.shape)
+    if grid is None:
+        return
+    dx, dy, s = grid
+    theta = np.radians(theta)
+    u = dx*np.cos(theta) + dy*np.sin(theta)
+    v = -dx*np.sin(theta) + dy*np.cos(theta)
+    peak = 2e-3*flux
+    spikes = np.zeros(dx.shape)
+    for along, across in [(u, v), (v, u)]:
+        spikes += peak*np.clip(1 - np.abs(along)/length, 0, None)*np.exp(-0.5*(across/1.5)**2)
+    data[s] += spikes
+
+#Power-law number counts dN/dm ~ 10^(slope*m) between mag_min and mag_max
+def draw_magnitudes(rng, n, mag_min, mag_max, slope):
+    u = rng.uniform(size=n)
+    lo, hi = 10**(slope*mag_min), 10**(slope*mag_max)
+    return np.log10(lo + u*(hi-lo))/slope
+
+#Sources covering the whole survey area. Galaxy half-light radii shrink with magnitude (0.3" at mag 22).
+def make_sources(rng, ra_range, dec_range, n_galaxies, n_stars):
+    n = n_galaxies + n_stars
+    dec = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(dec_range[0])), np.sin(np.radians(dec_range[1])), n)))
+    ra = rng.uniform(ra_range[0], ra_range[1], n)
+    is_star = np.zeros(n, dtype=int)
+    is_star[n_galaxies:] = 1
+    mag606 = np.concatenate([draw_magnitudes(rng, n_galaxies, 20., 27.5, 0.3), draw_magnitudes(rng, n_stars, 16., 25., 0.1)])
+    color = np.concatenate([rng.normal(0.6, 0.3, n_galaxies), rng.normal(0.8, 0.5, n_stars)])
+    hlr = 0.3/pixel_scale*10**(-0.1*(mag606-22))*np.exp(rng.normal(0, 0.3, n))
+    hlr = np.clip(hlr, 1.5, 60.)
+    hlr[n_galaxies:] = 0.
+    sersic_n = np.where(is_star == 1, 0., rng.uniform(0.5, 4., n))
+    q = np.where(is_star == 1, 1., rng.uniform(0.2, 1., n))
+    pa = rng.uniform(0, np.pi, n)
+    return np.rec.fromarrays([np.arange(n), ra, dec, mag606, mag606-color, hlr, sersic_n, q, pa, is_star],
+                             names="ID,RA,DEC,MAG606,MAG814,HLR,N,Q,PA,IS_STAR")
+
+def flux_of(mag):
+    return 10**(-0.4*(mag-zeropoint))
+
+#Draws every source that lands in the tile, adds noise and writes the drz/wht pair
+def make_tile(out_dir, band, k, ra0, dec0, size, sources, f, noise, rng):
+    x, y = sky_to_pixel(sources.RA, sources.DEC, ra0, dec0, size)
+    margin = 100
+    near = (x > -margin) & (x < size+margin) & (y > -margin) & (y < size+margin)
+    data = np.zeros((size, size), dtype=np.float64)
+    mag = sources.MAG606 if band == 606 else sources.MAG814
+    for i in np.where(near)[0]:
+        flux = flux_of(mag[i])
+        if sources.IS_STAR[i] == 1:
+            add_star(data, band, f, x[i], y[i], flux, size)
+            if mag[i] < 19.:
+                add_spikes(data, band, x[i], y[i], flux)
+        else:
+            add_galaxy(data, band, f, x[i], y[i], flux, sources.HLR[i], sources.N[i], sources.Q[i], sources.PA[i], size)
+    yy, xx = np.mgrid[1:size+1, 1:size+1]
+    inside = in_footprint(xx, yy, size)
+    del xx, yy
+    #Slowly varying depth across the tile
+    sigma = noise*(1 + 0.1*np.sin(np.linspace(0, np.pi, size)))[np.newaxis,:]*np.ones((size,1))
+    data += rng.normal(size=(size, size))*sigma
+    data[~inside] = 0.
+    weight = np.where(inside, 1/sigma**2, 0.)
+    del sigma
+    header = tile_header(ra0, dec0, size)
+    name = tile_name(band, k)
+    pyfits.PrimaryHDU(data.astype(np.float32), header=header).writeto(os.path.join(out_dir, name), clobber=True)
+    pyfits.PrimaryHDU(weight.astype(np.float32), header=header).writeto(os.path.join(out_dir, weight_name(name)), clobber=True)
+    return name
+
+#Noiseless grids of unit-flux PSF stars, one field per focus position, and the list of their centroids
+def make_tt_fields(out_dir, band, size):
+    tt_dir = os.path.join(out_dir, "F" + str(band) + "W_TT")
+    if not os.path.isdir(tt_dir):
+        os.makedirs(tt_dir)
+    centers = np.arange(tt_spacing/2, size, tt_spacing) + 0.5
+    for f in focus_range:
+        data = np.zeros((size, size), dtype=np.float64)
+        for y in centers:
+            for x in centers:
+                add_star(data, band, f, x, y, 1., size)
+        pyfits.PrimaryHDU(data.astype(np.float32)).writeto(os.path.join(tt_dir, "TinyTim_f" + str(f) + ".fits"), clobber=True)
+    out = open(os.path.join(tt_dir, str(band) + "_stars.txt"), "w")
+    out.write("#   1 X_IMAGE                Object position along x                                    [pixel]\n")
+    out.write("#   2 Y_IMAGE                Object position along y                                    [pixel]\n")
+    for y in centers:
+        for x in centers:
+            out.write("%11.3f %11.3f\n" % (x, y))
+    out.close()
+
+def write_truth(out_dir, sources):
+    out = open(os.path.join(out_dir, "truth_sources.txt"), "w")
+    out.write("#" + " ".join(sources.dtype.names) + "\n")
+    for s in sources:
+        out.write("%d %.7f %.7f %.3f %.3f %.3f %.3f %.3f %.4f %d\n" % tuple(s))
+    out.close()
+
+#Tiles are size x size pixels on an n_tiles[0] x n_tiles[1] grid, overlapping their neighbours by overlap pixels.
+#Densities are per square pixel; the defaults give about 5600 galaxies and 200 stars on a full 7500x7500 tile.
+def make_survey(out_dir, size=2048, n_tiles=(2,1), overlap=200, seed=0, bands=(606,814), galaxy_density=1e-4,
+                star_density=4e-6, noise=0.004, tt_fields=True):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    rng = np.random.RandomState(seed)
+    step = (size - overlap)*pixel_scale/3600.
+    dec_step = step
+    ra_step = step/np.cos(np.radians(survey_center[1]))
+    centers = []
+    for j in range(n_tiles[1]):
+        for i in range(n_tiles[0]):
+            centers.append((survey_center[0] - (i - 0.5*(n_tiles[0]-1))*ra_step, survey_center[1] + (j - 0.5*(n_tiles[1]-1))*dec_step))
+    corners = [pixel_to_sky(x, y, ra0, dec0, size) for (ra0, dec0) in centers for x in (0, size+1) for y in (0, size+1)]
+    ras = [c[0] for c in corners]
+    decs = [c[1] for c in corners]
+    area = (n_tiles[0]*(size-overlap) + overlap)*(n_tiles[1]*(size-overlap) + overlap)
+    sources = make_sources(rng, (min(ras), max(ras)), (min(decs), max(decs)), rng.poisson(galaxy_density*area), rng.poisson(star_density*area))
+    write_truth(out_dir, sources)
+    focus_file = open(os.path.join(out_dir, "truth_focus.txt"), "w")
+    for band in bands:
+        images = open(os.path.join(out_dir, "f" + str(band) + "w_filenames.txt"), "w")
+        weights = open(os.path.join(out_dir, "f" + str(band) + "w_backgrounds.txt"), "w")
+        for k in range(len(centers)):
+            f = rng.uniform(-8., 3.)
+            print "Making tile", k, "in f" + str(band) + "w"
+            name = make_tile(out_dir, band, k, centers[k][0], centers[k][1], size, sources, f, noise, rng)
+            images.write(name + "\n")
+            weights.write(weight_name(name) + "\n")
+            focus_file.write(name + " " + str(f) + "\n")
+        images.close()
+        weights.close()
+        if tt_fields:
+            print "Making TT fields for f" + str(band) + "w"
+            make_tt_fields(out_dir, band, size)
+    focus_file.close()
+    params = {"size" : size, "n_tiles" : list(n_tiles), "overlap" : overlap, "seed" : seed, "bands" : list(bands),
+              "galaxy_density" : galaxy_density, "star_density" : star_density, "noise" : noise,
+              "n_sources" : len(sources)}
+    out = open(os.path.join(out_dir, "synthetic.json"), "w")
+    json.dump(params, out, indent=1, sort_keys=True)
+    out.close()
+    return params
+
+if __name__ == "__main__":
+    size = 2048
+    n_tiles = (2,1)
+    seed = 0
+    if len(sys.argv) > 2:
+        size = int(sys.argv[2])
+    if len(sys.argv) > 4:
+        n_tiles = (int(sys.argv[3]), int(sys.argv[4]))
+    if len(sys.argv) > 5:
+        seed = int(sys.argv[5])
+    make_survey(sys.argv[1], size=size, n_tiles=n_tiles, seed=seed)